@@ -2,7 +2,7 @@ import os
 import shutil
 from typing import Any, Dict
 from urllib.parse import urlparse
-from urllib.request import urlretrieve
+from urllib.request import Request, urlopen, urlretrieve
 
 import numpy as np
 import torch
@@ -12,15 +12,26 @@ import matplotlib.patches as patches
 
 from PIL import Image
 
-def download_data(download_directory: str, data_config: Dict[str, Any]) -> str:
-    if not os.path.exists(download_directory):
-        os.makedirs(download_directory, exist_ok=True)
+from dataset_cache import DatasetCache
+
+
+def download_data(cache: DatasetCache, data_config: Dict[str, Any]) -> str:
+    """
+    Downloads and unpacks the archive at `url` into the dataset cache, unless the same version (as told by its ETag)
+    is already there, and returns the directory it is unpacked in.
+    """
     url = data_config["url"]
     filename = os.path.basename(urlparse(url).path)
-    filepath = os.path.join(download_directory, filename)
-    if not os.path.exists(filepath):
+    with urlopen(Request(url, method="HEAD")) as response:
+        etag = response.headers.get("ETag", "")
+
+    def download(path):
+        filepath = os.path.join(path, filename)
         urlretrieve(url, filename=filepath)
-        shutil.unpack_archive(filepath, download_directory)
+        shutil.unpack_archive(filepath, path)
+
+    root, _ = cache.fetch(("url", url, etag), download)
+    return root
 
 
 def collate_fn(batch):
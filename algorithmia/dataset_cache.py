@@ -0,0 +1,220 @@
+import collections
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import time
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+DEFAULT_ROOT = "/tmp/dataset-cache"
+DEFAULT_SIZE_GB = 50.0
+
+
+class DatasetCache:
+    """
+    Node-level cache of downloaded datasets, keyed by whatever identifies their content exactly: (repo, commit,
+    path) for a Pachyderm repository, (bucket, table, version) for a Delta table, URL and ETag for a file.
+
+    Every rank of a trial shares the cache, and so does every trial that can see `root` (i.e. a directory
+    bind-mounted from the agent's host). A lock file per entry makes sure that a single process downloads it while
+    the others wait, downloads go to a temporary directory that is renamed once complete, and the least recently
+    used entries are evicted when a download grows the cache beyond `max_size_gb`. The entries returned by `fetch`
+    are held with a shared lock until the process exits, so that they are never evicted from under a running trial.
+    """
+
+    COMPLETE_MARKER = ".complete"
+    # [device, inode, size in bytes] of the files of an entry, recorded when it is committed
+    SIZE_FILE = ".size"
+    PENDING_PREFIX = ".tmp-"
+
+    def __init__(self, root: str = DEFAULT_ROOT, max_size_gb: float = DEFAULT_SIZE_GB):
+        self.root = root
+        self.max_size_bytes = int(float(max_size_gb) * 1024**3)
+        self.held = {}
+        os.makedirs(self.root, exist_ok=True)
+
+    @classmethod
+    def from_data_config(cls, data_config: Dict[str, Any]) -> "DatasetCache":
+        return cls(
+            data_config.get("dataset_cache_dir", DEFAULT_ROOT),
+            data_config.get("dataset_cache_gb", DEFAULT_SIZE_GB),
+        )
+
+    @staticmethod
+    def entry_name(key: Sequence) -> str:
+        # Readable prefix for humans, hash of the full key for uniqueness
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", "-".join(str(part) for part in key))[:64].lstrip(".")
+        digest = hashlib.sha256("\0".join(str(part) for part in key).encode("utf-8")).hexdigest()[:16]
+        return f"{slug}-{digest}"
+
+    def entry_path(self, key: Sequence) -> str:
+        return os.path.join(self.root, self.entry_name(key))
+
+    def pending_path(self, key: Sequence) -> str:
+        """Temporary directory of entry `key` while it is being downloaded."""
+        return os.path.join(self.root, f"{self.PENDING_PREFIX}{self.entry_name(key)}")
+
+    def contains(self, key: Sequence) -> bool:
+        return os.path.exists(os.path.join(self.entry_path(key), self.COMPLETE_MARKER))
+
+    def fetch(self, key: Sequence, download: Callable[[str], None], resumable: bool = False) -> Tuple[str, bool]:
+        """
+        Returns the local directory of entry `key` and whether it was a cache hit, calling `download(path)` on a cache
+        miss. With `resumable`, the temporary directory of an interrupted download is handed to `download` again
+        instead of being cleared, for downloads that can skip the files they already have.
+        """
+        name = self.entry_name(key)
+        entry = os.path.join(self.root, name)
+
+        if name in self.held:
+            return entry, True
+
+        lock = open(os.path.join(self.root, f".{name}.lock"), "a")
+        try:
+            while True:
+                # Waits for a download in progress. An exclusive lock would also wait for every process that holds the
+                # entry, i.e. until the other ranks exit
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                hit = self.contains(key)
+                if hit:
+                    break
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Another process is about to download the entry
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+                    time.sleep(random.uniform(0.01, 0.1))
+                    continue
+
+                # The shared lock may have been released while upgrading it
+                hit = self.contains(key)
+                if not hit:
+                    logging.info(f"Dataset cache miss: {key}. Downloading to {entry}")
+                    self._download(name, download, resumable)
+                # Downgrade to a shared lock: other processes can use the entry, but not evict it
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                break
+
+            if hit:
+                logging.info(f"Dataset cache hit: {key}")
+                os.utime(os.path.join(entry, self.COMPLETE_MARKER))
+        except BaseException:
+            lock.close()
+            raise
+
+        self.held[name] = lock
+        if not hit:
+            self.evict()
+        return entry, hit
+
+    def hold(self, key: Sequence) -> bool:
+        """
+        Holds entry `key` like `fetch` does, if it is already in the cache, and returns whether it is.
+        """
+        name = self.entry_name(key)
+        if name in self.held:
+            return True
+
+        lock = open(os.path.join(self.root, f".{name}.lock"), "a")
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        if not self.contains(key):
+            lock.close()
+            return False
+
+        self.held[name] = lock
+        return True
+
+    def release(self, key: Sequence):
+        lock = self.held.pop(self.entry_name(key), None)
+        if lock is not None:
+            lock.close()
+
+    def evict(self):
+        entries = self._entries()
+        # A file hard-linked into several entries (i.e. mirrored from an older version) takes its space once, and only
+        # frees it with its last entry
+        links = collections.Counter(inode for _, files, _ in entries for inode in files)
+        total = sum({inode: size for _, files, _ in entries for inode, size in files.items()}.values())
+
+        for name, files, _ in entries:
+            if total <= self.max_size_bytes:
+                break
+            entry_name = name[len(self.PENDING_PREFIX):] if name.startswith(self.PENDING_PREFIX) else name
+            if entry_name in self.held:
+                continue
+
+            with open(os.path.join(self.root, f".{entry_name}.lock"), "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Another process is using or downloading this entry right now
+                    continue
+
+                freed = sum(size for inode, size in files.items() if links[inode] == 1)
+                logging.info(f"Evicting {name} ({freed / 1024 ** 2:.1f} MB) from the dataset cache")
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+                links.subtract(files.keys())
+                total -= freed
+
+    def _download(self, name: str, download: Callable[[str], None], resumable: bool):
+        entry = os.path.join(self.root, name)
+        tmp = os.path.join(self.root, f"{self.PENDING_PREFIX}{name}")
+
+        if not resumable:
+            shutil.rmtree(tmp, ignore_errors=True)
+        shutil.rmtree(entry, ignore_errors=True)
+        os.makedirs(tmp, exist_ok=True)
+
+        try:
+            download(tmp)
+            with open(os.path.join(tmp, self.SIZE_FILE), "w") as f:
+                json.dump([[*inode, size] for inode, size in self._files(tmp).items()], f)
+            with open(os.path.join(tmp, self.COMPLETE_MARKER), "w"):
+                pass
+            os.rename(tmp, entry)
+        except BaseException:
+            if not resumable:
+                shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    def _entries(self) -> List[Tuple[str, Dict[Tuple[int, int], int], float]]:
+        """
+        Returns (name, {(device, inode): size in bytes} of its files, last access time) for every complete entry and
+        every temporary directory of a download, least recently used first. The temporary directories of crashed
+        downloads are only removed by eviction, which skips the ones of downloads in progress. Only the temporary
+        directories, and the entries committed without a size file, are walked.
+        """
+        entries = []
+
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            marker = os.path.join(path, self.COMPLETE_MARKER)
+            if name.startswith(self.PENDING_PREFIX) and os.path.isdir(path):
+                last_access = os.path.getmtime(path)
+            elif not name.startswith(".") and os.path.exists(marker):
+                last_access = os.path.getmtime(marker)
+            else:
+                continue
+
+            try:
+                with open(os.path.join(path, self.SIZE_FILE)) as f:
+                    files = {(device, inode): size for device, inode, size in json.load(f)}
+            except FileNotFoundError:
+                files = self._files(path)
+
+            entries.append((name, files, last_access))
+
+        return sorted(entries, key=lambda entry: entry[2])
+
+    @staticmethod
+    def _files(path: str) -> Dict[Tuple[int, int], int]:
+        files = {}
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                stat = os.lstat(os.path.join(dirpath, filename))
+                files[(stat.st_dev, stat.st_ino)] = stat.st_size
+        return files
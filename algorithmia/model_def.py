@@ -10,6 +10,7 @@ Useful References:
 Based on: https://pytorch.org/tutorials/intermediate/torchvision_tutorial.html
 """
 import copy
+import os
 from typing import Any, Dict, Sequence, Union
 
 import torch
@@ -23,7 +24,8 @@ import numpy as np
 import determined as det
 from determined.pytorch import DataLoader, LRScheduler, PyTorchTrial
 
-from predict import download_data, get_transform, collate_fn, PennFudanDataset
+from data import download_data, get_transform, collate_fn, PennFudanDataset
+from dataset_cache import DatasetCache
 
 TorchData = Union[Dict[str, torch.Tensor], Sequence[torch.Tensor], torch.Tensor]
 
@@ -33,14 +35,11 @@ class ObjectDetectionModel(PyTorchTrial):
         self.context = context
         self.current_step = context.env.first_step()
 
-        # Create a unique download directory for each rank so they don't
-        # overwrite each other.
-        self.download_directory = f"/tmp/data-rank{self.context.distributed.get_rank()}"
-        download_data(
-            download_directory=self.download_directory, data_config=self.context.get_data_config(),
-        )
+        # Downloaded once per node, and shared by its ranks and trials
+        self.dataset_cache = DatasetCache.from_data_config(self.context.get_data_config())
+        data_dir = download_data(self.dataset_cache, self.context.get_data_config())
 
-        dataset = PennFudanDataset(self.download_directory + "/PennFudanPed", get_transform())
+        dataset = PennFudanDataset(os.path.join(data_dir, "PennFudanPed"), get_transform())
 
         # Split 80/20 into training and validation datasets.
         train_size = int(0.8 * len(dataset))
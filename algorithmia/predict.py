@@ -1,14 +1,10 @@
 import torch
 import os
-import shutil
 import numpy as np
 import torch
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 
-from typing import Any, Dict
-from urllib.parse import urlparse
-from urllib.request import urlretrieve
 from torchvision.transforms import Compose, ToTensor
 
 from PIL import Image
@@ -46,17 +42,6 @@ def predict(model, file, threshold=0.9, inference="algorithmia"):
         print("No objects detected!")
         
         
-def download_data(download_directory: str, data_config: Dict[str, Any]) -> str:
-    if not os.path.exists(download_directory):
-        os.makedirs(download_directory, exist_ok=True)
-    url = data_config["url"]
-    filename = os.path.basename(urlparse(url).path)
-    filepath = os.path.join(download_directory, filename)
-    if not os.path.exists(filepath):
-        urlretrieve(url, filename=filepath)
-        shutil.unpack_archive(filepath, download_directory)
-
-
 def collate_fn(batch):
     return tuple(zip(*batch))
 
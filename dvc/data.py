@@ -9,32 +9,34 @@ from skimage import io
 from torchvision import transforms
 from torch.utils.data import Dataset, DataLoader
 
+from loading import decode
+from shards import fingerprint, pack_shards
 
-def get_test_transforms():
+
+def get_test_transforms(loading):
     return transforms.Compose([
-        transforms.Resize(240),
+        loading.resize(240),
         transforms.CenterCrop(224),
-        transforms.ToTensor(),
+        loading.to_tensor(),
         transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
     ])
 
 class CatDogDataset(Dataset):
 
-    def __init__(self, root_dir, train, transform=None):
+    def __init__(self, root_dir, train, transform=None, decoder="pil"):
         """
         Args:
             csv_file (string): Path to the csv file with annotations.
             root_dir (string): Directory with all the images.
             transform (callable, optional): Optional transform to be applied
                 on a sample.
+            decoder (string): "pil", or "torchvision" to decode into tensors
+                (see loading.py).
         """
-        if train:
-            file_dir = 'train'
-        else:
-            file_dir = 'eval'
-        self.file_path = os.path.join(root_dir, file_dir)
+        self.file_path = split_dir(root_dir, train)
         self.files = [f for f in os.listdir(self.file_path) if f.endswith('.jpg')]
         self.transform = transform
+        self.decoder = decoder
 
     def __len__(self):
         return len(self.files)
@@ -44,10 +46,36 @@ class CatDogDataset(Dataset):
             idx = idx.tolist()
 
         img_name = self.files[idx]
-        image = io.imread(os.path.join(self.file_path, img_name))
-        image = Image.fromarray(image)
+        if self.decoder == "pil":
+            image = io.imread(os.path.join(self.file_path, img_name))
+            image = Image.fromarray(image)
+        else:
+            with open(os.path.join(self.file_path, img_name), 'rb') as img_file:
+                image = decode(img_file.read(), self.decoder)
         if self.transform:
             image = self.transform(image)
-        label = 0 if img_name.startswith('dog') else 1
-        sample = (image, label)
+        sample = (image, image_label(img_name))
         return sample
+
+
+def split_dir(root_dir, train):
+    return os.path.join(root_dir, 'train' if train else 'eval')
+
+
+def image_label(img_name):
+    return 0 if img_name.startswith('dog') else 1
+
+
+def pack_split(root_dir, train, cache, encoding):
+    """
+    Packs the images of the train or eval split into shards (see shards.py) once, in the dataset cache, and returns
+    their directory.
+    """
+    file_path = split_dir(root_dir, train)
+    files = sorted(f for f in os.listdir(file_path) if f.endswith('.jpg'))
+    paths = [os.path.join(file_path, f) for f in files]
+
+    key = ('shards', encoding, fingerprint(paths))
+    pack = lambda path: pack_shards([(p, image_label(f)) for p, f in zip(paths, files)], path, encoding)
+    root, _ = cache.fetch(key, pack)
+    return root
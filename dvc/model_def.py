@@ -10,7 +10,10 @@ from torchvision import models, transforms
 from tqdm import tqdm
 
 
-from data import CatDogDataset, get_test_transforms
+from data import CatDogDataset, get_test_transforms, pack_split
+from dataset_cache import DatasetCache
+from loading import LoadingConfig, StepTimer
+from shards import ShardDataset, ShardShuffleSampler
 TorchData = Union[Dict[str, torch.Tensor], Sequence[torch.Tensor], torch.Tensor]
 
 
@@ -18,7 +21,13 @@ class CatDogModel(PyTorchTrial):
     def __init__(self, context):
         self.context = context
         self.data_dir = "images/"
-        self.test_transform = get_test_transforms()
+        # Workers, pinned memory, prefetching and JPEG decoder of the data loaders (see loading.py)
+        self.loading = LoadingConfig(self.context.get_data_config())
+        self.step_timer = StepTimer()
+        self.test_transform = get_test_transforms(self.loading)
+        # Pack the images into shards ("jpeg" or "raw", see shards.py) instead of reading one file per sample
+        self.shards = self.context.get_data_config().get("shards")
+        self.dataset_cache = DatasetCache.from_data_config(self.context.get_data_config())
 
     def build_model(self) -> nn.Module:
         model = models.resnet50(pretrained=True)
@@ -35,18 +44,23 @@ class CatDogModel(PyTorchTrial):
     def train_batch(
         self, batch: TorchData, model: nn.Module, epoch_idx: int, batch_idx: int
     ) -> Dict[str, torch.Tensor]:
+        self.step_timer.begin(epoch_idx)
         batch = cast(Tuple[torch.Tensor, torch.Tensor], batch)
         data, labels = batch
 
         output = model(data)
         loss = torch.nn.functional.cross_entropy(output, labels)
-        return {"loss": loss}
+        # With this trial API, the backward pass and the optimizer step run after train_batch returns: they are
+        # counted in the data wait of the next step, which is an upper bound here
+        return {"loss": loss, **self.step_timer.end()}
 
     def evaluate_batch(self, batch: TorchData, model: nn.Module) -> Dict[str, Any]:
         """
         Calculate validation metrics for a batch and return them as a dictionary.
         This method is not necessary if the user overwrites evaluate_full_dataset().
         """
+        # Validation runs between training steps: its time is not data wait
+        self.step_timer.reset()
         batch = cast(Tuple[torch.Tensor, torch.Tensor], batch)
         data, labels = batch
 
@@ -57,23 +71,33 @@ class CatDogModel(PyTorchTrial):
 
     def build_train_dataset(self):
         transform = transforms.Compose([
-            transforms.Resize(240),
+            self.loading.resize(240),
             transforms.RandomCrop(224),
             transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
+            self.loading.to_tensor(),
             transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
         ])
-        ds = CatDogDataset(self.data_dir, train=True, transform=transform)
+        if self.shards:
+            return ShardDataset(pack_split(self.data_dir, True, self.dataset_cache, self.shards), transform,
+                                decoder=self.loading.decoder)
+        ds = CatDogDataset(self.data_dir, train=True, transform=transform, decoder=self.loading.decoder)
         return ds
 
     def build_test_dataset(self):
-        ds = CatDogDataset(self.data_dir, train=False, transform=self.test_transform)
+        if self.shards:
+            return ShardDataset(pack_split(self.data_dir, False, self.dataset_cache, self.shards), self.test_transform,
+                                decoder=self.loading.decoder)
+        ds = CatDogDataset(self.data_dir, train=False, transform=self.test_transform, decoder=self.loading.decoder)
         return ds
 
     def build_training_data_loader(self) -> Any:
         ds = self.build_train_dataset()
-        return DataLoader(ds, batch_size=self.context.get_per_slot_batch_size())
+        if isinstance(ds, ShardDataset):
+            sampler = ShardShuffleSampler(ds, seed=self.context.get_trial_seed())
+            return DataLoader(ds, batch_size=self.context.get_per_slot_batch_size(), sampler=sampler,
+                              **self.loading.loader_kwargs())
+        return DataLoader(ds, batch_size=self.context.get_per_slot_batch_size(), **self.loading.loader_kwargs())
 
     def build_validation_data_loader(self) -> Any:
         ds = self.build_test_dataset()
-        return DataLoader(ds, batch_size=self.context.get_per_slot_batch_size())
+        return DataLoader(ds, batch_size=self.context.get_per_slot_batch_size(), **self.loading.loader_kwargs())
@@ -8,6 +8,8 @@ import requests
 
 from torchvision import datasets, transforms
 
+from dataset_cache import DatasetCache
+
 
 def get_dataset(data_dir: str, train: bool) -> Any:
     return datasets.MNIST(
@@ -25,38 +27,46 @@ def get_dataset(data_dir: str, train: bool) -> Any:
     )
 
 
-def download_dataset(download_directory: str, data_config: Dict[str, Any]) -> str:
+def download_dataset(cache: DatasetCache, data_config: Dict[str, Any]) -> str:
+    """
+    Downloads and unpacks the MNIST archive into the dataset cache, unless it is already there, and returns the
+    directory containing the MNIST folder.
+    """
     local_path = data_config.get("local_path")
     if local_path:
+        stat = os.stat(local_path)
+        key = ("file", local_path, stat.st_size, stat.st_mtime_ns)
         basename = local_path.rsplit("/", 1)[1]
-        download_directory = os.path.join(download_directory, "MNIST")
-        os.makedirs(download_directory, exist_ok=True)
-        filepath = os.path.join(download_directory, basename)
-        if not os.path.exists(filepath):
+
+        def download(path: str) -> None:
+            download_directory = os.path.join(path, "MNIST")
+            os.makedirs(download_directory, exist_ok=True)
+            filepath = os.path.join(download_directory, basename)
             logging.info("Downloading {} to {}".format(local_path, filepath))
 
             shutil.copyfile(local_path, filepath)
+            shutil.unpack_archive(filepath, download_directory)
 
-        shutil.unpack_archive(filepath, download_directory)
-
-        return os.path.dirname(download_directory)
-
-    url = data_config["url"]
-    url_path = urllib.parse.urlparse(url).path
-    basename = url_path.rsplit("/", 1)[1]
-
-    download_directory = os.path.join(download_directory, "MNIST")
-    os.makedirs(download_directory, exist_ok=True)
-    filepath = os.path.join(download_directory, basename)
-    if not os.path.exists(filepath):
-        logging.info("Downloading {} to {}".format(url, filepath))
+    else:
+        url = data_config["url"]
+        etag = requests.head(url, allow_redirects=True).headers.get("ETag", "")
+        key = ("url", url, etag)
+        url_path = urllib.parse.urlparse(url).path
+        basename = url_path.rsplit("/", 1)[1]
 
-        r = requests.get(url, stream=True)
-        with open(filepath, "wb") as f:
-            for chunk in r.iter_content(chunk_size=8192):
-                if chunk:
-                    f.write(chunk)
+        def download(path: str) -> None:
+            download_directory = os.path.join(path, "MNIST")
+            os.makedirs(download_directory, exist_ok=True)
+            filepath = os.path.join(download_directory, basename)
+            logging.info("Downloading {} to {}".format(url, filepath))
 
-    shutil.unpack_archive(filepath, download_directory)
+            r = requests.get(url, stream=True)
+            r.raise_for_status()
+            with open(filepath, "wb") as f:
+                for chunk in r.iter_content(chunk_size=8192):
+                    if chunk:
+                        f.write(chunk)
+            shutil.unpack_archive(filepath, download_directory)
 
-    return os.path.dirname(download_directory)
+    root, _ = cache.fetch(key, download)
+    return root
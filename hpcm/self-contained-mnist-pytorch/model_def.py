@@ -19,6 +19,7 @@ from layers import Flatten
 from determined.pytorch import DataLoader, PyTorchTrial, PyTorchTrialContext
 
 import data
+from dataset_cache import DatasetCache
 
 TorchData = Union[Dict[str, torch.Tensor], Sequence[torch.Tensor], torch.Tensor]
 
@@ -27,9 +28,10 @@ class MNistTrial(PyTorchTrial):
     def __init__(self, context: PyTorchTrialContext) -> None:
         self.context = context
 
-        # Create a unique download directory for each rank so they don't overwrite each
-        # other when doing distributed training.
-        self.download_directory = f"/tmp/data-rank{self.context.distributed.get_rank()}"
+        # The dataset is downloaded once per node, by the first rank to get there, and shared
+        # with the other ranks and trials through the dataset cache.
+        self.dataset_cache = DatasetCache.from_data_config(self.context.get_data_config())
+        self.download_directory = None
         self.data_downloaded = False
 
         self.model = self.context.wrap_model(nn.Sequential(
@@ -56,7 +58,7 @@ class MNistTrial(PyTorchTrial):
     def build_training_data_loader(self) -> DataLoader:
         if not self.data_downloaded:
             self.download_directory = data.download_dataset(
-                download_directory=self.download_directory,
+                cache=self.dataset_cache,
                 data_config=self.context.get_data_config(),
             )
             self.data_downloaded = True
@@ -67,7 +69,7 @@ class MNistTrial(PyTorchTrial):
     def build_validation_data_loader(self) -> DataLoader:
         if not self.data_downloaded:
             self.download_directory = data.download_dataset(
-                download_directory=self.download_directory,
+                cache=self.dataset_cache,
                 data_config=self.context.get_data_config(),
             )
             self.data_downloaded = True
@@ -0,0 +1,147 @@
+"""
+Examples per second of the chunked SQuAD conversion of data.py against the worker count, and the time until its first
+chunk can be streamed, compared to squad_convert_examples_to_features on a single process. The features are checked
+against the ones of squad_convert_examples_to_features, and so are the ones that two ranks stream from a conversion
+in progress.
+"""
+import argparse
+import concurrent.futures
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+import torch
+from transformers import squad_convert_examples_to_features
+from transformers.data.processors.squad import SquadExample, SquadV2Processor
+
+import constants
+from data import TRAIN_ARRAYS, FeatureStream, LazyFeatures, MappedFeatureDataset, convert_examples, read_manifest
+from dataset_cache import DatasetCache
+
+
+def synthetic_examples(count, context_words=150, seed=0):
+    """SQuAD 2.0-like training examples: a third without answer, several questions per context."""
+    rng = np.random.default_rng(seed)
+    words = ["the", "of", "river", "city", "empire", "king", "was", "built", "in", "century", "north", "trade",
+             "population", "university", "founded", "church", "war", "army", "coast", "mountain", "language"]
+    examples = []
+    for i in range(count):
+        if i % 5 == 0:
+            picks = zip(rng.integers(len(words), size=context_words), rng.integers(100, size=context_words))
+            tokens = [f"{words[w]}{n}" if w % 4 == 0 else words[w] for w, n in picks]
+            context = " ".join(tokens)
+        start = int(rng.integers(len(tokens) - 3))
+        answer = " ".join(tokens[start:start + 3])
+        impossible = i % 3 == 0
+        examples.append(SquadExample(
+            qas_id=str(i),
+            question_text=f"what {tokens[start + 1]} {tokens[int(rng.integers(len(tokens)))]} in {tokens[start]}?",
+            context_text=context,
+            answer_text=None if impossible else answer,
+            start_position_character=None if impossible else len(" ".join(tokens[:start])) + (start > 0),
+            title="Synthetic",
+            is_impossible=impossible,
+            answers=[],
+        ))
+    return examples
+
+
+def check_features(path, features, dataset, names):
+    converted = MappedFeatureDataset(path, names)
+    assert len(converted) == len(dataset), f"{len(converted)} features instead of {len(dataset)}"
+    for i in range(len(dataset)):
+        assert all(torch.equal(x, y) for x, y in zip(converted[i], dataset[i])), f"Feature {i} differs"
+    assert [(f.unique_id, f.example_index, f.tokens) for f in LazyFeatures(path)] == \
+           [(f.unique_id, f.example_index, f.tokens) for f in features], "Feature indexes differ"
+
+
+def check_stream(work_dir, examples, tokenizer, settings, dataset, workers, chunk_size, num_replicas=2):
+    """
+    Streams a conversion into a dataset cache from `num_replicas` ranks, the way load_and_cache_examples does: the
+    readers start before the conversion, and only the chief's stream knows of it.
+    """
+    cache = DatasetCache(os.path.join(work_dir, "cache"))
+    key = ("benchmark", len(examples), workers, chunk_size)
+    convert = lambda path: convert_examples(path, examples, tokenizer, *settings, True, workers=workers,
+                                            chunk_size=chunk_size)
+    conversion = concurrent.futures.ThreadPoolExecutor(max_workers=1).submit(cache.fetch, key, convert)
+    streams = [FeatureStream(cache.entry_path(key), cache.pending_path(key), TRAIN_ARRAYS, rank, num_replicas,
+                             conversion if rank == 0 else None, poll_seconds=0.01) for rank in range(num_replicas)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=num_replicas) as readers:
+        streamed = list(readers.map(list, streams))
+    conversion.result()
+
+    assert len({len(features) for features in streamed}) == 1, "The ranks streamed different numbers of features"
+    for rank, features in enumerate(streamed):
+        assert len(features) == len(streams[rank]) == len(dataset) // num_replicas, f"Length of rank {rank}"
+        for i, feature in enumerate(features):
+            assert all(torch.equal(x, y) for x, y in zip(feature, dataset[rank + i * num_replicas])), \
+                f"Feature {i} of rank {rank} differs"
+
+    # A rank whose node has no process converting fails instead of waiting forever
+    orphan = FeatureStream(os.path.join(work_dir, "missing"), os.path.join(work_dir, ".tmp-missing"), TRAIN_ARRAYS,
+                           poll_seconds=0.01, timeout_seconds=0.1)
+    try:
+        next(iter(orphan))
+        raise AssertionError("A stream without conversion did not time out")
+    except TimeoutError:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chunked, multi-process SQuAD feature conversion")
+    parser.add_argument("--model-type", default="albert", choices=sorted(constants.MODEL_CLASSES))
+    parser.add_argument("--model", default="albert-base-v2", help="Pretrained model name or tokenizer directory")
+    parser.add_argument("--squad-file", help="SQuAD 2.0 training file, synthetic examples if not given")
+    parser.add_argument("--examples", type=int, default=2000, help="Number of examples converted")
+    parser.add_argument("--workers", default="1,2,4,8", help="Comma-separated worker counts")
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--max-seq-length", type=int, default=384)
+    parser.add_argument("--doc-stride", type=int, default=128)
+    parser.add_argument("--max-query-length", type=int, default=64)
+    args = parser.parse_args()
+
+    tokenizer = constants.MODEL_CLASSES[args.model_type][1].from_pretrained(args.model, do_lower_case=True)
+    if args.squad_file:
+        examples = SquadV2Processor().get_train_examples(os.path.dirname(args.squad_file),
+                                                         os.path.basename(args.squad_file))[:args.examples]
+    else:
+        examples = synthetic_examples(args.examples)
+    settings = (args.max_seq_length, args.doc_stride, args.max_query_length)
+    print(f"{len(examples)} examples, {os.cpu_count()} CPUs")
+
+    start = time.perf_counter()
+    features, dataset = squad_convert_examples_to_features(examples, tokenizer, *settings, is_training=True,
+                                                           return_dataset="pt", threads=1, tqdm_enabled=False)
+    elapsed = time.perf_counter() - start
+    print(f">>> {'squad_convert_examples_to_features':<36} {len(examples) / elapsed:7.1f} examples/s, "
+          f"first batch after {elapsed:6.2f} s")
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        for workers in [int(w) for w in args.workers.split(",")]:
+            path = os.path.join(work_dir, f"workers-{workers}")
+            os.makedirs(path)
+            start = time.perf_counter()
+            conversion = threading.Thread(target=convert_examples, args=(path, examples, tokenizer, *settings, True),
+                                          kwargs={"workers": workers, "chunk_size": args.chunk_size})
+            conversion.start()
+            while conversion.is_alive() and not read_manifest(path)[0]:
+                time.sleep(0.01)
+            first_chunk = time.perf_counter() - start
+            conversion.join()
+            elapsed = time.perf_counter() - start
+
+            check_features(path, features, dataset, TRAIN_ARRAYS)
+            print(f">>> {f'convert_examples, {workers} workers':<36} {len(examples) / elapsed:7.1f} examples/s, "
+                  f"first chunk after {first_chunk:6.2f} s")
+        print("Converted features match squad_convert_examples_to_features")
+
+        workers = int(args.workers.split(",")[0])
+        check_stream(work_dir, examples, tokenizer, settings, dataset, workers, args.chunk_size)
+        print(f"Features streamed by 2 ranks during the conversion match ({workers} workers)")
+    finally:
+        shutil.rmtree(work_dir)
@@ -0,0 +1,97 @@
+"""
+Wall time of the evaluation of AlbertSQuADPyTorch on a synthetic dev set, with the logits gathered into arrays and
+post-processed by postprocess.py, compared to the previous path: a SquadResult per feature built from per-row
+tensor copies, post-processed by compute_predictions_logits. The model has random weights, which makes no difference
+to the time spent outside of the forward passes. The predictions are checked against the ones of the previous path.
+"""
+import argparse
+import time
+
+import torch
+from torch.utils.data import DataLoader
+from transformers import squad_convert_examples_to_features
+from transformers.data.metrics.squad_metrics import compute_predictions_logits
+from transformers.data.processors.squad import SquadResult
+
+import constants
+from benchmark_conversion import synthetic_examples
+from postprocess import LogitsBuffer, compute_predictions
+
+
+def previous_results(model, data_loader, features):
+    all_results = []
+    # Without gradients either way, as Determined evaluates without them
+    with torch.no_grad():
+        for batch in data_loader:
+            outputs = model(input_ids=batch[0], attention_mask=batch[1], token_type_ids=batch[2])
+            for i, feature_index in enumerate(batch[3]):
+                unique_id = int(features[feature_index.item()].unique_id)
+                start_logits, end_logits = [output[i].detach().cpu().tolist() for output in outputs]
+                all_results.append(SquadResult(unique_id, start_logits, end_logits))
+    return all_results
+
+
+def gathered_logits(model, data_loader, num_features, seq_length):
+    logits = LogitsBuffer(num_features, seq_length)
+    with torch.no_grad():
+        for batch in data_loader:
+            start_logits, end_logits = model(input_ids=batch[0], attention_mask=batch[1], token_type_ids=batch[2])
+            logits.add(batch[3], start_logits, end_logits)
+    return logits
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluation with gathered logits against the per-feature results")
+    parser.add_argument("--model-type", default="albert", choices=sorted(constants.MODEL_CLASSES))
+    parser.add_argument("--model", default="albert-base-v2", help="Pretrained model name or tokenizer directory")
+    parser.add_argument("--examples", type=int, default=2000, help="Number of synthetic dev examples")
+    parser.add_argument("--layers", type=int, default=2, help="Layers of the randomly initialized model")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--n-best-size", type=int, default=20)
+    parser.add_argument("--top-k", default="5,10", help="Comma-separated candidate counts of the pre-filter")
+    parser.add_argument("--max-seq-length", type=int, default=384)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    config_class, tokenizer_class, model_class = constants.MODEL_CLASSES[args.model_type]
+    tokenizer = tokenizer_class.from_pretrained(args.model, do_lower_case=True)
+    config = config_class(vocab_size=tokenizer.vocab_size, hidden_size=256, intermediate_size=1024,
+                          num_attention_heads=4, num_hidden_layers=args.layers, return_dict=False)
+    model = model_class(config).eval()
+
+    examples = synthetic_examples(args.examples)
+    features, dataset = squad_convert_examples_to_features(examples, tokenizer, args.max_seq_length, 128, 64,
+                                                           is_training=False, return_dataset="pt", threads=1,
+                                                           tqdm_enabled=False)
+    data_loader = DataLoader(dataset, batch_size=args.batch_size)
+    settings = dict(n_best_size=args.n_best_size, max_answer_length=30, do_lower_case=True,
+                    output_prediction_file=None, output_nbest_file=None, output_null_log_odds_file=None,
+                    verbose_logging=False, version_2_with_negative=True, null_score_diff_threshold=0.0,
+                    tokenizer=tokenizer)
+    print(f"{len(examples)} examples, {len(features)} features")
+
+    all_results, forward_time = timed(lambda: previous_results(model, data_loader, features))
+    expected, post_time = timed(lambda: compute_predictions_logits(examples, features, all_results, **settings))
+    print(f">>> {'SquadResult per feature':<32} forward + results {forward_time:6.2f} s, "
+          f"post-processing {post_time:6.2f} s, total {forward_time + post_time:6.2f} s")
+
+    logits, forward_time = timed(lambda: gathered_logits(model, data_loader, len(features), args.max_seq_length))
+    predictions, post_time = timed(lambda: compute_predictions(
+        examples, features, logits.start_logits, logits.end_logits, workers=1, **settings))
+    assert predictions == expected, "Predictions differ"
+    print(f">>> {'gathered logits':<32} forward + gather  {forward_time:6.2f} s, "
+          f"post-processing {post_time:6.2f} s, total {forward_time + post_time:6.2f} s")
+    print("Predictions match compute_predictions_logits")
+
+    for top_k in [int(k) for k in args.top_k.split(",")]:
+        predictions, post_time = timed(lambda: compute_predictions(
+            examples, features, logits.start_logits, logits.end_logits, top_k=top_k, workers=1, **settings))
+        changed = sum(predictions[qas_id] != text for qas_id, text in expected.items())
+        print(f">>> {f'gathered logits, top {top_k}':<32} post-processing {post_time:6.2f} s, "
+              f"{changed} of {len(expected)} predictions changed")
@@ -0,0 +1,105 @@
+"""
+Wall time of the post-processing of postprocess.py against the worker count, compared to compute_predictions_logits of
+transformers, on the features of synthetic dev examples with random logits. Half of the logits are rounded, so that
+the best indexes have ties. The predictions and the files written are checked against the ones of
+compute_predictions_logits.
+"""
+import argparse
+import filecmp
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+from transformers import squad_convert_examples_to_features
+from transformers.data.metrics.squad_metrics import _get_best_indexes, compute_predictions_logits
+from transformers.data.processors.squad import SquadResult
+
+import constants
+from benchmark_conversion import synthetic_examples
+from postprocess import best_indexes, compute_predictions
+
+OUTPUT_FILES = ("predictions.json", "nbest_predictions.json", "null_odds.json")
+
+
+def random_logits(rng, num_features, seq_length):
+    logits = rng.normal(0, 3, size=(num_features, seq_length)).astype(np.float32)
+    logits[::2] = np.round(logits[::2])
+    return logits
+
+
+def output_files(directory):
+    paths = [os.path.join(directory, name) if directory else None for name in OUTPUT_FILES]
+    return dict(zip(["output_prediction_file", "output_nbest_file", "output_null_log_odds_file"], paths))
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Parallel SQuAD post-processing against compute_predictions_logits")
+    parser.add_argument("--model-type", default="albert", choices=sorted(constants.MODEL_CLASSES))
+    parser.add_argument("--model", default="albert-base-v2", help="Pretrained model name or tokenizer directory")
+    parser.add_argument("--examples", type=int, default=2000, help="Number of synthetic dev examples")
+    parser.add_argument("--workers", default="1,2,4,8", help="Comma-separated worker counts")
+    parser.add_argument("--n-best-size", type=int, default=20)
+    parser.add_argument("--max-seq-length", type=int, default=384)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    tokenizer = constants.MODEL_CLASSES[args.model_type][1].from_pretrained(args.model, do_lower_case=True)
+    examples = synthetic_examples(args.examples)
+    features, _ = squad_convert_examples_to_features(examples, tokenizer, args.max_seq_length, 128, 64,
+                                                     is_training=False, return_dataset="pt", threads=1,
+                                                     tqdm_enabled=False)
+    start_logits = random_logits(rng, len(features), args.max_seq_length)
+    end_logits = random_logits(rng, len(features), args.max_seq_length)
+    results = [SquadResult(feature.unique_id, start.tolist(), end.tolist())
+               for feature, start, end in zip(features, start_logits, end_logits)]
+    print(f"{len(examples)} examples, {len(features)} features, {os.cpu_count()} CPUs")
+
+    for n in [1, 5, args.n_best_size, args.max_seq_length]:
+        expected = [_get_best_indexes(logits, n) for logits in start_logits.tolist()]
+        assert best_indexes(start_logits, n).tolist() == expected, f"Best {n} indexes differ"
+    print("best_indexes matches _get_best_indexes")
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        for version_2_with_negative in [False, True]:
+            settings = dict(n_best_size=args.n_best_size, max_answer_length=30, do_lower_case=True,
+                            verbose_logging=False, version_2_with_negative=version_2_with_negative,
+                            null_score_diff_threshold=0.0, tokenizer=tokenizer)
+            label = "SQuAD 2.0" if version_2_with_negative else "SQuAD 1.1"
+
+            reference_dir = os.path.join(work_dir, f"reference-{version_2_with_negative}")
+            os.makedirs(reference_dir)
+            expected, reference_time = timed(lambda: compute_predictions_logits(
+                examples, features, results, **output_files(reference_dir), **settings))
+            print(f">>> {label}, {'compute_predictions_logits':<28} {reference_time:6.2f} s")
+
+            for workers in [int(w) for w in args.workers.split(",")]:
+                output_dir = os.path.join(work_dir, f"{version_2_with_negative}-{workers}")
+                os.makedirs(output_dir)
+                predictions, elapsed = timed(lambda: compute_predictions(
+                    examples, features, start_logits, end_logits, **output_files(output_dir), workers=workers,
+                    **settings))
+                assert predictions == expected, f"Predictions of {workers} workers differ"
+                for name in OUTPUT_FILES:
+                    if os.path.exists(os.path.join(reference_dir, name)):
+                        assert filecmp.cmp(os.path.join(reference_dir, name), os.path.join(output_dir, name),
+                                           shallow=False), f"{name} of {workers} workers differs"
+                print(f">>> {label}, {f'{workers} workers':<28} {elapsed:6.2f} s "
+                      f"({reference_time / elapsed:.1f}x)")
+
+            predictions, elapsed = timed(lambda: compute_predictions(
+                examples, features, start_logits, end_logits, **output_files(None), workers=workers, **settings))
+            assert predictions == expected
+            print(f">>> {label}, {f'{workers} workers, no files':<28} {elapsed:6.2f} s "
+                  f"({reference_time / elapsed:.1f}x)")
+        print("Predictions and files match compute_predictions_logits")
+    finally:
+        shutil.rmtree(work_dir)
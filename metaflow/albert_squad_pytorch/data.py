@@ -1,15 +1,50 @@
-from transformers.data.processors.squad import SquadV1Processor, SquadV2Processor, SquadFeatures
-from transformers import squad_convert_examples_to_features
+from transformers.data.processors.squad import (
+    SquadV1Processor,
+    SquadV2Processor,
+    SquadFeatures,
+    squad_convert_example_to_features,
+    squad_convert_example_to_features_init,
+)
+import collections.abc
+import concurrent.futures
+import json
+import multiprocessing
 import urllib.request
 import os
+import pickle
+import shutil
+import sys
+import time
+import numpy as np
 import torch
 
 from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 
+from dataset_cache import DEFAULT_SIZE_GB, DatasetCache
 
-def data_directory(using_bind_mount: bool, rank: int, bind_mount_path: Path = None):
-    base_dir = bind_mount_path if using_bind_mount else Path("/tmp")
-    return base_dir / f"data-rank{rank}"
+# Tensors of the datasets returned by squad_convert_examples_to_features, in order
+TRAIN_ARRAYS = ("input_ids", "attention_mask", "token_type_ids", "start_positions", "end_positions", "cls_index",
+                "p_mask", "is_impossible")
+EVAL_ARRAYS = ("input_ids", "attention_mask", "token_type_ids", "feature_index", "cls_index", "p_mask")
+# (feature attribute, dtype) of every tensor, as squad_convert_examples_to_features builds them
+FEATURE_ARRAYS = {
+    "input_ids": ("input_ids", np.int64),
+    "attention_mask": ("attention_mask", np.int64),
+    "token_type_ids": ("token_type_ids", np.int64),
+    "start_positions": ("start_position", np.int64),
+    "end_positions": ("end_position", np.int64),
+    "cls_index": ("cls_index", np.int64),
+    "p_mask": ("p_mask", np.float32),
+    "is_impossible": ("is_impossible", np.float32),
+}
+SEQUENCE_ARRAYS = ("input_ids", "attention_mask", "token_type_ids", "p_mask")
+FIRST_UNIQUE_ID = 1000000000
+CHUNK_SIZE = 512
+MANIFEST = "chunks.json"
+EXAMPLES_INDEX = "examples.pkl"
+FEATURES_INDEX = "features.pkl"
 
 
 def cache_dir(using_bind_mount: bool, rank: int, bind_mount_path: Path = None):
@@ -17,7 +52,362 @@ def cache_dir(using_bind_mount: bool, rank: int, bind_mount_path: Path = None):
     return base_dir / f"cache/{rank}"
 
 
-def load_and_cache_examples(data_dir: Path, tokenizer, task, max_seq_length, doc_stride, max_query_length, evaluate=False, model_name=None):
+def dataset_cache(using_bind_mount: bool, data_config: dict, bind_mount_path: Path = None):
+    # With a bind mount, the dataset is shared by every trial running on the agents that mount it
+    if using_bind_mount and "dataset_cache_dir" not in data_config:
+        return DatasetCache(str(bind_mount_path / "dataset-cache"), data_config.get("dataset_cache_gb", DEFAULT_SIZE_GB))
+    return DatasetCache.from_data_config(data_config)
+
+
+def download_file(cache: DatasetCache, url: str, filename: str) -> Path:
+    """
+    Downloads `url` as `filename` into the dataset cache, unless the same version (as told by its ETag) is already
+    there, and returns the directory containing it.
+    """
+    with urllib.request.urlopen(urllib.request.Request(url, method="HEAD")) as response:
+        etag = response.headers.get("ETag", "")
+
+    def download(path):
+        with urllib.request.urlopen(url) as response, open(os.path.join(path, filename), "wb") as f:
+            shutil.copyfileobj(response, f)
+
+    root, _ = cache.fetch(("url", url, etag), download)
+    return Path(root)
+
+
+def chunk_name(chunk: int) -> str:
+    return f"chunk-{chunk:05d}"
+
+
+def read_manifest(root: str) -> Tuple[List[dict], bool]:
+    """
+    Returns the chunks converted so far under `root`, with the offsets of their first feature and first indexed
+    example, and whether the conversion is complete. A conversion that has not started yet has no chunks.
+    """
+    try:
+        with open(os.path.join(root, MANIFEST)) as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return [], False
+
+    feature_offset = example_offset = 0
+    for chunk in manifest["chunks"]:
+        chunk["feature_offset"], chunk["example_offset"] = feature_offset, example_offset
+        feature_offset += chunk["features"]
+        example_offset += chunk["indexed_examples"]
+    return manifest["chunks"], manifest["complete"]
+
+
+def write_manifest(root: str, chunks: List[dict], complete: bool):
+    # Replaced atomically, as the readers of a streamed conversion poll it
+    tmp = os.path.join(root, f".{MANIFEST}")
+    with open(tmp, "w") as f:
+        json.dump({"chunks": chunks, "complete": complete}, f)
+    os.replace(tmp, os.path.join(root, MANIFEST))
+
+
+def load_chunk_arrays(root: str, chunk: dict, names: Sequence[str]) -> Dict[str, np.ndarray]:
+    # The feature indexes are not saved, as they are the position of the features in the dataset
+    path = os.path.join(root, chunk["name"])
+    return {
+        name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in names if name != "feature_index"
+    }
+
+
+def feature_tensors(arrays: Dict[str, np.ndarray], names: Sequence[str], row: int, idx: int):
+    return tuple(torch.tensor(idx) if name == "feature_index" else torch.from_numpy(np.array(arrays[name][row]))
+                 for name in names)
+
+
+class MappedFeatureDataset(Dataset):
+    """
+    The TensorDataset of squad_convert_examples_to_features, read from the chunks of arrays saved by convert_examples
+    through memory maps: the ranks of a node share the page cache instead of unpickling a copy of the dataset each.
+    """
+
+    def __init__(self, root: str, names: Sequence[str]):
+        self.names = names
+        chunks, _ = read_manifest(root)
+        self.chunks = [load_chunk_arrays(root, chunk, names) for chunk in chunks]
+        self.offsets = np.cumsum([0] + [chunk["features"] for chunk in chunks])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        chunk = int(np.searchsorted(self.offsets, idx, side="right")) - 1
+        return feature_tensors(self.chunks[chunk], self.names, idx - int(self.offsets[chunk]), idx)
+
+
+class FeatureStream(IterableDataset):
+    """
+    Reads the features of a conversion that is still running, in order, from the chunks that convert_examples has
+    finished so far: under `pending` during the conversion, and under `root` once it is complete. The features are
+    split between the `num_replicas` ranks of a distributed trial, and then between the DataLoader workers of each
+    rank. `conversion` is the future of the conversion when it runs in this process, to surface its errors.
+
+    Only one process per node converts, the others read concurrently without any lock: a chunk is listed in the
+    manifest once its files are written, the manifest is replaced atomically, and the last chunk is listed with the
+    completion of the conversion. The stream then drops the last few features, so that every rank and worker yields
+    as many of them, and its length is known. The cache entry is held by the converting process for as long as the
+    trial runs. A TimeoutError is raised when no chunk comes for `timeout_seconds`, e.g. when no process converts
+    into this node's cache.
+    """
+
+    def __init__(self, root: str, pending: str, names: Sequence[str], rank=0, num_replicas=1, conversion=None,
+                 poll_seconds=1.0, timeout_seconds=1800.0):
+        self.root = root
+        self.pending = pending
+        self.names = names
+        self.rank = rank
+        self.num_replicas = num_replicas
+        self.conversion = conversion
+        self.poll_seconds = poll_seconds
+        self.timeout_seconds = timeout_seconds
+
+    def __len__(self):
+        _, chunks, complete = self.manifest()
+        if not complete:
+            raise TypeError("The number of features is only known once the conversion is complete")
+        # With DataLoader workers, up to one feature fewer per worker
+        return sum(chunk["features"] for chunk in chunks) // self.num_replicas
+
+    def manifest(self) -> Tuple[str, List[dict], bool]:
+        """The directory of the conversion, its chunks so far and whether it is complete."""
+        complete_marker = os.path.join(self.root, DatasetCache.COMPLETE_MARKER)
+        if not os.path.exists(complete_marker):
+            chunks, complete = read_manifest(self.pending)
+            # Unless renamed to `root` in the meantime
+            if complete or not os.path.exists(complete_marker):
+                return self.pending, chunks, complete
+        return (self.root, *read_manifest(self.root))
+
+    def __iter__(self):
+        shard, num_shards = self.rank, self.num_replicas
+        worker = get_worker_info()
+        if worker is not None:
+            shard, num_shards = shard * worker.num_workers + worker.id, num_shards * worker.num_workers
+
+        next_chunk = 0
+        deadline = time.monotonic() + self.timeout_seconds
+        while True:
+            root, chunks, complete = self.manifest()
+
+            if next_chunk < len(chunks):
+                chunk = chunks[next_chunk]
+                try:
+                    arrays = load_chunk_arrays(root, chunk, self.names)
+                except FileNotFoundError:
+                    # Renamed from `pending` to `root` in the meantime
+                    continue
+                first = chunk["feature_offset"]
+                end = first + chunk["features"]
+                if complete:
+                    total = sum(listed["features"] for listed in chunks)
+                    end = min(end, total - total % num_shards)
+                for idx in range(first + (shard - first) % num_shards, end, num_shards):
+                    yield feature_tensors(arrays, self.names, idx - first, idx)
+                next_chunk += 1
+                deadline = time.monotonic() + self.timeout_seconds
+            elif complete:
+                return
+            else:
+                if self.conversion is not None and self.conversion.done():
+                    # Raises the error of a failed conversion instead of waiting for chunks that will never come
+                    self.conversion.result()
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"No features converted into {self.pending} in the last "
+                                       f"{self.timeout_seconds:.0f} s")
+                time.sleep(self.poll_seconds)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["conversion"] = None
+        return state
+
+
+class RepeatingLoader:
+    """
+    Iterates over `loader` again and again. Determined only calls iter() once on a training loader that it did not
+    build, i.e. the DataLoader of a FeatureStream, and expects it to go on for as many epochs as the trial runs.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __len__(self):
+        try:
+            return len(self.loader)
+        except TypeError:
+            # A conversion still running: the epoch never ends, as Determined>=0.19 does for loaders without a length
+            return sys.maxsize
+
+    def __iter__(self):
+        while True:
+            yield from self.loader
+
+
+class LazySequence(collections.abc.Sequence):
+    """
+    The lists pickled as `index` in the chunks under `root`, only unpickled when first accessed: training never reads
+    the examples and features.
+    """
+
+    def __init__(self, root: str, index: str):
+        self.root = root
+        self.index = index
+        self.items = None
+
+    def load(self) -> list:
+        if self.items is None:
+            chunks, _ = read_manifest(self.root)
+            self.items = []
+            for chunk in chunks:
+                with open(os.path.join(self.root, chunk["name"], self.index), "rb") as f:
+                    self.items += self.load_chunk(chunk, pickle.load(f))
+        return self.items
+
+    def load_chunk(self, chunk: dict, items: list) -> list:
+        return items
+
+    def __getitem__(self, idx):
+        return self.load()[idx]
+
+    def __len__(self):
+        return len(self.load())
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["items"] = None
+        return state
+
+
+class LazyFeatures(LazySequence):
+    """
+    The features of the chunks under `root`, numbered as squad_convert_examples_to_features numbers them: each chunk
+    is saved with the unique ids and example indexes that it would have if it were converted on its own.
+    """
+
+    def __init__(self, root: str):
+        super().__init__(root, FEATURES_INDEX)
+
+    def load_chunk(self, chunk: dict, items: list) -> list:
+        for feature in items:
+            feature.unique_id += chunk["feature_offset"]
+            feature.example_index += chunk["example_offset"]
+        return items
+
+
+def convert_chunk(task: tuple) -> dict:
+    """
+    Converts a chunk of examples in a worker process of convert_examples, and saves the arrays of the features, the
+    features without their token arrays (not needed by the post-processing) and the examples under `path`.
+    """
+    path, examples, max_seq_length, doc_stride, max_query_length, is_training = task
+    names = TRAIN_ARRAYS if is_training else EVAL_ARRAYS
+
+    # Numbered like squad_convert_examples_to_features does, from the start of the chunk
+    features = []
+    indexed_examples = 0
+    for example in examples:
+        example_features = squad_convert_example_to_features(
+            example, max_seq_length, doc_stride, max_query_length, "max_length", is_training
+        )
+        for feature in example_features:
+            feature.example_index = indexed_examples
+            feature.unique_id = FIRST_UNIQUE_ID + len(features)
+            features.append(feature)
+        if example_features:
+            indexed_examples += 1
+
+    os.makedirs(path, exist_ok=True)
+    for name in names:
+        if name == "feature_index":
+            continue
+        attribute, dtype = FEATURE_ARRAYS[name]
+        array = np.array([getattr(feature, attribute) for feature in features], dtype=dtype)
+        if name in SEQUENCE_ARRAYS:
+            array = array.reshape(len(features), max_seq_length)
+        np.save(os.path.join(path, f"{name}.npy"), array)
+
+    for feature in features:
+        feature.input_ids = feature.attention_mask = feature.token_type_ids = feature.p_mask = None
+    with open(os.path.join(path, FEATURES_INDEX), "wb") as f:
+        pickle.dump(features, f, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(os.path.join(path, EXAMPLES_INDEX), "wb") as f:
+        pickle.dump(examples, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return {
+        "name": os.path.basename(path),
+        "examples": len(examples),
+        "features": len(features),
+        "indexed_examples": indexed_examples,
+    }
+
+
+def default_workers() -> int:
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+
+def convert_examples(path: str, examples, tokenizer, max_seq_length, doc_stride, max_query_length, is_training,
+                     workers: Optional[int] = None, chunk_size: int = CHUNK_SIZE):
+    """
+    Converts `examples` like squad_convert_examples_to_features, in chunks of `chunk_size` examples spread over a
+    pool of `workers` processes (all the CPUs by default), and saves every chunk under `path` as soon as it is
+    converted. The manifest lists the chunks in order as they complete, so that FeatureStream can read them while
+    the conversion goes on.
+
+    The workers are spawned rather than forked, as the conversion can run in a thread of a trial that already uses
+    CUDA and other threads.
+    """
+    workers = max(1, workers or default_workers())
+    starts = range(0, len(examples), chunk_size)
+    tasks = (
+        (os.path.join(path, chunk_name(i)), examples[start:start + chunk_size], max_seq_length, doc_stride,
+         max_query_length, is_training)
+        for i, start in enumerate(starts)
+    )
+
+    chunks = []
+    converted = 0
+    report_every = max(1, len(starts) // 10)
+    start_time = time.perf_counter()
+    write_manifest(path, chunks, complete=False)
+
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(workers, initializer=squad_convert_example_to_features_init, initargs=(tokenizer,)) as pool:
+        for chunk in pool.imap(convert_chunk, tasks):
+            chunks.append(chunk)
+            converted += chunk["examples"]
+            # Complete with the last chunk, so that FeatureStream knows which features are the last ones when it reads
+            # them
+            write_manifest(path, chunks, complete=len(chunks) == len(starts))
+
+            if len(chunks) % report_every == 0 or len(chunks) == len(starts):
+                elapsed = time.perf_counter() - start_time
+                print(f"Converted {converted}/{len(examples)} examples into "
+                      f"{sum(chunk['features'] for chunk in chunks)} features in {elapsed:.0f} s "
+                      f"({converted / max(elapsed, 1e-9):.0f} examples/s, {workers} workers)")
+
+    write_manifest(path, chunks, complete=True)
+
+
+def load_and_cache_examples(cache: DatasetCache, tokenizer, task, max_seq_length, doc_stride, max_query_length, evaluate=False, model_name=None,
+                            workers=None, stream=False, rank=0, num_replicas=1, local_rank=0):
+    """
+    Returns the dataset, examples and features of the training or validation set of `task`, converted with
+    `tokenizer` by `workers` processes. They are cached in the dataset cache by everything that they depend on, and
+    the SQuAD file is only downloaded when they are not there yet.
+
+    With `stream`, the dataset is a FeatureStream of this rank's share of the features. A conversion that is not in
+    the cache yet runs in the background of the first process of every node (`local_rank` 0), as the cache is usually
+    local to the node, and every rank can read it as soon as the first chunk is converted.
+    """
     if (task == "SQuAD1.1"):
         train_url = "https://rajpurkar.github.io/SQuAD-explorer/dataset/train-v1.1.json"
         validation_url = "https://rajpurkar.github.io/SQuAD-explorer/dataset/dev-v1.1.json"
@@ -33,54 +423,41 @@ def load_and_cache_examples(data_dir: Path, tokenizer, task, max_seq_length, doc
     else:
         raise NameError("Incompatible dataset detected")
 
-    if not data_dir.exists():
-        data_dir.mkdir(parents=True)
-    if evaluate:
-        # TODO: Cache instead of always downloading
-        with urllib.request.urlopen(validation_url) as url:
-            val_path = data_dir / validation_file
-            with val_path.open('w') as f:
-                f.write(url.read().decode())
-
-    else:
-        with urllib.request.urlopen(train_url) as url:
-            train_path = data_dir / train_file
-            with train_path.open('w') as f:
-                f.write(url.read().decode())
-
-    # Load data features from cache or dataset file
-    cached_features_file = os.path.join(
-        str(data_dir.absolute()),
-        "cache_{}_{}".format(
-            "dev" if evaluate else "train",
-            model_name,
-        ),
+    url, filename = (validation_url, validation_file) if evaluate else (train_url, train_file)
+    key = (
+        "squad-feature-chunks",
+        task,
+        "dev" if evaluate else "train",
+        url,
+        model_name,
+        type(tokenizer).__name__,
+        getattr(tokenizer, "do_lower_case", None),
+        max_seq_length,
+        doc_stride,
+        max_query_length,
     )
+    names = EVAL_ARRAYS if evaluate else TRAIN_ARRAYS
 
-    # Init features and dataset from cache if it exists
-    overwrite_cache = False  # Set to True to do a cache wipe (TODO: Make cache wipe configurable)
-    if os.path.exists(cached_features_file) and not overwrite_cache:
-        print("Loading features from cached file %s", cached_features_file)
-        features_and_dataset = torch.load(cached_features_file)
-        features, dataset, examples = (
-            features_and_dataset["features"],
-            features_and_dataset["dataset"],
-            features_and_dataset["examples"],
-        )
-    else:
+    def convert(path):
+        input_dir = download_file(cache, url, filename)
         if evaluate:
-            examples = processor.get_dev_examples(data_dir, filename=validation_file)
+            examples = processor.get_dev_examples(str(input_dir), filename=filename)
         else:
-            examples = processor.get_train_examples(data_dir, filename=train_file)
-        features, dataset = squad_convert_examples_to_features(
-                examples=examples,
-                tokenizer=tokenizer,
-                max_seq_length=max_seq_length,
-                doc_stride=doc_stride,
-                max_query_length=max_query_length,
-                is_training=not evaluate,
-                return_dataset="pt",
-        )
-        print("Saving features into cached file %s", cached_features_file)
-        torch.save({"features": features, "dataset": dataset, "examples": examples}, cached_features_file)
-    return dataset, examples, features
+            examples = processor.get_train_examples(str(input_dir), filename=filename)
+        print(f"Converting {len(examples)} examples into {path}")
+        convert_examples(path, examples, tokenizer, max_seq_length, doc_stride, max_query_length,
+                         is_training=not evaluate, workers=workers)
+
+    root = cache.entry_path(key)
+    if stream:
+        # Every rank streams, so that they all split the features the same way, but only one per node converts them
+        conversion = None
+        if local_rank == 0 and not cache.hold(key):
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            conversion = executor.submit(cache.fetch, key, convert)
+            executor.shutdown(wait=False)
+        dataset = FeatureStream(root, cache.pending_path(key), names, rank, num_replicas, conversion)
+    else:
+        root, _ = cache.fetch(key, convert)
+        dataset = MappedFeatureDataset(root, names)
+    return dataset, LazySequence(root, EXAMPLES_INDEX), LazyFeatures(root)
@@ -7,16 +7,13 @@ from pathlib import Path
 from determined.pytorch import DataLoader, PyTorchTrial, PyTorchTrialContext, LRScheduler
 import data
 import constants
+import postprocess
 
 from transformers import (
     AdamW,
     get_linear_schedule_with_warmup,
 )
-from transformers.data.processors.squad import SquadResult
-from transformers.data.metrics.squad_metrics import (
-    compute_predictions_logits,
-    squad_evaluate,
-)
+from transformers.data.metrics.squad_metrics import squad_evaluate
 from radam import PlainRAdam
 
 TorchData = Union[Dict[str, torch.Tensor], Sequence[torch.Tensor], torch.Tensor]
@@ -29,9 +26,10 @@ class AlbertSQuADPyTorch(PyTorchTrial):
         self.using_bind_mount = data_config.get("use_bind_mount", False)
         self.bind_mount_path = Path(data_config.get("bind_mount_path")) if self.using_bind_mount else None
 
-        self.download_directory = data.data_directory(self.using_bind_mount,
-                                                      self.context.distributed.get_rank(),
-                                                      self.bind_mount_path)
+        self.dataset_cache = data.dataset_cache(self.using_bind_mount, data_config, self.bind_mount_path)
+        if data_config.get("stream_features", False):
+            # The streamed features are read through a plain DataLoader, see build_training_data_loader
+            self.context.experimental.disable_dataset_reproducibility_checks()
         self.config_class, self.tokenizer_class, self.model_class = constants.MODEL_CLASSES[
             self.context.get_hparam("model_type")
         ]
@@ -105,26 +103,39 @@ class AlbertSQuADPyTorch(PyTorchTrial):
 
     def build_training_data_loader(self):
         train_dataset, _, _ = data.load_and_cache_examples(
-            data_dir=self.download_directory,
+            cache=self.dataset_cache,
             tokenizer=self.tokenizer,
             task=self.context.get_data_config().get("task"),
             max_seq_length=self.context.get_hparam("max_seq_length"),
             doc_stride=self.context.get_hparam("doc_stride"),
             max_query_length=self.context.get_hparam("max_query_length"),
             evaluate=False,
+            model_name=self.context.get_data_config().get("pretrained_model_name"),
+            workers=self.context.get_data_config().get("conversion_workers"),
+            stream=self.context.get_data_config().get("stream_features", False),
+            rank=self.context.distributed.get_rank(),
+            num_replicas=self.context.distributed.get_size(),
+            local_rank=self.context.distributed.get_local_rank(),
         )
+        if isinstance(train_dataset, torch.utils.data.IterableDataset):
+            # Streamed while the features are converted: the stream shards itself, Determined's DataLoader would add
+            # a sampler. Without it, the trial starts from the beginning of an epoch when it is resumed
+            return data.RepeatingLoader(
+                torch.utils.data.DataLoader(train_dataset, batch_size=self.context.get_per_slot_batch_size())
+            )
         return DataLoader(train_dataset, batch_size=self.context.get_per_slot_batch_size())
 
     def build_validation_data_loader(self):
         self.validation_dataset, self.validation_examples, self.validation_features = data.load_and_cache_examples(
-            data_dir=self.download_directory,
+            cache=self.dataset_cache,
             tokenizer=self.tokenizer,
             task=self.context.get_data_config().get("task"),
             max_seq_length=self.context.get_hparam("max_seq_length"),
             doc_stride=self.context.get_hparam("doc_stride"),
             max_query_length=self.context.get_hparam("max_query_length"),
             evaluate=True,
-            model_name=self.context.get_data_config().get("pretrained_model_name")
+            model_name=self.context.get_data_config().get("pretrained_model_name"),
+            workers=self.context.get_data_config().get("conversion_workers"),
         )
 
         return DataLoader(
@@ -153,36 +164,27 @@ class AlbertSQuADPyTorch(PyTorchTrial):
         return {"loss": loss, "lr": float(self.lr_scheduler.get_last_lr()[0])}
 
     def evaluate_full_dataset(self, data_loader: DataLoader):
-        all_results = []
+        logits = postprocess.LogitsBuffer(len(self.validation_dataset), self.context.get_hparam("max_seq_length"))
 
         cuda_available = torch.cuda.is_available()
 
-        for batch in data_loader:
-            if cuda_available:
-                inputs = {
-                    "input_ids": batch[0].cuda(),
-                    "attention_mask": batch[1].cuda(),
-                    "token_type_ids": batch[2].cuda(),
-                }
-            else:
-                inputs = {
-                    "input_ids": batch[0],
-                    "attention_mask": batch[1],
-                    "token_type_ids": batch[2],
-                }
-            feature_indices = batch[3]
-            outputs = self.model(**inputs)
-            for i, feature_index in enumerate(feature_indices):
-                eval_feature = self.validation_features[feature_index.item()]
-                unique_id = int(eval_feature.unique_id)
-                output = [output[i].detach().cpu().tolist() for output in outputs]
-                start_logits, end_logits = output
-                result = SquadResult(unique_id, start_logits, end_logits)
-                all_results.append(result)
-
-        output_prediction_file = None
-        output_nbest_file = None
-        output_null_log_odds_file = None
+        with torch.no_grad():
+            for batch in data_loader:
+                if cuda_available:
+                    inputs = {
+                        "input_ids": batch[0].cuda(),
+                        "attention_mask": batch[1].cuda(),
+                        "token_type_ids": batch[2].cuda(),
+                    }
+                else:
+                    inputs = {
+                        "input_ids": batch[0],
+                        "attention_mask": batch[1],
+                        "token_type_ids": batch[2],
+                    }
+                feature_indices = batch[3]
+                start_logits, end_logits = self.model(**inputs)
+                logits.add(feature_indices, start_logits, end_logits)
 
         task = self.context.get_data_config().get("task")
         if task == "SQuAD1.1":
@@ -192,12 +194,17 @@ class AlbertSQuADPyTorch(PyTorchTrial):
         else:
             raise NameError(f"Incompatible dataset '{task}' detected")
 
+        output_prediction_file = None
+        output_nbest_file = None
+        output_null_log_odds_file = None
+
         # TODO: Make verbose logging configurable
         verbose_logging = False
-        predictions = compute_predictions_logits(
+        predictions = postprocess.compute_predictions(
             self.validation_examples,
             self.validation_features,
-            all_results,
+            logits.start_logits,
+            logits.end_logits,
             self.context.get_hparam("n_best_size"),
             self.context.get_hparam("max_answer_length"),
             self.context.get_hparam("do_lower_case"),
@@ -208,6 +215,8 @@ class AlbertSQuADPyTorch(PyTorchTrial):
             version_2_with_negative,
             self.context.get_hparam("null_score_diff_threshold"),
             self.tokenizer,
+            top_k=self.context.get_hparams().get("n_best_candidates"),
+            workers=self.context.get_data_config().get("postprocessing_workers"),
         )
         results = squad_evaluate(self.validation_examples, predictions)
         return results
@@ -0,0 +1,324 @@
+import collections
+import json
+import logging
+import multiprocessing
+import os
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from transformers.data.metrics.squad_metrics import _compute_softmax, get_final_text
+
+PARTITIONS_PER_WORKER = 4
+# Spawning a worker costs seconds of imports: by default, a worker per this many examples at most
+EXAMPLES_PER_WORKER = 1000
+
+_PrelimPrediction = collections.namedtuple(
+    "PrelimPrediction", ["feature_index", "start_index", "end_index", "start_logit", "end_logit"]
+)
+_NbestPrediction = collections.namedtuple("NbestPrediction", ["text", "start_logit", "end_logit"])
+
+# Settings of compute_predictions shared by the examples, only set in the processes of its pool
+_worker_settings = None
+
+
+class LogitsBuffer:
+    """
+    Start and end logits of every feature of an evaluation, in arrays indexed by feature index: each batch is copied
+    from the device once, instead of once per feature and per output.
+    """
+
+    def __init__(self, num_features: int, seq_length: int):
+        self.start_logits = np.zeros((num_features, seq_length), dtype=np.float32)
+        self.end_logits = np.zeros((num_features, seq_length), dtype=np.float32)
+
+    def add(self, feature_indices: torch.Tensor, start_logits: torch.Tensor, end_logits: torch.Tensor):
+        logits = torch.stack([start_logits, end_logits]).detach().cpu().numpy()
+        indices = feature_indices.cpu().numpy()
+        self.start_logits[indices] = logits[0]
+        self.end_logits[indices] = logits[1]
+
+
+def best_indexes(logits: np.ndarray, n: int) -> np.ndarray:
+    """
+    Indexes of the `n` largest logits of every row, largest first and ties in index order, like _get_best_indexes of
+    transformers does for a single feature. The rows are partitioned around their n-th largest logit, and only the
+    logits above it (or tied with it) are sorted.
+    """
+    n = min(n, logits.shape[1])
+    if n == 0 or len(logits) == 0:
+        return np.zeros((len(logits), n), dtype=np.int64)
+
+    nth_largest = np.partition(logits, logits.shape[1] - n, axis=1)[:, logits.shape[1] - n]
+    rows, cols = np.nonzero(logits >= nth_largest[:, None])
+    # By row, largest logit first, then by index
+    order = np.lexsort((cols, -logits[rows, cols], rows))
+    counts = np.bincount(rows, minlength=len(logits))
+    first = np.cumsum(counts) - counts
+    return cols[order[first[:, None] + np.arange(n)]]
+
+
+def predict_examples(
+    examples: Sequence,
+    example_features: Sequence[List[Tuple[int, object]]],
+    start_logits: np.ndarray,
+    end_logits: np.ndarray,
+    best_starts: np.ndarray,
+    best_ends: np.ndarray,
+    n_best_size: int,
+    max_answer_length: int,
+    do_lower_case: bool,
+    verbose_logging: bool,
+    version_2_with_negative: bool,
+    null_score_diff_threshold: float,
+    tokenizer,
+    with_nbest: bool,
+    start: int,
+    end: int,
+) -> list:
+    """
+    Predicts the answers of examples[start:end] like compute_predictions_logits of transformers does, given the
+    (row in the logits arrays, feature) of the features of every example. Returns (qas_id, prediction, n-best
+    entries or None, null score difference or None) for every example.
+    """
+    outputs = []
+    for example_index in range(start, end):
+        example = examples[example_index]
+        features = example_features[example_index]
+
+        prelim_predictions = []
+        # The minimum score of null start+end of position 0, and the feature and logits it comes from
+        score_null = 1000000
+        min_null_feature_index = 0
+        null_start_logit = 0
+        null_end_logit = 0
+        for (feature_index, (row, feature)) in enumerate(features):
+            feature_start_logits = start_logits[row].tolist()
+            feature_end_logits = end_logits[row].tolist()
+            if version_2_with_negative:
+                feature_null_score = feature_start_logits[0] + feature_end_logits[0]
+                if feature_null_score < score_null:
+                    score_null = feature_null_score
+                    min_null_feature_index = feature_index
+                    null_start_logit = feature_start_logits[0]
+                    null_end_logit = feature_end_logits[0]
+            for start_index in best_starts[row].tolist():
+                for end_index in best_ends[row].tolist():
+                    # Spans in the question, across features, reversed or too long are invalid
+                    if start_index >= len(feature.tokens):
+                        continue
+                    if end_index >= len(feature.tokens):
+                        continue
+                    if start_index not in feature.token_to_orig_map:
+                        continue
+                    if end_index not in feature.token_to_orig_map:
+                        continue
+                    if not feature.token_is_max_context.get(start_index, False):
+                        continue
+                    if end_index < start_index:
+                        continue
+                    length = end_index - start_index + 1
+                    if length > max_answer_length:
+                        continue
+                    prelim_predictions.append(
+                        _PrelimPrediction(
+                            feature_index=feature_index,
+                            start_index=start_index,
+                            end_index=end_index,
+                            start_logit=feature_start_logits[start_index],
+                            end_logit=feature_end_logits[end_index],
+                        )
+                    )
+        if version_2_with_negative:
+            prelim_predictions.append(
+                _PrelimPrediction(
+                    feature_index=min_null_feature_index,
+                    start_index=0,
+                    end_index=0,
+                    start_logit=null_start_logit,
+                    end_logit=null_end_logit,
+                )
+            )
+        prelim_predictions = sorted(prelim_predictions, key=lambda x: (x.start_logit + x.end_logit), reverse=True)
+
+        seen_predictions = {}
+        nbest = []
+        for pred in prelim_predictions:
+            if len(nbest) >= n_best_size:
+                break
+            _, feature = features[pred.feature_index]
+            if pred.start_index > 0:  # this is a non-null prediction
+                tok_tokens = feature.tokens[pred.start_index : (pred.end_index + 1)]
+                orig_doc_start = feature.token_to_orig_map[pred.start_index]
+                orig_doc_end = feature.token_to_orig_map[pred.end_index]
+                orig_tokens = example.doc_tokens[orig_doc_start : (orig_doc_end + 1)]
+
+                tok_text = tokenizer.convert_tokens_to_string(tok_tokens)
+                tok_text = " ".join(tok_text.strip().split())
+                orig_text = " ".join(orig_tokens)
+
+                final_text = get_final_text(tok_text, orig_text, do_lower_case, verbose_logging)
+                if final_text in seen_predictions:
+                    continue
+                seen_predictions[final_text] = True
+            else:
+                final_text = ""
+                seen_predictions[final_text] = True
+
+            nbest.append(_NbestPrediction(text=final_text, start_logit=pred.start_logit, end_logit=pred.end_logit))
+
+        if version_2_with_negative:
+            # The empty answer is always one of the candidates, next to at least one non-empty one
+            if "" not in seen_predictions:
+                nbest.append(_NbestPrediction(text="", start_logit=null_start_logit, end_logit=null_end_logit))
+            if len(nbest) == 1:
+                nbest.insert(0, _NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
+        if not nbest:
+            nbest.append(_NbestPrediction(text="empty", start_logit=0.0, end_logit=0.0))
+
+        nbest_json = None
+        if with_nbest:
+            probs = _compute_softmax([entry.start_logit + entry.end_logit for entry in nbest])
+            nbest_json = [
+                collections.OrderedDict(
+                    [
+                        ("text", entry.text),
+                        ("probability", probability),
+                        ("start_logit", entry.start_logit),
+                        ("end_logit", entry.end_logit),
+                    ]
+                )
+                for entry, probability in zip(nbest, probs)
+            ]
+
+        best_non_null_entry = next((entry for entry in nbest if entry.text), None)
+        if not version_2_with_negative:
+            outputs.append((example.qas_id, nbest[0].text, nbest_json, None))
+        else:
+            # Predict "" iff the null score - the score of best non-null > threshold
+            score_diff = score_null - best_non_null_entry.start_logit - best_non_null_entry.end_logit
+            prediction = "" if score_diff > null_score_diff_threshold else best_non_null_entry.text
+            outputs.append((example.qas_id, prediction, nbest_json, score_diff))
+
+    return outputs
+
+
+def _init_worker(settings: tuple):
+    global _worker_settings
+    _worker_settings = settings
+
+
+def _predict_partition(task: tuple) -> list:
+    examples = task[0]
+    return predict_examples(*task, *_worker_settings, 0, len(examples))
+
+
+def _partition(examples, example_features, start_logits, end_logits, best_starts, best_ends, start, end) -> tuple:
+    """The inputs of predict_examples for examples[start:end], with the rows of their features renumbered from 0."""
+    rows = []
+    partition_features = []
+    for features in example_features[start:end]:
+        partition_features.append([(len(rows) + i, feature) for i, (_, feature) in enumerate(features)])
+        rows.extend(row for row, _ in features)
+    return (
+        examples[start:end], partition_features, start_logits[rows], end_logits[rows], best_starts[rows],
+        best_ends[rows],
+    )
+
+
+def default_workers() -> int:
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+
+
+def compute_predictions(
+    all_examples: Sequence,
+    all_features: Sequence,
+    start_logits: np.ndarray,
+    end_logits: np.ndarray,
+    n_best_size: int,
+    max_answer_length: int,
+    do_lower_case: bool,
+    output_prediction_file: Optional[str],
+    output_nbest_file: Optional[str],
+    output_null_log_odds_file: Optional[str],
+    verbose_logging: bool,
+    version_2_with_negative: bool,
+    null_score_diff_threshold: float,
+    tokenizer,
+    top_k: Optional[int] = None,
+    workers: Optional[int] = None,
+) -> collections.OrderedDict:
+    """
+    Returns the same predictions as compute_predictions_logits of transformers, and writes the same files, from the
+    logits of the features in arrays indexed by feature index (see LogitsBuffer) rather than from a SquadResult per
+    feature. The n-best entries are only computed when they are written.
+
+    The best start and end indexes of all the features are selected at once. The examples are then split into
+    contiguous partitions, predicted by a pool of `workers` processes (by default, all the CPUs, up to one per
+    EXAMPLES_PER_WORKER examples). Each partition is sent with the rows of the logits of its features only. The
+    workers are spawned rather than forked, as the post-processing runs in a trial that already uses CUDA and other
+    threads.
+
+    `top_k` limits the start and end indexes considered for every feature to fewer than `n_best_size`, i.e. top_k^2
+    candidate spans per feature instead of n_best_size^2, which is faster but may change a few predictions.
+    """
+    if output_prediction_file:
+        logging.info(f"Writing predictions to: {output_prediction_file}")
+    if output_nbest_file:
+        logging.info(f"Writing nbest to: {output_nbest_file}")
+    if output_null_log_odds_file and version_2_with_negative:
+        logging.info(f"Writing null_log_odds to: {output_null_log_odds_file}")
+
+    candidates = n_best_size if top_k is None else min(top_k, n_best_size)
+    best_starts = best_indexes(start_logits, candidates)
+    best_ends = best_indexes(end_logits, candidates)
+
+    # Features of every example, with their rows in the logits arrays
+    example_features = [[] for _ in range(len(all_examples))]
+    for row, feature in enumerate(all_features):
+        if feature.example_index < len(example_features):
+            example_features[feature.example_index].append((row, feature))
+
+    settings = (
+        n_best_size, max_answer_length, do_lower_case, verbose_logging, version_2_with_negative,
+        null_score_diff_threshold, tokenizer, bool(output_nbest_file),
+    )
+    if workers is None:
+        workers = min(default_workers(), len(all_examples) // EXAMPLES_PER_WORKER)
+    workers = min(workers, len(all_examples))
+    if workers <= 1:
+        outputs = predict_examples(
+            all_examples, example_features, start_logits, end_logits, best_starts, best_ends, *settings,
+            0, len(all_examples),
+        )
+    else:
+        partitions = np.linspace(0, len(all_examples), workers * PARTITIONS_PER_WORKER + 1).astype(int).tolist()
+        tasks = (
+            _partition(all_examples, example_features, start_logits, end_logits, best_starts, best_ends, start, end)
+            for start, end in zip(partitions[:-1], partitions[1:])
+        )
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(workers, initializer=_init_worker, initargs=(settings,)) as pool:
+            outputs = [output for partition in pool.imap(_predict_partition, tasks) for output in partition]
+
+    all_predictions = collections.OrderedDict()
+    all_nbest_json = collections.OrderedDict()
+    scores_diff_json = collections.OrderedDict()
+    for qas_id, prediction, nbest_json, score_diff in outputs:
+        all_predictions[qas_id] = prediction
+        all_nbest_json[qas_id] = nbest_json
+        scores_diff_json[qas_id] = score_diff
+
+    if output_prediction_file:
+        with open(output_prediction_file, "w") as writer:
+            writer.write(json.dumps(all_predictions, indent=4) + "\n")
+
+    if output_nbest_file:
+        with open(output_nbest_file, "w") as writer:
+            writer.write(json.dumps(all_nbest_json, indent=4) + "\n")
+
+    if output_null_log_odds_file and version_2_with_negative:
+        with open(output_null_log_odds_file, "w") as writer:
+            writer.write(json.dumps(scores_diff_json, indent=4) + "\n")
+
+    return all_predictions
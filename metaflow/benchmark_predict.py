@@ -0,0 +1,119 @@
+"""
+Questions answered per second on CPU by QAPredictor of predict.py, asked one at a time by one or several concurrent
+clients, about a few contexts, compared to the previous run_prediction: a process to convert the examples, the model
+moved to its device, a SquadResult per feature and three JSON files written on every call. The model has random
+weights, which makes no difference to the time spent outside of the forward passes. The answers are checked against
+the ones of the previous run_prediction.
+"""
+import argparse
+import concurrent.futures
+import os
+import tempfile
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, SequentialSampler
+from transformers import squad_convert_examples_to_features
+from transformers.data.metrics.squad_metrics import compute_predictions_logits
+from transformers.data.processors.squad import SquadExample, SquadResult
+
+import predict
+from albert_squad_pytorch import constants
+from predict import QAPredictor
+
+
+def previous_prediction(model, tokenizer, question_texts, context_text, output_dir):
+    """The previous run_prediction, writing its files to output_dir."""
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model.to(device)
+
+    examples = [
+        SquadExample(qas_id=str(i), question_text=question_text, context_text=context_text, answer_text=None,
+                     start_position_character=None, title="Predict", is_impossible=False, answers=None)
+        for i, question_text in enumerate(question_texts)
+    ]
+    features, dataset = squad_convert_examples_to_features(examples=examples, tokenizer=tokenizer, max_seq_length=384,
+                                                           doc_stride=128, max_query_length=64, is_training=False,
+                                                           return_dataset="pt", threads=1, tqdm_enabled=False)
+    eval_dataloader = DataLoader(dataset, sampler=SequentialSampler(dataset), batch_size=10)
+
+    all_results = []
+    for batch in eval_dataloader:
+        model.eval()
+        batch = tuple(t.to(device) for t in batch)
+        with torch.no_grad():
+            outputs = model(input_ids=batch[0], attention_mask=batch[1], token_type_ids=batch[2])
+            for i, feature_index in enumerate(batch[3]):
+                unique_id = int(features[feature_index.item()].unique_id)
+                start_logits, end_logits = [output[i].detach().cpu().tolist() for output in outputs]
+                all_results.append(SquadResult(unique_id, start_logits, end_logits))
+
+    return compute_predictions_logits(
+        examples, features, all_results, predict.n_best_size, predict.max_answer_length, predict.do_lower_case,
+        os.path.join(output_dir, "predictions.json"), os.path.join(output_dir, "nbest_predictions.json"),
+        os.path.join(output_dir, "null_predictions.json"), False, True, predict.null_score_diff_threshold, tokenizer,
+    )
+
+
+def synthetic_questions(count, contexts, context_words, seed=0):
+    """(question, context) pairs: a few contexts, with many questions about each of them."""
+    rng = np.random.default_rng(seed)
+    words = ["the", "of", "river", "city", "empire", "king", "was", "built", "in", "century", "north", "trade",
+             "population", "university", "founded", "church", "war", "army", "coast", "mountain", "language"]
+    all_tokens = []
+    for _ in range(contexts):
+        picks = zip(rng.integers(len(words), size=context_words), rng.integers(100, size=context_words))
+        all_tokens.append([f"{words[w]}{n}" if w % 4 == 0 else words[w] for w, n in picks])
+    questions = []
+    for i in range(count):
+        tokens = all_tokens[i % contexts]
+        start = int(rng.integers(len(tokens) - 3))
+        question = f"what {tokens[start + 1]} {tokens[int(rng.integers(len(tokens)))]} in {tokens[start]}?"
+        questions.append((question, " ".join(tokens)))
+    return questions
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="QAPredictor against the previous run_prediction")
+    parser.add_argument("--model-type", default="albert", choices=sorted(constants.MODEL_CLASSES))
+    parser.add_argument("--model", default="albert-base-v2", help="Pretrained model name or tokenizer directory")
+    parser.add_argument("--layers", type=int, default=2, help="Layers of the randomly initialized model")
+    parser.add_argument("--questions", type=int, default=200, help="Number of questions asked")
+    parser.add_argument("--contexts", type=int, default=4, help="Number of contexts the questions are about")
+    parser.add_argument("--context-words", type=int, default=300)
+    parser.add_argument("--clients", default="1,4,16", help="Comma-separated numbers of concurrent clients")
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    config_class, tokenizer_class, model_class = constants.MODEL_CLASSES[args.model_type]
+    tokenizer = tokenizer_class.from_pretrained(args.model, do_lower_case=True)
+    config = config_class(vocab_size=tokenizer.vocab_size, hidden_size=256, intermediate_size=1024,
+                          num_attention_heads=4, num_hidden_layers=args.layers, return_dict=False)
+    model = model_class(config).eval()
+    questions = synthetic_questions(args.questions, args.contexts, args.context_words)
+    print(f"{len(questions)} questions about {args.contexts} contexts, {torch.get_num_threads()} torch threads")
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        expected, reference_time = timed(lambda: [
+            previous_prediction(model, tokenizer, [question], context, output_dir)["0"]
+            for question, context in questions
+        ])
+    print(f">>> {'previous run_prediction':<36} {len(questions) / reference_time:7.1f} questions/s")
+
+    for clients in [int(c) for c in args.clients.split(",")]:
+        with QAPredictor(model, tokenizer, batch_size=args.batch_size) as predictor:
+            with concurrent.futures.ThreadPoolExecutor(clients) as executor:
+                answers, elapsed = timed(lambda: list(executor.map(
+                    lambda pair: predictor.predict([pair[0]], pair[1])[0], questions)))
+        assert answers == expected, f"Answers of {clients} clients differ"
+        print(f">>> {f'QAPredictor, {clients} clients':<36} {len(questions) / elapsed:7.1f} questions/s "
+              f"({reference_time / elapsed:.1f}x)")
+    print("Answers match the previous run_prediction")
@@ -1,17 +1,21 @@
-import os
+import collections
+import concurrent.futures
+import copy
+import functools
+import queue
+import threading
+import time
+from typing import List
+
 import torch
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
 
-from transformers import (
-    AlbertConfig,
-    AlbertForQuestionAnswering,
-    AlbertTokenizer,
-    squad_convert_examples_to_features
+from transformers.data.processors.squad import (
+    SquadExample,
+    squad_convert_example_to_features,
+    squad_convert_example_to_features_init,
 )
 
-from transformers.data.processors.squad import SquadResult, SquadV2Processor, SquadExample
-
-from transformers.data.metrics.squad_metrics import compute_predictions_logits
+from albert_squad_pytorch.postprocess import compute_predictions
 
 
 # Config
@@ -19,27 +23,104 @@ n_best_size = 2
 max_answer_length = 30
 do_lower_case = True
 null_score_diff_threshold = 0.0
+max_seq_length = 384
+doc_stride = 128
+max_query_length = 64
 
-def to_list(tensor):
-    return tensor.detach().cpu().tolist()
+# squad_convert_example_to_features reads its tokenizer from a global of transformers, shared by all the predictors
+_conversion_lock = threading.Lock()
 
-def run_prediction(model, question_texts, context_text):
-    """Setup function to compute predictions"""
-    
-    processor = SquadV2Processor()
-    config = model.model.config
-    tokenizer = model.tokenizer
-    examples = []
-    
-    model = model.model
-
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model.to(device)
-    
-    for i, question_text in enumerate(question_texts):
-        example = SquadExample(
-            qas_id=str(i),
-            question_text=question_text,
+# Stops the batching thread of a predictor
+_CLOSE = object()
+
+_Request = collections.namedtuple("Request", ["examples", "features", "future"])
+
+
+class QAPredictor:
+    """
+    Answers questions about a context with a model kept on its device, in evaluation mode, between calls.
+
+    The parsing of the contexts and the sub-word tokenization of their words are cached, so that many questions about
+    the same context only pay for the tokenization of the questions. The questions submitted by concurrent callers
+    within `max_batch_delay` seconds of each other are run through the model together, in batches of up to
+    `batch_size` features. The answers are returned in memory.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        device=None,
+        batch_size: int = 32,
+        max_batch_delay: float = 0.005,
+        cached_contexts: int = 64,
+        cached_tokens: int = 2 ** 16,
+    ):
+        self.device = device or torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.model = model.to(self.device).eval()
+        self.batch_size = batch_size
+        self.max_batch_delay = max_batch_delay
+
+        # A copy of the tokenizer, of the same class so that the conversion treats it the same way
+        self.tokenizer = copy.copy(tokenizer)
+        self.tokenizer.tokenize = functools.lru_cache(maxsize=cached_tokens)(tokenizer.tokenize)
+        self._parse_context = functools.lru_cache(maxsize=cached_contexts)(self._parse_context)
+
+        self._requests = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._serve, name="QAPredictor", daemon=True)
+        self._thread.start()
+
+    def predict(self, question_texts: List[str], context_text: str) -> List[str]:
+        """Answers of the questions about the context, "" for the ones without answer."""
+        return self.submit(question_texts, context_text).result()
+
+    def submit(self, question_texts: List[str], context_text: str) -> concurrent.futures.Future:
+        """Like predict, but returns a future of the answers instead of waiting for them."""
+        if self._closed:
+            raise RuntimeError("QAPredictor is closed")
+
+        template = self._parse_context(context_text)
+        examples = []
+        for i, question_text in enumerate(question_texts):
+            example = copy.copy(template)
+            example.qas_id = str(i)
+            example.question_text = question_text
+            examples.append(example)
+
+        features = []
+        with _conversion_lock:
+            squad_convert_example_to_features_init(self.tokenizer)
+            for example_index, example in enumerate(examples):
+                for feature in squad_convert_example_to_features(
+                    example, max_seq_length, doc_stride, max_query_length, "max_length", is_training=False
+                ):
+                    feature.example_index = example_index
+                    feature.unique_id = 1000000000 + len(features)
+                    features.append(feature)
+
+        future = concurrent.futures.Future()
+        self._requests.put(_Request(examples, features, future))
+        return future
+
+    def close(self):
+        """Stops the batching thread once the questions already submitted are answered."""
+        if not self._closed:
+            self._closed = True
+            self._requests.put(_CLOSE)
+            self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _parse_context(context_text: str) -> SquadExample:
+        return SquadExample(
+            qas_id=None,
+            question_text=None,
             context_text=context_text,
             answer_text=None,
             start_position_character=None,
@@ -48,70 +129,89 @@ def run_prediction(model, question_texts, context_text):
             answers=None,
         )
 
-        examples.append(example)
-
-    features, dataset = squad_convert_examples_to_features(
-        examples=examples,
-        tokenizer=tokenizer,
-        max_seq_length=384,
-        doc_stride=128,
-        max_query_length=64,
-        is_training=False,
-        return_dataset="pt",
-        threads=1,
-    )
-
-    eval_sampler = SequentialSampler(dataset)
-    eval_dataloader = DataLoader(dataset, sampler=eval_sampler, batch_size=10)
+    def _serve(self):
+        closing = False
+        while not closing:
+            request = self._requests.get()
+            if request is _CLOSE:
+                break
+            # Gathers the requests of the next max_batch_delay seconds, up to a full batch
+            requests = [request]
+            num_features = len(request.features)
+            deadline = time.monotonic() + self.max_batch_delay
+            while num_features < self.batch_size:
+                try:
+                    request = self._requests.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if request is _CLOSE:
+                    closing = True
+                    break
+                requests.append(request)
+                num_features += len(request.features)
+
+            try:
+                self._answer(requests)
+            except Exception as e:
+                for request in requests:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+
+    def _answer(self, requests: List[_Request]):
+        features = [feature for request in requests for feature in request.features]
+        start_logits, end_logits = [], []
+        with torch.no_grad():
+            for start in range(0, len(features), self.batch_size):
+                batch = features[start : start + self.batch_size]
+                inputs = {
+                    name: torch.tensor([getattr(feature, name) for feature in batch], dtype=torch.long).to(self.device)
+                    for name in ["input_ids", "attention_mask", "token_type_ids"]
+                }
+                outputs = self.model(**inputs)
+                start_logits.append(outputs[0].cpu())
+                end_logits.append(outputs[1].cpu())
+        start_logits = torch.cat(start_logits).numpy()
+        end_logits = torch.cat(end_logits).numpy()
+
+        row = 0
+        for request in requests:
+            rows = slice(row, row + len(request.features))
+            row = rows.stop
+            # A handful of questions, predicted faster in this thread than by a pool
+            predictions = compute_predictions(
+                request.examples,
+                request.features,
+                start_logits[rows],
+                end_logits[rows],
+                n_best_size,
+                max_answer_length,
+                do_lower_case,
+                None,  # output_prediction_file
+                None,  # output_nbest_file
+                None,  # output_null_log_odds_file
+                False,  # verbose_logging
+                True,  # version_2_with_negative
+                null_score_diff_threshold,
+                self.tokenizer,
+                workers=1,
+            )
+            request.future.set_result([predictions[example.qas_id] for example in request.examples])
+
+
+# The predictor of the last model given to run_prediction, kept warm for the next calls
+_predictor = None
+_predictor_model = None
 
-    all_results = []
 
-    for batch in eval_dataloader:
-        model.eval()
-        batch = tuple(t.to(device) for t in batch)
+def run_prediction(model, question_texts, context_text):
+    """Setup function to compute predictions"""
+    global _predictor, _predictor_model
 
-        with torch.no_grad():
-            inputs = {
-                "input_ids": batch[0],
-                "attention_mask": batch[1],
-                "token_type_ids": batch[2],
-            }
-
-            example_indices = batch[3]
-
-            outputs = model(**inputs)
-
-            for i, example_index in enumerate(example_indices):
-                eval_feature = features[example_index.item()]
-                unique_id = int(eval_feature.unique_id)
-
-                output = [to_list(output[i]) for output in outputs]
-
-                start_logits, end_logits = output
-                result = SquadResult(unique_id, start_logits, end_logits)
-                all_results.append(result)
-
-    if not os.path.exists("predictions"):
-        os.mkdir("predictions")
-
-    output_prediction_file = "predictions/predictions.json"
-    output_nbest_file = "predictions/nbest_predictions.json"
-    output_null_log_odds_file = "predictions/null_predictions.json"
-
-    predictions = compute_predictions_logits(
-        examples,
-        features,
-        all_results,
-        n_best_size,
-        max_answer_length,
-        do_lower_case,
-        output_prediction_file,
-        output_nbest_file,
-        output_null_log_odds_file,
-        False,  # verbose_logging
-        True,  # version_2_with_negative
-        null_score_diff_threshold,
-        tokenizer,
-    )
+    if _predictor_model is not model:
+        if _predictor is not None:
+            _predictor.close()
+        _predictor = QAPredictor(model.model, model.tokenizer)
+        _predictor_model = model
 
-    return predictions
\ No newline at end of file
+    answers = _predictor.predict(question_texts, context_text)
+    return collections.OrderedDict((str(i), answer) for i, answer in enumerate(answers))
@@ -9,7 +9,7 @@ from seldon_deploy_sdk import (
     PredictiveUnit, Parameter,
     DriftDetectorApi, DetectorConfigData, DetectorConfiguration, BasicDetectorConfiguration,
     DetectorDeploymentConfiguration,
-    OutlierDetectorApi, VolumeMount, Volume, SecretVolumeSource, EnvVar
+    OutlierDetectorApi, VolumeMount, Volume, SecretVolumeSource, HostPathVolumeSource, EnvVar
 )
 
 from seldon_deploy_sdk.auth import OIDCAuthenticator
@@ -24,6 +24,15 @@ def parse_args():
     parser.add_argument("--detect-bucket-uri", type=str, help="Bucket to use for all detectors")
     parser.add_argument("--detect-batch-size", type=str, help="Batch size to use for all detectors")
     parser.add_argument("--serving-image",     type=str, help="Container image to use to serve the model")
+    parser.add_argument("--max-batch-size",    type=int,   default=1,   help="Max requests grouped in one forward pass (1 disables batching)")
+    parser.add_argument("--max-batch-wait-ms", type=float, default=5.0, help="Max time a request waits for a batch to fill")
+    parser.add_argument("--serving-mode",      type=str,   default="eager",
+                        choices=["eager", "int8", "torchscript", "int8+torchscript"],
+                        help="Conversion applied to the model before serving")
+    parser.add_argument("--model-memory-gb",   type=float, default=0.0,
+                        help="Memory budget to host several model versions in one pod (0 serves a single version)")
+    parser.add_argument("--checkpoint-cache-host-path", type=str, default=None,
+                        help="Node directory shared by all replicas to cache downloaded checkpoints")
     return parser.parse_args()
 
 # =====================================================================================
@@ -64,6 +73,51 @@ def build_metadata(model):
 
 # =====================================================================================
 
+def build_volume_mounts(args):
+    mounts = [
+        VolumeMount(
+            name="config",
+            mount_path="/app/config"
+        )
+    ]
+
+    if args.checkpoint_cache_host_path:
+        mounts.append(
+            VolumeMount(
+                name="checkpoint-cache",
+                mount_path="/app/checkpoint-cache"
+            )
+        )
+
+    return mounts
+
+# =====================================================================================
+
+def build_volumes(args):
+    volumes = [
+        Volume(
+            name="config",
+            secret=SecretVolumeSource(
+                secret_name="deployment-secret"
+            )
+        )
+    ]
+
+    if args.checkpoint_cache_host_path:
+        volumes.append(
+            Volume(
+                name="checkpoint-cache",
+                host_path=HostPathVolumeSource(
+                    path=args.checkpoint_cache_host_path,
+                    type="DirectoryOrCreate"
+                )
+            )
+        )
+
+    return volumes
+
+# =====================================================================================
+
 def create_deploy_descriptor(args, secrets, det, model):
     return SeldonDeployment(
         api_version="machinelearning.seldon.io/v1",
@@ -83,12 +137,7 @@ def create_deploy_descriptor(args, secrets, det, model):
                                     Container(
                                         name=args.deploy_name + "-container",
                                         image=args.serving_image,
-                                        volume_mounts=[
-                                            VolumeMount(
-                                                name="config",
-                                                mount_path="/app/config"
-                                            )
-                                        ],
+                                        volume_mounts=build_volume_mounts(args),
                                         env=[
                                             EnvVar(
                                                 name="MODEL_METADATA",
@@ -97,14 +146,7 @@ def create_deploy_descriptor(args, secrets, det, model):
                                         ]
                                     )
                                 ],
-                                volumes=[
-                                    Volume(
-                                        name="config",
-                                        secret=SecretVolumeSource(
-                                            secret_name="deployment-secret"
-                                        )
-                                    )
-                                ]
+                                volumes=build_volumes(args)
                             )
                         )
                     ],
@@ -118,7 +160,11 @@ def create_deploy_descriptor(args, secrets, det, model):
                             Parameter("user",          "STRING", det.username),
                             Parameter("password",      "STRING", det.password),
                             Parameter("model_name",    "STRING", model.name),
-                            Parameter("model_version", "STRING", model.version)
+                            Parameter("model_version", "STRING", model.version),
+                            Parameter("max_batch_size",    "INT",   str(args.max_batch_size)),
+                            Parameter("max_batch_wait_ms", "FLOAT", str(args.max_batch_wait_ms)),
+                            Parameter("serving_mode",      "STRING", args.serving_mode),
+                            Parameter("model_memory_gb",   "FLOAT",  str(args.model_memory_gb))
                         ],
                     ),
                     traffic=100,
@@ -1,25 +1,110 @@
+import inspect
 import os
 import time
-from typing import Dict, Union, List, Optional
+from typing import Dict, Union, List, Optional, Tuple
 
-from determined.common.experimental import ModelVersion
 from determined.experimental import Determined
 from determined.pytorch import load_trial_from_checkpoint_path
 import numpy as np
 import logging
 import torch
+from seldon_core.user_model import SeldonResponse
+
+from batching import BatchingQueue
+from checkpoint_cache import CheckpointCache
+from model_manager import ModelManager, model_bytes
+from model_optimizer import optimize_for_serving
+from request_logging import RequestLogger, setup_async_logging, summarize
+from serving_metrics import ServingMetrics
+from version_index import VersionIndex
 
 logging.basicConfig()
 logging.getLogger().setLevel(logging.INFO)
 
 # =============================================================================
 
+class ServedModel(object):
+    """
+    A trial loaded from a checkpoint, together with its batching queue.
+    """
+
+    def __init__(self, trial, max_batch_size: int, max_batch_wait_ms: float):
+        self.trial         = trial
+        self.stage_timings = (hasattr(trial, 'predict_batch')
+                              and 'timings' in inspect.signature(trial.predict_batch).parameters)
+        self.batcher       = self.create_batcher(max_batch_size, max_batch_wait_ms)
+        self.size_bytes    = model_bytes(trial.model)
+
+    # -------------------------------------------------------------------------
+
+    def create_batcher(self, max_batch_size, max_batch_wait_ms) -> Optional[BatchingQueue]:
+        if int(max_batch_size) <= 1:
+            return None
+
+        if not hasattr(self.trial, 'predict_batch'):
+            logging.warning("The checkpoint's trial does not implement 'predict_batch'. Batching disabled")
+            return None
+
+        return BatchingQueue(self.predict_batch, max_batch_size, max_batch_wait_ms)
+
+    # -------------------------------------------------------------------------
+
+    def predict_batch(self, images: List[np.ndarray]) -> List[Tuple[str, Optional[Dict]]]:
+        """
+        Runs the trial on a batch and pairs each label with the batch's size and stage timings.
+        Only the first request of the batch carries them, so that they are reported once per batch.
+        """
+        timings = {}
+        if self.stage_timings:
+            labels = self.trial.predict_batch(images, timings=timings)
+        else:
+            labels = self.trial.predict_batch(images)
+
+        batch = {'size': len(images), 'timings': timings}
+        return [(label, batch if i == 0 else None) for i, label in enumerate(labels)]
+
+    # -------------------------------------------------------------------------
+
+    def predict(self, X, names, meta) -> Tuple[List, Optional[Dict], Optional[int]]:
+        """
+        Returns the prediction, the batch information (see predict_batch) and the depth of the
+        batching queue when the request was submitted.
+        """
+        if self.batcher is not None:
+            depth = self.batcher.depth()
+            label, batch = self.batcher.predict(X)
+            return [label], batch, depth
+
+        if hasattr(self.trial, 'predict_batch'):
+            label, batch = self.predict_batch([X])[0]
+            return [label], batch, None
+
+        return self.trial.predict(X, names, meta), None, None
+
+    # -------------------------------------------------------------------------
+
+    def close(self):
+        if self.batcher is not None:
+            self.batcher.close()
+
+# =============================================================================
+
 class ModelServer(object):
     """
     Model template. You can load your model parameters in __init__ from a location accessible at runtime
+
+    With a `model_memory_gb` budget, the server hosts several versions of the model: requests are
+    routed by the `model_version` tag of their `meta` (defaulting to `model_version`), and versions
+    are loaded on first use and evicted, least recently used first, beyond the budget. With a
+    `local_checkpoint_dir`, versions are loaded from `local_checkpoint_dir/MODEL_NAME/VERSION`
+    instead of being resolved and downloaded through the Determined master.
     """
 
-    def __init__(self, det_master, user, password, model_name, model_version):
+    def __init__(self, det_master, user, password, model_name, model_version,
+                 max_batch_size: int = 1, max_batch_wait_ms: float = 5.0,
+                 checkpoint_cache_dir: str = '/app/checkpoint-cache', checkpoint_cache_gb: float = 10.0,
+                 serving_mode: str = 'eager', request_log_sample_rate: float = 0.1,
+                 model_memory_gb: float = 0.0, local_checkpoint_dir: str = ''):
         logging.info(f"Loading model version '{model_name}/{model_version}' from master at '{det_master}'")
 
         # Credentials to download the checkpoint from the bucket
@@ -30,39 +115,102 @@ class ModelServer(object):
 
         os.environ['SERVING_MODE'] = 'true'
 
+        self.model_name           = model_name
+        self.model_version        = model_version
+        self.max_batch_size       = max_batch_size
+        self.max_batch_wait_ms    = max_batch_wait_ms
+        self.serving_mode         = serving_mode
+        self.local_checkpoint_dir = local_checkpoint_dir
+        self.checkpoint_cache_dir = checkpoint_cache_dir
+
         start = time.time()
-        client = Determined(master=det_master, user=user, password=password)
-        version = self.get_version(client, model_name, model_version)
-        checkpoint = version.checkpoint
-        checkpoint_dir = checkpoint.download()
-        self.model = load_trial_from_checkpoint_path(checkpoint_dir, map_location=torch.device('cpu'))
+        if not local_checkpoint_dir:
+            self.client = Determined(master=det_master, user=user, password=password)
+            self.cache  = CheckpointCache(checkpoint_cache_dir, checkpoint_cache_gb)
+
+        served, hit = self.load_model(model_name, model_version)
+
         end = time.time()
         delta = end - start
-        logging.info(f'Checkpoint loaded in {delta} seconds')
+        logging.info(f"Checkpoint loaded in {delta} seconds (cache {'hit' if hit else 'miss'}, mode {serving_mode})")
+
+        self.manager = None
+        if float(model_memory_gb) > 0:
+            self.manager = ModelManager(lambda key: self.load_model(*key)[0],
+                                        lambda served: served.size_bytes,
+                                        lambda served: served.close(),
+                                        model_memory_gb)
+            self.manager.add((model_name, str(model_version)), served)
+
+        # With a model manager, the default version must not be referenced from here, or its memory
+        # would never be released once it gets evicted
+        self.served = served if self.manager is None else None
+        self.model  = served.trial if self.manager is None else None
+        self.metrics = ServingMetrics(delta, hit)
+        self.request_logger = RequestLogger(request_log_sample_rate)
 
     # -------------------------------------------------------------------------
 
-    def get_version(self, client, model_name, model_version) -> ModelVersion:
+    def load(self):
+        # Called by the Seldon wrapper in every process that serves requests, after the fork
+        setup_async_logging()
 
-        for version in client.get_model(model_name).get_versions():
-            if version.name == model_version:
-                return version
+    # -------------------------------------------------------------------------
 
-        raise AssertionError(f"Version '{model_version}' not found inside model '{model_name}'")
+    def load_model(self, model_name: str, model_version: str) -> Tuple[ServedModel, bool]:
+        """
+        Loads a model version and returns it with whether its checkpoint was already cached.
+        """
+        example_inputs = [torch.zeros(1, 3, 224, 224)]
+
+        if self.local_checkpoint_dir:
+            if any(os.sep in name or name in ('', '.', '..') for name in (model_name, model_version)):
+                raise ValueError(f"Invalid model version '{model_name}/{model_version}'")
+            checkpoint_dir = os.path.join(self.local_checkpoint_dir, model_name, model_version)
+            trial = load_trial_from_checkpoint_path(checkpoint_dir, map_location=torch.device('cpu'))
+            trial.model = optimize_for_serving(trial.model, self.serving_mode, example_inputs, checkpoint_dir)
+            return ServedModel(trial, self.max_batch_size, self.max_batch_wait_ms), True
+
+        index = VersionIndex(self.checkpoint_cache_dir, model_name)
+        uuid = index.resolve(self.client, model_version)
+
+        download = lambda path: self.client.get_checkpoint(uuid).download(path)
+        with self.cache.open(uuid, download) as (checkpoint_dir, hit):
+            trial = load_trial_from_checkpoint_path(checkpoint_dir, map_location=torch.device('cpu'))
+            trial.model = optimize_for_serving(trial.model, self.serving_mode, example_inputs, checkpoint_dir)
+
+        return ServedModel(trial, self.max_batch_size, self.max_batch_wait_ms), hit
+
+    # -------------------------------------------------------------------------
+
+    def route(self, meta: Optional[Dict]) -> ServedModel:
+        if self.manager is None:
+            return self.served
+
+        # Only the version is taken from the request: the model stays the configured one
+        tags = (meta or {}).get('tags') or {}
+        return self.manager.get((self.model_name, str(tags.get('model_version', self.model_version))))
 
     # -------------------------------------------------------------------------
 
     def predict(self, X: Union[np.ndarray, List, str, bytes, Dict], names: Optional[List[str]],
                 meta: Optional[Dict] = None) -> Union[np.ndarray, List, str, bytes, Dict]:
-        logging.info(f"Received request : \n{X}")
+        start = time.perf_counter()
 
         try:
-            prediction = self.model.predict(X, names, meta)
-            logging.info(f"Prediction : {prediction}")
+            prediction, batch, depth = self.route(meta).predict(X, names, meta)
+            self.request_logger.log(X, prediction)
+
+            metrics = []
+            if depth is not None:
+                metrics += self.metrics.queue_depth(depth)
+            if batch is not None:
+                metrics += self.metrics.batch(batch['size'], batch['timings'])
+            metrics += self.metrics.request(time.perf_counter() - start)
 
-            return prediction
+            return SeldonResponse(prediction, metrics=metrics)
         except Exception as e:
-            logging.warning(f"Raised error : {e}")
-            return "???"
+            logging.warning("Raised error : %s (request : %s)", e, summarize(X))
+            return SeldonResponse("???", metrics=self.metrics.error(e))
 
 # =============================================================================
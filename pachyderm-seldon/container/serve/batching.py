@@ -0,0 +1,143 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List, Tuple
+
+# =============================================================================
+
+class BatchingQueue(object):
+    """
+    Groups concurrent requests into a single batched call.
+
+    Each caller submits one item and blocks on its own future. A background thread collects items
+    until either `max_batch_size` items are queued or `max_wait_ms` milliseconds have passed since
+    the first item of the batch arrived, then runs `predict_batch` once and hands each caller the
+    result at its own position.
+
+    The Seldon wrapper forks its REST and gRPC servers after instantiating the model server, and
+    threads do not survive a fork, so the background thread is started lazily by the process that
+    serves the requests.
+    """
+
+    def __init__(self, predict_batch: Callable[[List[Any]], List[Any]], max_batch_size: int, max_wait_ms: float):
+        self.predict_batch  = predict_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait       = max(0.0, float(max_wait_ms)) / 1000.0
+
+        self.requests   = None
+        self.worker_pid = None
+        self.start_lock = threading.Lock()
+        self.closed     = False
+
+        logging.info(f"Batching enabled: max_batch_size={self.max_batch_size}, max_wait_ms={max_wait_ms}")
+
+    # -------------------------------------------------------------------------
+
+    def start(self):
+        with self.start_lock:
+            if self.worker_pid == os.getpid() or self.closed:
+                return
+
+            self.requests   = queue.Queue()
+            self.worker     = threading.Thread(target=self._run, args=(self.requests,), name="batching-queue",
+                                               daemon=True)
+            self.worker.start()
+            self.worker_pid = os.getpid()
+
+    # -------------------------------------------------------------------------
+
+    def submit(self, item: Any) -> Future:
+        if self.worker_pid != os.getpid():
+            self.start()
+
+        future = Future()
+        with self.start_lock:
+            if not self.closed:
+                self.requests.put((item, future))
+                return future
+
+        # The queue was closed while the caller was holding on to it: run the item on its own
+        try:
+            future.set_result(self.predict_batch([item])[0])
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    # -------------------------------------------------------------------------
+
+    def close(self):
+        """
+        Stops the background thread once the items already queued have been processed.
+        """
+        with self.start_lock:
+            self.closed = True
+            if self.worker_pid == os.getpid():
+                self.requests.put(None)
+
+    # -------------------------------------------------------------------------
+
+    def predict(self, item: Any) -> Any:
+        return self.submit(item).result()
+
+    # -------------------------------------------------------------------------
+
+    def depth(self) -> int:
+        return self.requests.qsize() if self.worker_pid == os.getpid() else 0
+
+    # -------------------------------------------------------------------------
+
+    def _collect(self, requests: queue.Queue) -> Tuple[List, bool]:
+        """
+        Returns the next batch and whether the queue was closed.
+        """
+        first = requests.get()
+        if first is None:
+            return [], True
+
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    request = requests.get_nowait()
+                else:
+                    request = requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+
+            if request is None:
+                return batch, True
+            batch.append(request)
+
+        return batch, False
+
+    # -------------------------------------------------------------------------
+
+    def _run(self, requests: queue.Queue):
+        closed = False
+        while not closed:
+            batch, closed = self._collect(requests)
+            if not batch:
+                continue
+
+            items   = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+
+            try:
+                results = self.predict_batch(items)
+                if len(results) != len(items):
+                    raise RuntimeError(f"Batch returned {len(results)} results for {len(items)} inputs")
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+# =============================================================================
@@ -0,0 +1,65 @@
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+
+from request_logging import RequestLogger, setup_async_logging
+
+# =============================================================================
+
+def fake_model(X):
+    return ['dog']
+
+# -----------------------------------------------------------------------------
+
+def predict_unlogged(X):
+    return fake_model(X)
+
+# -----------------------------------------------------------------------------
+
+def predict_full_payload(X):
+    # What ModelServer.predict used to do on every request
+    logging.info(f"Received request : \n{X}")
+    prediction = fake_model(X)
+    logging.info(f"Prediction : {prediction}")
+    return prediction
+
+# -----------------------------------------------------------------------------
+
+def predict_sampled(request_logger):
+    def predict(X):
+        prediction = fake_model(X)
+        request_logger.log(X, prediction)
+        return prediction
+
+    return predict
+
+# =============================================================================
+
+def measure(label, predict, X, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        predict(X)
+    elapsed = (time.perf_counter() - start) / repeat * 1e6
+    print(f"{label:<40} {elapsed:10.1f} us/request")
+
+# =============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Request logging overhead of ModelServer.predict")
+    parser.add_argument("--repeat", type=int, default=2000, help="Requests per scenario")
+    args = parser.parse_args()
+
+    # Log to /dev/null so that the terminal does not dominate the measurements
+    logging.basicConfig(stream=open(os.devnull, "w"), level=logging.INFO)
+    X = np.random.default_rng(0).integers(0, 256, size=(224, 224, 3), dtype=np.uint8)
+
+    measure("logging off", predict_unlogged, X, args.repeat)
+    measure("full payload, synchronous", predict_full_payload, X, args.repeat)
+
+    setup_async_logging()
+    for sample_rate in [1.0, 0.1, 0.01]:
+        measure(f"summary, async, sample rate {sample_rate}", predict_sampled(RequestLogger(sample_rate)), X,
+                args.repeat)
@@ -0,0 +1,92 @@
+import argparse
+import tempfile
+import time
+
+from version_index import VersionIndex
+
+# =============================================================================
+# Synthetic stand-ins for the Determined SDK objects used by the model server
+# =============================================================================
+
+class FakeCheckpoint(object):
+    def __init__(self, uuid):
+        self.uuid = uuid
+
+
+class FakeModelVersion(object):
+    def __init__(self, number):
+        self.model_version = number
+        self.name          = f"job-{number:08d}"
+        self.checkpoint    = FakeCheckpoint(f"checkpoint-{number:08d}")
+
+
+class FakeModel(object):
+    def __init__(self, num_versions, latency):
+        self.num_versions = num_versions
+        self.latency      = latency
+
+    def get_versions(self, order_by=None):
+        # Every call to the master deserializes the full list of versions
+        time.sleep(self.latency * self.num_versions)
+        return [FakeModelVersion(n) for n in range(self.num_versions, 0, -1)]
+
+    def get_version(self, version=0):
+        time.sleep(self.latency)
+        return FakeModelVersion(version or self.num_versions)
+
+
+class FakeDetermined(object):
+    def __init__(self, model):
+        self.model = model
+
+    def get_model(self, name):
+        return self.model
+
+# =============================================================================
+
+def linear_scan(client, model_name, version_name):
+    for version in client.get_model(model_name).get_versions():
+        if version.name == version_name:
+            return version.checkpoint.uuid
+
+    raise AssertionError(f"Version '{version_name}' not found inside model '{model_name}'")
+
+# =============================================================================
+
+def measure(label, fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    elapsed = (time.perf_counter() - start) / repeat * 1000
+    print(f"{label:<36} {elapsed:10.3f} ms")
+
+# =============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Startup cost of model version resolution")
+    parser.add_argument("--versions",   type=int,   default=10000, help="Number of synthetic versions")
+    parser.add_argument("--latency-us", type=float, default=5.0,   help="Simulated master cost per returned version")
+    parser.add_argument("--repeat",     type=int,   default=5,     help="Measurements averaged per scenario")
+    args = parser.parse_args()
+
+    client = FakeDetermined(FakeModel(args.versions, args.latency_us / 1e6))
+    old_version = FakeModelVersion(1).name
+
+    print(f"Resolving versions of a model with {args.versions} versions")
+    measure("linear scan (current version 1)", lambda: linear_scan(client, "model", old_version), args.repeat)
+
+    with tempfile.TemporaryDirectory() as root:
+        def cold():
+            index = VersionIndex(tempfile.mkdtemp(dir=root), "model")
+            index.resolve(client, old_version)
+
+        measure("index, cold start (full build)", cold, args.repeat)
+
+        VersionIndex(root, "model").resolve(client, old_version)
+        measure("index, warm start (persisted)", lambda: VersionIndex(root, "model").resolve(client, old_version),
+                args.repeat)
+
+        client.model.num_versions += 1
+        new_version = FakeModelVersion(client.model.num_versions).name
+        measure("index, newly registered version", lambda: VersionIndex(root, "model").resolve(client, new_version),
+                args.repeat)
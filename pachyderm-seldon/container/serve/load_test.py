@@ -0,0 +1,70 @@
+import argparse
+import threading
+import time
+
+import numpy as np
+from skimage import io
+from ModelServer import ModelServer
+
+# =============================================================================
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Load generator for a locally instantiated ModelServer")
+    parser.add_argument("det_master",          type=str, help="Determined master URL")
+    parser.add_argument("model_name",          type=str, help="Name of the model on Determined")
+    parser.add_argument("model_version",       type=str, help="Name of the model version on Determined")
+    parser.add_argument("--image",             type=str,   default="dog.png", help="Image sent in every request")
+    parser.add_argument("--clients",           type=int,   default=16,  help="Number of concurrent callers")
+    parser.add_argument("--requests",          type=int,   default=50,  help="Requests sent by each caller")
+    parser.add_argument("--max-batch-size",    type=int,   default=8,   help="Batch size used by the batching layer")
+    parser.add_argument("--max-batch-wait-ms", type=float, default=5.0, help="Max wait before a partial batch runs")
+    return parser.parse_args()
+
+# =============================================================================
+
+def run_clients(model, image, clients, requests):
+    latencies = []
+    lock = threading.Lock()
+
+    def client():
+        local = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            model.predict(image, None, None)
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return elapsed, np.array(latencies) * 1000
+
+# =============================================================================
+
+def report(label, elapsed, latencies):
+    print(f"{label:<12} throughput={len(latencies) / elapsed:8.1f} req/s  "
+          f"p50={np.percentile(latencies, 50):8.1f} ms  "
+          f"p99={np.percentile(latencies, 99):8.1f} ms")
+
+# =============================================================================
+
+if __name__ == '__main__':
+    args  = parse_args()
+    image = io.imread(args.image)
+
+    for label, batch_size in [("unbatched", 1), ("batched", args.max_batch_size)]:
+        print(f"Loading model from '{args.det_master}' (max_batch_size={batch_size})")
+        model = ModelServer(args.det_master, 'determined', 'dai', args.model_name, args.model_version,
+                            max_batch_size=batch_size, max_batch_wait_ms=args.max_batch_wait_ms)
+
+        # Warm up so that the first forward pass does not skew the percentiles
+        model.predict(image, None, None)
+
+        elapsed, latencies = run_clients(model, image, args.clients, args.requests)
+        report(label, elapsed, latencies)
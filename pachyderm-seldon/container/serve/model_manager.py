@@ -0,0 +1,137 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List
+
+import torch
+from torch import nn
+
+# =============================================================================
+
+def model_bytes(module: nn.Module) -> int:
+    """
+    Memory used by the tensors of `module`. Goes through the state dict rather than parameters(),
+    so that the packed weights of quantized layers are accounted for too.
+    """
+    def tensor_bytes(value) -> int:
+        if torch.is_tensor(value):
+            return value.numel() * value.element_size()
+        if isinstance(value, (list, tuple)):
+            return sum(tensor_bytes(v) for v in value)
+        return 0
+
+    return sum(tensor_bytes(value) for value in module.state_dict().values())
+
+# =============================================================================
+
+class ModelManager(object):
+    """
+    Keeps the most recently used models in memory, within a memory budget.
+
+    Models are loaded lazily by `load(key)` on first use. Loading happens outside of the manager's
+    lock, so requests for models that are already loaded are not blocked by a slow load, and
+    concurrent requests for the same model wait for a single load. Once a model is loaded, the
+    least recently used models are evicted until the total size (as measured by `size`) fits in the
+    budget again; the model that was just loaded is never evicted, so the peak memory usage can
+    exceed the budget by one model. `close` is called on evicted models. A load that raises is
+    not remembered: the requests waiting for it, and later ones, try to load the model again.
+    """
+
+    def __init__(self, load: Callable[[Hashable], Any], size: Callable[[Any], int],
+                 close: Callable[[Any], None], memory_budget_gb: float):
+        self.load         = load
+        self.size         = size
+        self.close        = close
+        self.budget_bytes = int(float(memory_budget_gb) * 1024 ** 3)
+
+        self.models   = OrderedDict()   # Least recently used first
+        self.sizes    = {}
+        self.loading  = {}
+        self.lock     = threading.Lock()
+
+    # -------------------------------------------------------------------------
+
+    def get(self, key: Hashable) -> Any:
+        while True:
+            with self.lock:
+                if key in self.models:
+                    self.models.move_to_end(key)
+                    return self.models[key]
+                key_lock = self.loading.setdefault(key, threading.Lock())
+
+            with key_lock:
+                with self.lock:
+                    if key in self.models:
+                        self.models.move_to_end(key)
+                        return self.models[key]
+                    if self.loading.get(key) is not key_lock:
+                        # The load this request waited for failed: start over like a new request
+                        continue
+
+                logging.info(f"Loading model {key}")
+                try:
+                    model = self.load(key)
+                    size = self.size(model)
+
+                    with self.lock:
+                        self.models[key] = model
+                        self.sizes[key]  = size
+                        evicted = self._evict(keep=key)
+                finally:
+                    # Also after a failed load, so that the next request for the model tries again
+                    with self.lock:
+                        self.loading.pop(key, None)
+
+            for evicted_key, evicted_model, evicted_size in evicted:
+                logging.info(f"Evicted model {evicted_key} ({evicted_size / 1024 ** 2:.1f} MB)")
+                self.close(evicted_model)
+
+            logging.info(f"Loaded model {key} ({size / 1024 ** 2:.1f} MB), "
+                         f"{len(self.models)} model(s) using {self.total_bytes() / 1024 ** 2:.1f} MB")
+            return model
+
+    # -------------------------------------------------------------------------
+
+    def add(self, key: Hashable, model: Any):
+        """
+        Registers a model that was loaded outside of the manager (i.e. the default one, at startup).
+        """
+        with self.lock:
+            self.models[key] = model
+            self.sizes[key]  = self.size(model)
+            evicted = self._evict(keep=key)
+
+        for _, evicted_model, _ in evicted:
+            self.close(evicted_model)
+
+    # -------------------------------------------------------------------------
+
+    def keys(self) -> List[Hashable]:
+        with self.lock:
+            return list(self.models.keys())
+
+    # -------------------------------------------------------------------------
+
+    def total_bytes(self) -> int:
+        with self.lock:
+            return sum(self.sizes.values())
+
+    # -------------------------------------------------------------------------
+
+    def _evict(self, keep: Hashable) -> List:
+        evicted = []
+        total = sum(self.sizes.values())
+
+        for key in list(self.models.keys()):
+            if total <= self.budget_bytes:
+                break
+            if key == keep:
+                continue
+
+            size = self.sizes.pop(key)
+            total -= size
+            evicted.append((key, self.models.pop(key), size))
+
+        return evicted
+
+# =============================================================================
@@ -0,0 +1,98 @@
+import logging
+import os
+from typing import Sequence
+
+import torch
+from torch import nn
+
+SERVING_MODES = ("eager", "int8", "torchscript", "int8+torchscript")
+
+# =============================================================================
+
+def fuse_conv_bn(model: nn.Module) -> nn.Module:
+    """
+    Folds every BatchNorm2d into the Conv2d registered right before it in the same parent module,
+    which is how torchvision ResNets are laid out (conv1/bn1, conv2/bn2, ..., downsample.0/1).
+    The model must be in eval mode.
+    """
+    for parent in model.modules():
+        names = list(parent._modules.keys())
+        pairs = [[first, second] for first, second in zip(names, names[1:])
+                 if isinstance(parent._modules[first], nn.Conv2d)
+                 and isinstance(parent._modules[second], nn.BatchNorm2d)]
+        if pairs:
+            torch.quantization.fuse_modules(parent, pairs, inplace=True)
+
+    return model
+
+# -----------------------------------------------------------------------------
+
+def convert(model: nn.Module, mode: str, example_inputs: Sequence[torch.Tensor]) -> nn.Module:
+    """
+    Converts an eager CPU model for serving:
+      - int8:        conv/bn fusion, then dynamic int8 quantization of the Linear layers
+      - torchscript: TorchScript tracing with `example_inputs`
+    """
+    model.eval()
+
+    if "int8" in mode:
+        model = fuse_conv_bn(model)
+        model = torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+    if "torchscript" in mode:
+        with torch.no_grad():
+            model = torch.jit.trace(model, tuple(example_inputs), strict=False)
+
+    return model
+
+# -----------------------------------------------------------------------------
+
+def save(model: nn.Module, mode: str, path: str):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    if "torchscript" in mode:
+        torch.jit.save(model, tmp)
+    else:
+        torch.save(model, tmp)
+    os.replace(tmp, path)
+
+# -----------------------------------------------------------------------------
+
+def load(mode: str, path: str) -> nn.Module:
+    if "torchscript" in mode:
+        return torch.jit.load(path, map_location="cpu")
+
+    return torch.load(path, map_location="cpu")
+
+# -----------------------------------------------------------------------------
+
+def optimize_for_serving(model: nn.Module, mode: str, example_inputs: Sequence[torch.Tensor],
+                         artifact_dir: str) -> nn.Module:
+    """
+    Returns `model` converted according to serving `mode`. The converted model is stored in
+    `artifact_dir` (the checkpoint's cache entry), so later starts load it instead of converting again.
+    """
+    if mode not in SERVING_MODES:
+        raise ValueError(f"Unknown serving mode '{mode}', expected one of {SERVING_MODES}")
+
+    if mode == "eager":
+        return model
+
+    path = os.path.join(artifact_dir, f"serving-{mode.replace('+', '-')}.pt")
+    if os.path.exists(path):
+        try:
+            logging.info(f"Loading '{mode}' serving artifact from {path}")
+            return load(mode, path)
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable serving artifact '{path}': {e}")
+
+    logging.info(f"Converting model for serving mode '{mode}'")
+    model = convert(model, mode, example_inputs)
+
+    try:
+        save(model, mode, path)
+    except Exception as e:
+        logging.warning(f"Could not store serving artifact '{path}': {e}")
+
+    return model
+
+# =============================================================================
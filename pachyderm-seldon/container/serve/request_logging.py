@@ -0,0 +1,109 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import zlib
+
+import numpy as np
+
+logger = logging.getLogger("model_server.requests")
+
+# =============================================================================
+
+def summarize(X) -> str:
+    """
+    Short description of a request or response payload: type, shape/length, dtype and a CRC32 of the
+    content, so that identical payloads can be told apart in the logs without printing them.
+    """
+    if isinstance(X, np.ndarray):
+        data = np.ascontiguousarray(X).data
+        return f"ndarray(shape={X.shape}, dtype={X.dtype}, crc32={zlib.crc32(data):08x})"
+
+    if isinstance(X, str) and len(X) <= 32:
+        return repr(X)
+
+    if isinstance(X, (str, bytes)):
+        data = X.encode("utf-8", errors="replace") if isinstance(X, str) else X
+        return f"{type(X).__name__}(len={len(X)}, crc32={zlib.crc32(data):08x})"
+
+    if isinstance(X, dict):
+        return f"dict(keys={sorted(X.keys())})"
+
+    if isinstance(X, (list, tuple)):
+        first = f", first={summarize(X[0])}" if len(X) > 0 else ""
+        return f"{type(X).__name__}(len={len(X)}{first})"
+
+    return type(X).__name__
+
+# =============================================================================
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread. The stock handler formats every
+    record on the calling thread, which is exactly what the request path has to avoid.
+    """
+
+    def prepare(self, record):
+        return record
+
+# -----------------------------------------------------------------------------
+
+_listener     = None
+_listener_pid = None
+
+def setup_async_logging():
+    """
+    Moves the handlers of the root logger behind a queue: the request thread only enqueues records
+    and a background listener formats them and performs the I/O. Safe to call more than once.
+
+    Threads do not survive a fork, so this has to be called by the process that serves the requests
+    (see ModelServer.load).
+    """
+    global _listener, _listener_pid
+
+    if _listener_pid == os.getpid():
+        return
+
+    root = logging.getLogger()
+    if _listener is not None:
+        # Forked from a process that had already set up its listener: reuse its handlers
+        handlers = list(_listener.handlers)
+    else:
+        handlers = root.handlers[:]
+    if not handlers:
+        handlers = [logging.StreamHandler()]
+
+    records = queue.SimpleQueue()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_DeferredQueueHandler(records))
+
+    _listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    _listener.start()
+    _listener_pid = os.getpid()
+    atexit.register(_listener.stop)
+
+# =============================================================================
+
+class RequestLogger(object):
+    """
+    Logs a summary of a sample of the requests and responses going through the model server.
+    """
+
+    def __init__(self, sample_rate: float):
+        self.sample_rate = float(sample_rate)
+
+    # -------------------------------------------------------------------------
+
+    def sampled(self) -> bool:
+        return self.sample_rate >= 1.0 or (self.sample_rate > 0.0 and random.random() < self.sample_rate)
+
+    # -------------------------------------------------------------------------
+
+    def log(self, X, prediction):
+        if self.sampled() and logger.isEnabledFor(logging.INFO):
+            logger.info("Request : %s --> Prediction : %s", summarize(X), summarize(prediction))
+
+# =============================================================================
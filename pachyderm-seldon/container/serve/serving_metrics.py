@@ -0,0 +1,79 @@
+import os
+import threading
+from typing import Dict, List
+
+# =============================================================================
+# Seldon custom metrics: the model server returns them with every response and the Seldon wrapper
+# exposes them on its metrics port (6000, /prometheus), aggregated over all the processes serving
+# requests. TIMER values are given in milliseconds and exposed as histograms in seconds.
+# =============================================================================
+
+def timer(key: str, seconds: float, **tags) -> Dict:
+    return {"type": "TIMER", "key": key, "value": seconds * 1000.0, "tags": tags}
+
+# -----------------------------------------------------------------------------
+
+def counter(key: str, value: float = 1, **tags) -> Dict:
+    return {"type": "COUNTER", "key": key, "value": value, "tags": tags}
+
+# -----------------------------------------------------------------------------
+
+def gauge(key: str, value: float, **tags) -> Dict:
+    return {"type": "GAUGE", "key": key, "value": value, "tags": tags}
+
+# =============================================================================
+
+class ServingMetrics(object):
+    """
+    Builds the custom metrics of a model server:
+      - model_server_checkpoint_load_seconds  (histogram, once per serving process, tagged with cache hit/miss)
+      - model_server_predict_seconds          (histogram, whole predict call)
+      - model_server_<stage>_seconds          (histogram, preprocess/forward/postprocess, once per batch)
+      - model_server_requests, model_server_batches (counters, their ratio is the average batch size)
+      - model_server_batch_size, model_server_queue_depth (gauges)
+      - model_server_errors                   (counter, tagged with the exception type)
+    """
+
+    def __init__(self, checkpoint_load_seconds: float, cache_hit: bool):
+        self.checkpoint_load_seconds = checkpoint_load_seconds
+        self.cache                   = "hit" if cache_hit else "miss"
+        self.reported_pid            = None
+        self.lock                    = threading.Lock()
+
+    # -------------------------------------------------------------------------
+
+    def startup(self) -> List[Dict]:
+        # The checkpoint is loaded before Seldon forks its servers: report it once per serving process
+        with self.lock:
+            if self.reported_pid == os.getpid():
+                return []
+            self.reported_pid = os.getpid()
+
+        return [timer("model_server_checkpoint_load_seconds", self.checkpoint_load_seconds, cache=self.cache)]
+
+    # -------------------------------------------------------------------------
+
+    def request(self, seconds: float) -> List[Dict]:
+        return self.startup() + [
+            counter("model_server_requests"),
+            timer("model_server_predict_seconds", seconds),
+        ]
+
+    # -------------------------------------------------------------------------
+
+    def batch(self, size: int, timings: Dict[str, float]) -> List[Dict]:
+        metrics = [counter("model_server_batches"), gauge("model_server_batch_size", size)]
+        metrics += [timer(f"model_server_{stage}_seconds", seconds) for stage, seconds in timings.items()]
+        return metrics
+
+    # -------------------------------------------------------------------------
+
+    def queue_depth(self, depth: int) -> List[Dict]:
+        return [gauge("model_server_queue_depth", depth)]
+
+    # -------------------------------------------------------------------------
+
+    def error(self, e: Exception) -> List[Dict]:
+        return self.startup() + [counter("model_server_errors", exception=type(e).__name__)]
+
+# =============================================================================
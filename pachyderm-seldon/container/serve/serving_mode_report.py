@@ -0,0 +1,74 @@
+import argparse
+import copy
+import glob
+import os
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from skimage import io
+from ModelServer import ModelServer
+from model_optimizer import SERVING_MODES, convert
+
+# =============================================================================
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Accuracy delta and latency of every serving mode on a held-out batch")
+    parser.add_argument("det_master",    type=str, help="Determined master URL")
+    parser.add_argument("model_name",    type=str, help="Name of the model on Determined")
+    parser.add_argument("model_version", type=str, help="Name of the model version on Determined")
+    parser.add_argument("--images",      type=str, required=True, help="Directory of held-out dog/cat images")
+    parser.add_argument("--batch-size",  type=int, default=64, help="Number of held-out images")
+    parser.add_argument("--repeat",      type=int, default=5,  help="Forward passes averaged per mode")
+    return parser.parse_args()
+
+# =============================================================================
+
+def load_batch(trial, directory, batch_size):
+    files = sorted(glob.glob(os.path.join(directory, "*")))[:batch_size]
+    transform = trial.get_test_transforms()
+
+    images = torch.stack([transform(Image.fromarray(io.imread(f).astype(np.uint8))) for f in files])
+    # Same labelling rule as the training dataset (dog = 0, cat = 1)
+    labels = torch.tensor([0 if "dog" in os.path.basename(f) else 1 for f in files])
+
+    return images, labels
+
+# =============================================================================
+
+def measure(model, images, repeat):
+    with torch.no_grad():
+        output = model(images)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            model(images)
+        elapsed = (time.perf_counter() - start) / repeat
+
+    return output, elapsed
+
+# =============================================================================
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    server = ModelServer(args.det_master, 'determined', 'dai', args.model_name, args.model_version)
+    eager = server.model.model.eval()
+    images, labels = load_batch(server.model, args.images, args.batch_size)
+
+    print(f"Held-out batch of {len(images)} images")
+    print(f"{'mode':<18} {'accuracy':>9} {'delta':>8} {'agreement':>10} {'max |dlogit|':>13} {'latency':>11}")
+
+    reference, _ = measure(eager, images, 1)
+    reference_accuracy = (reference.argmax(dim=1) == labels).float().mean().item()
+
+    for mode in SERVING_MODES:
+        model = convert(copy.deepcopy(eager), mode, [images[:1]])
+        output, elapsed = measure(model, images, args.repeat)
+
+        accuracy  = (output.argmax(dim=1) == labels).float().mean().item()
+        agreement = (output.argmax(dim=1) == reference.argmax(dim=1)).float().mean().item()
+        max_diff  = (output - reference).abs().max().item()
+
+        print(f"{mode:<18} {accuracy:9.4f} {accuracy - reference_accuracy:+8.4f} {agreement:10.4f} "
+              f"{max_diff:13.5f} {elapsed * 1000:8.1f} ms")
@@ -0,0 +1,93 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import torch
+
+import synthetic_trial
+from ModelServer import ModelServer
+
+MODEL_NAME = 'dogs-and-cats'
+
+# =============================================================================
+
+def create_checkpoints(root, versions, size_mb):
+    """
+    Writes one Determined checkpoint of the SyntheticModel trial per version, laid out as
+    `root/MODEL_NAME/VERSION` for ModelServer's `local_checkpoint_dir`, with roughly `size_mb` of weights.
+    """
+    width = int((size_mb * 1024 ** 2 / 4) ** 0.5)
+    for version in versions:
+        checkpoint_dir = os.path.join(root, MODEL_NAME, version)
+        os.makedirs(os.path.join(checkpoint_dir, 'code'))
+        shutil.copy(synthetic_trial.__file__, os.path.join(checkpoint_dir, 'code'))
+
+        hparams = {'width': width, 'version': version}
+        load_data = {'trial_type':        'PyTorchTrial',
+                     'experiment_config': {'hyperparameters': hparams},
+                     'hparams':           hparams,
+                     'trial_cls_spec':    'synthetic_trial:SyntheticModel',
+                     'is_trainer':        False}
+        with open(os.path.join(checkpoint_dir, 'load_data.json'), 'w') as f:
+            json.dump(load_data, f)
+
+        model = synthetic_trial.build_model(width)
+        torch.save({'models_state_dict': [model.state_dict()]}, os.path.join(checkpoint_dir, 'state_dict.pth'))
+
+# =============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Multi-version hosting of ModelServer with a memory budget")
+    parser.add_argument("--versions",  type=int,   default=6,    help="Number of synthetic model versions")
+    parser.add_argument("--size-mb",   type=float, default=16.0, help="Size of each synthetic model")
+    parser.add_argument("--budget-mb", type=float, default=40.0, help="model_memory_gb of the server, in MB")
+    parser.add_argument("--requests",  type=int,   default=500,  help="Number of routed requests")
+    parser.add_argument("--hot",       type=float, default=0.8,  help="Fraction of requests sent to the 2 newest versions")
+    args = parser.parse_args()
+
+    versions = [str(n) for n in range(1, args.versions + 1)]
+    image = np.random.RandomState(0).randint(0, 256, (224, 224, 3), dtype=np.uint8)
+
+    with tempfile.TemporaryDirectory() as root:
+        create_checkpoints(root, versions, args.size_mb)
+
+        # The newest version is the deployed one, loaded at startup
+        server = ModelServer('', '', '', MODEL_NAME, versions[-1],
+                             request_log_sample_rate=0.0, model_memory_gb=args.budget_mb / 1024,
+                             local_checkpoint_dir=root)
+        manager = server.manager
+        rng = random.Random(0)
+        loads, cold, warm = 1, [], []
+
+        for _ in range(args.requests):
+            version = rng.choice(versions[-2:]) if rng.random() < args.hot else rng.choice(versions)
+            # Requests for the deployed version do not need to carry a tag
+            meta = None if version == versions[-1] and rng.random() < 0.5 else {'tags': {'model_version': version}}
+            loaded = (MODEL_NAME, version) in manager.keys()
+
+            start = time.perf_counter()
+            response = server.predict(image, None, meta=meta)
+            (warm if loaded else cold).append(time.perf_counter() - start)
+            loads += not loaded
+
+            assert response.data[0].split('/')[0] == version, f"Request for {version} served {response.data}"
+            assert manager.total_bytes() <= args.budget_mb * 1024 ** 2 or len(manager.keys()) == 1
+
+        print(f"{args.requests} requests over {len(versions)} versions of {args.size_mb} MB, "
+              f"budget {args.budget_mb} MB")
+        print(f"loads: {loads}, resident at the end: {[version for _, version in manager.keys()]} "
+              f"({manager.total_bytes() / 1024 ** 2:.1f} MB)")
+        print(f"cold requests: {len(cold):4d}  mean {1000 * sum(cold) / max(1, len(cold)):8.2f} ms")
+        print(f"warm requests: {len(warm):4d}  mean {1000 * sum(warm) / max(1, len(warm)):8.2f} ms")
+
+        # The model name tag is ignored, and a version that fails to load is not left in progress
+        response = server.predict(image, None, meta={'tags': {'model_name': 'other', 'model_version': versions[0]}})
+        assert response.data[0].split('/')[0] == versions[0], response.data
+        assert server.predict(image, None, meta={'tags': {'model_version': 'missing'}}).data == "???"
+        assert not manager.loading
+
@@ -0,0 +1,70 @@
+import time
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+import torch
+from torch import nn
+from determined.pytorch import PyTorchTrial
+
+# =============================================================================
+
+def build_model(width: int) -> nn.Module:
+    return nn.Sequential(nn.AdaptiveAvgPool2d(8), nn.Flatten(),
+                         nn.Linear(3 * 8 * 8, width), nn.ReLU(),
+                         nn.Linear(width, width), nn.ReLU(),
+                         nn.Linear(width, 2))
+
+# =============================================================================
+
+class SyntheticModel(PyTorchTrial):
+    """
+    Stand-in for the dog/cat trial in synthetic checkpoints (see simulate_model_manager.py): a small
+    MLP with `width` x `width` hidden weights, whose labels are prefixed with the `version` hparam
+    so that a prediction tells which model version served it.
+    """
+
+    def __init__(self, context):
+        self.context = context
+        width = int(self.context.get_hparam("width"))
+
+        self.model = self.context.wrap_model(build_model(width))
+        self.labels = [f"{self.context.get_hparam('version')}/{label}" for label in ['dog', 'cat']]
+
+    # -------------------------------------------------------------------------
+
+    def build_training_data_loader(self):
+        raise NotImplementedError("Synthetic checkpoints are only served")
+
+    def build_validation_data_loader(self):
+        raise NotImplementedError("Synthetic checkpoints are only served")
+
+    def train_batch(self, batch, epoch_idx: int, batch_idx: int):
+        raise NotImplementedError("Synthetic checkpoints are only served")
+
+    # -------------------------------------------------------------------------
+
+    def predict(self,X: np.ndarray, names, meta) -> Union[np.ndarray, List, str, bytes, Dict]:
+        return self.predict_batch([X])
+
+    # -------------------------------------------------------------------------
+
+    def predict_batch(self, images: List[np.ndarray], timings: Optional[Dict[str, float]] = None) -> List[str]:
+        timings = {} if timings is None else timings
+
+        start = time.perf_counter()
+        batch = torch.as_tensor(np.stack(images)).permute(0, 3, 1, 2).float() / 255
+        timings['preprocess'] = time.perf_counter() - start
+
+        self.model.eval()
+        with torch.no_grad():
+            start = time.perf_counter()
+            output = self.model(batch)
+            timings['forward'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        labels = [self.labels[pred] for pred in output.argmax(dim=1).tolist()]
+        timings['postprocess'] = time.perf_counter() - start
+
+        return labels
+
+# =============================================================================
@@ -0,0 +1,116 @@
+import json
+import logging
+import os
+import re
+import time
+from typing import Dict
+
+from determined.experimental import ModelOrderBy
+
+# =============================================================================
+
+class VersionIndex(object):
+    """
+    Persistent name --> (version number, checkpoint UUID) index of the versions of a model.
+
+    The index lives in the checkpoint cache directory, so it survives pod restarts and is shared by
+    the replicas of a node. Versions are never renamed once the training pipeline registers them,
+    which means the index only has to learn about versions newer than the last one it has seen.
+
+    Versions that are not found are not looked up again for `miss_ttl_seconds`: after a miss, the
+    master is not asked about any version missing from the index until then, so that requests for
+    unknown versions cannot list the versions of the model on every call.
+    """
+
+    def __init__(self, root: str, model_name: str, miss_ttl_seconds: float = 30.0):
+        os.makedirs(root, exist_ok=True)
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", model_name)
+
+        self.path       = os.path.join(root, f".versions-{safe_name}.json")
+        self.model_name = model_name
+        self.miss_ttl   = miss_ttl_seconds
+        self.latest     = 0
+        self.missed     = 0.0   # time.time() of the last lookup that did not find its version
+        self.versions: Dict[str, Dict] = {}
+        self.load()
+
+    # -------------------------------------------------------------------------
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, "r") as stream:
+                content = json.load(stream)
+            self.latest   = content["latest"]
+            self.versions = content["versions"]
+            self.missed   = content.get("missed", 0.0)
+        except (ValueError, KeyError) as e:
+            logging.warning(f"Ignoring corrupted version index '{self.path}': {e}")
+
+    # -------------------------------------------------------------------------
+
+    def save(self):
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w") as stream:
+            json.dump({"latest": self.latest, "versions": self.versions, "missed": self.missed}, stream)
+        os.replace(tmp, self.path)
+
+    # -------------------------------------------------------------------------
+
+    def add(self, version):
+        self.versions[version.name] = {
+            "number":     version.model_version,
+            "checkpoint": version.checkpoint.uuid,
+        }
+
+    # -------------------------------------------------------------------------
+
+    def refresh(self, model):
+        """
+        Adds the versions registered after the last indexed one. Versions are listed newest first,
+        so the scan stops as soon as it reaches a version that is already indexed.
+        """
+        latest = self.latest
+
+        for version in model.get_versions(order_by=ModelOrderBy.DESC):
+            if version.model_version <= self.latest:
+                break
+            self.add(version)
+            latest = max(latest, version.model_version)
+
+        logging.info(f"Version index of '{self.model_name}' refreshed: {latest - self.latest} new version(s)")
+        self.latest = latest
+        self.save()
+
+    # -------------------------------------------------------------------------
+
+    def resolve(self, client, version_name: str) -> str:
+        """
+        Returns the checkpoint UUID of version `version_name`. Only talks to the master when the
+        version is not indexed yet, and no lookup missed in the last `miss_ttl_seconds`.
+        """
+        if version_name not in self.versions:
+            if time.time() - self.missed < self.miss_ttl:
+                raise AssertionError(f"Version '{version_name}' not found inside model '{self.model_name}' "
+                                     f"(not looked up again within {self.miss_ttl:.0f} s of a miss)")
+
+            model = client.get_model(self.model_name)
+
+            # Most of the time the requested version is the one that was just registered
+            version = model.get_version()
+            if version is not None and version.name == version_name:
+                self.add(version)
+                self.save()
+            else:
+                self.refresh(model)
+
+        if version_name not in self.versions:
+            self.missed = time.time()
+            self.save()
+            raise AssertionError(f"Version '{version_name}' not found inside model '{self.model_name}'")
+
+        return self.versions[version_name]["checkpoint"]
+
+# =============================================================================
@@ -0,0 +1,230 @@
+import argparse
+import hashlib
+import io
+import os
+import random
+import shutil
+import tempfile
+import time
+import uuid
+from types import SimpleNamespace
+
+from python_pachyderm.proto.v2.pfs.pfs_pb2 import FileType
+
+from data import MANIFEST_NAME, download_commit, download_files
+from dataset_cache import DatasetCache
+
+# =============================================================================
+
+class FakePachydermClient(object):
+    """
+    Serves snapshots of local directories as the commits of a repository, through the subset of the python_pachyderm
+    client used by data.py, with a fixed latency per get_file call and an optional rate of failed calls.
+    """
+
+    def __init__(self, latency_ms=20.0, failure_rate=0.0, seed=0):
+        self.latency      = latency_ms / 1000.0
+        self.failure_rate = failure_rate
+        self.random       = random.Random(seed)
+        self.requests     = 0
+        self.commits      = {}
+        self.head         = None
+        self.work_dir     = tempfile.mkdtemp()
+
+    def commit(self, source_dir):
+        commit_id = uuid.uuid4().hex
+        self.commits[commit_id] = os.path.join(self.work_dir, commit_id)
+        shutil.copytree(source_dir, self.commits[commit_id])
+        self.head = commit_id
+        return commit_id
+
+    def inspect_branch(self, repo, branch):
+        return SimpleNamespace(head=SimpleNamespace(id=self.head))
+
+    def diff_file(self, new_commit, new_path, old_commit=None, old_path=None):
+        new = self._walk(self._resolve(new_commit))
+        old = self._walk(self._resolve(old_commit)) if old_commit is not None else {}
+        missing = self._file_info("", 0, 0, b"")
+
+        for path in sorted(set(new) | set(old)):
+            if path not in new:
+                yield SimpleNamespace(new_file=missing, old_file=self._file_info(path, *old[path]))
+            elif path not in old:
+                yield SimpleNamespace(new_file=self._file_info(path, *new[path]), old_file=missing)
+            elif new[path] != old[path]:
+                yield SimpleNamespace(new_file=self._file_info(path, *new[path]),
+                                      old_file=self._file_info(path, *old[path]))
+
+    def get_file(self, commit, path):
+        self.requests += 1
+        time.sleep(self.latency)
+        if self.random.random() < self.failure_rate:
+            raise ConnectionError(f"Simulated failure while reading {path}")
+        with open(os.path.join(self.commits[self._resolve(commit)], path.lstrip("/")), "rb") as stream:
+            return io.BytesIO(stream.read())
+
+    def close(self):
+        shutil.rmtree(self.work_dir)
+
+    def _resolve(self, commit):
+        return self.head if commit[1] == "master" else commit[1]
+
+    def _walk(self, commit_id):
+        """
+        Returns {path: (file type, size, hash)} for every file and directory of a commit. As in Pachyderm, the hash of
+        a directory changes with its content.
+        """
+        root = self.commits[commit_id]
+        entries = {"/": (FileType.DIR, 0, hashlib.sha256())}
+        for dirpath, dirnames, filenames in os.walk(root):
+            relative = os.path.relpath(dirpath, root)
+            prefix = "/" if relative == "." else f"/{relative}/"
+            for name in dirnames:
+                entries[f"{prefix}{name}/"] = (FileType.DIR, 0, hashlib.sha256())
+            for name in filenames:
+                with open(os.path.join(dirpath, name), "rb") as stream:
+                    content = stream.read()
+                entries[f"{prefix}{name}"] = (FileType.FILE, len(content), hashlib.sha256(content).digest())
+
+        for path, (file_type, _, file_hash) in sorted(entries.items(), reverse=True):
+            parent = path.rstrip("/").rsplit("/", 1)[0] + "/"
+            if path != "/":
+                entries[parent][2].update(path.encode() + (file_hash if file_type == FileType.FILE else file_hash.digest()))
+
+        return {path: (file_type, size, file_hash if file_type == FileType.FILE else file_hash.digest())
+                for path, (file_type, size, file_hash) in entries.items()}
+
+    @staticmethod
+    def _file_info(path, file_type, size_bytes, file_hash):
+        return SimpleNamespace(file=SimpleNamespace(path=path), file_type=file_type, size_bytes=size_bytes,
+                               hash=file_hash)
+
+# =============================================================================
+
+def write_file(path, size, rng):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as stream:
+        stream.write(bytes(rng.getrandbits(8) for _ in range(size)))
+
+# -----------------------------------------------------------------------------
+
+def create_repo(source_dir, files, file_kb):
+    rng = random.Random(0)
+    for i in range(files):
+        write_file(os.path.join(source_dir, "dog" if i % 2 == 0 else "cat", f"{i:05d}.jpg"), file_kb * 1024, rng)
+
+# -----------------------------------------------------------------------------
+
+def change_repo(source_dir, files, file_kb, fraction, generation):
+    """
+    Synthetic commit: changes, removes and adds `fraction` of the files each, and adds a new directory.
+    Every `generation` touches different files.
+    """
+    rng = random.Random(generation + 1)
+    count = max(1, int(files * fraction))
+    for i in range(generation * count * 3, (generation + 1) * count * 3, 3):
+        write_file(os.path.join(source_dir, "dog" if i % 2 == 0 else "cat", f"{i:05d}.jpg"), file_kb * 1024, rng)
+        os.remove(os.path.join(source_dir, "cat" if (i + 1) % 2 else "dog", f"{i + 1:05d}.jpg"))
+    for i in range(files + generation * count, files + (generation + 1) * count):
+        write_file(os.path.join(source_dir, "bird" if i % 3 == 0 else "cat", f"{i:05d}.jpg"), file_kb * 1024, rng)
+
+# -----------------------------------------------------------------------------
+
+def same_tree(source_dir, files):
+    """
+    Whether the downloaded `files` (source path, local path) are exactly the files of `source_dir`.
+    """
+    expected = {}
+    for dirpath, _, filenames in os.walk(source_dir):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            expected["/" + os.path.relpath(path, source_dir)] = path
+
+    if sorted(expected) != sorted(src for src, _ in files):
+        return False
+
+    for src, des in files:
+        with open(expected[src], "rb") as x, open(des, "rb") as y:
+            if x.read() != y.read():
+                return False
+    return True
+
+# -----------------------------------------------------------------------------
+
+def measure(label, fn, client):
+    start = time.perf_counter()
+    requests = client.requests
+    files = fn()
+    elapsed = time.perf_counter() - start
+    print(f">>> {label:<44} {elapsed:7.2f} s, {client.requests - requests:5d} get_file calls, {len(files)} files")
+    return files
+
+# =============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Concurrent, resumed and incremental downloads of a fake Pachyderm repo")
+    parser.add_argument("--files",      type=int,   default=200,  help="Number of files in the repository")
+    parser.add_argument("--file-kb",    type=int,   default=16,   help="Size of each file")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="Simulated latency of every get_file call")
+    parser.add_argument("--workers",    type=int,   default=8,    help="Workers of the concurrent download")
+    parser.add_argument("--changed",    type=float, default=0.05, help="Fraction of the files changed by a new commit")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    client = FakePachydermClient(args.latency_ms)
+    try:
+        source_dir = os.path.join(work_dir, "source")
+        create_repo(source_dir, args.files, args.file_kb)
+        client.commit(source_dir)
+
+        def download(root, workers):
+            return lambda: download_files(client, "repo", "master", root, workers, retries=3)
+
+        measure("serial (1 worker)", download(os.path.join(work_dir, "serial"), 1), client)
+        root = os.path.join(work_dir, "parallel")
+        files = measure(f"concurrent ({args.workers} workers)", download(root, args.workers), client)
+        assert same_tree(source_dir, files)
+
+        # Interrupted download: drop the manifest and half of the files, then resume
+        os.remove(os.path.join(root, MANIFEST_NAME))
+        for i in range(0, args.files, 2):
+            os.remove(os.path.join(root, "dog", f"{i:05d}.jpg"))
+        measure("resumed (half of the files missing)", download(root, args.workers), client)
+        measure("repeated (everything up to date)", download(root, args.workers), client)
+
+        flaky = FakePachydermClient(args.latency_ms, failure_rate=0.05)
+        flaky.commit(source_dir)
+        flaky_root = os.path.join(work_dir, "flaky")
+        files = measure("concurrent, 5% of the get_file calls failing",
+                        lambda: download_files(flaky, "repo", "master", flaky_root, args.workers, 3), flaky)
+        assert same_tree(source_dir, files)
+        flaky.close()
+
+        # Incremental sync through the dataset cache: the first commit is downloaded in full, the next ones only
+        # fetch what changed since the commit synced last
+        cache = DatasetCache(os.path.join(work_dir, "cache"))
+        sync = lambda: download_commit(client, "repo", "master", cache, args.workers, retries=3)
+        measure("cache: first commit", sync, client)
+        measure("cache: same commit again", sync, client)
+
+        change_repo(source_dir, args.files, args.file_kb, args.changed, 0)
+        client.commit(source_dir)
+        files = measure(f"cache: new commit ({args.changed:.0%} changed/added/removed)", sync, client)
+        assert same_tree(source_dir, files)
+
+        full = DatasetCache(os.path.join(work_dir, "full-cache"))
+        measure("no cache: new commit in full", lambda: download_commit(client, "repo", "master", full, args.workers),
+                client)
+
+        # Without the previous commit in the cache, the new one is downloaded in full
+        previous = ("pachyderm", "repo", client.head, "/")
+        cache.release(previous)
+        shutil.rmtree(cache.entry_path(previous))
+        change_repo(source_dir, args.files, args.file_kb, args.changed, 1)
+        client.commit(source_dir)
+        files = measure("cache: previous commit evicted", sync, client)
+        assert same_tree(source_dir, files)
+        print("Downloaded files match the repository")
+    finally:
+        client.close()
+        shutil.rmtree(work_dir)
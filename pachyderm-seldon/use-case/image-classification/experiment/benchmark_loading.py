@@ -0,0 +1,89 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import torch
+from torch import nn
+from torchvision import transforms
+
+from benchmark_shards import create_images
+from data import CatDogDataset
+from loading import LoadingConfig, StepTimer
+
+# =============================================================================
+
+def train_transforms(loading):
+    return transforms.Compose([
+        loading.resize(240),
+        transforms.RandomCrop(224),
+        transforms.RandomHorizontalFlip(),
+        loading.to_tensor(),
+        transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+    ])
+
+# -----------------------------------------------------------------------------
+
+def measure(label, files, loader_config, model, batch_size, epochs):
+    """
+    Trains `model` for `epochs` over the images as the trial does, and reports the samples/s and the share of the
+    step time spent waiting for the next batch.
+    """
+    loading = LoadingConfig({"loader": loader_config})
+    dataset = CatDogDataset(files, transform=train_transforms(loading), decoder=loading.decoder)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True, **loading.loader_kwargs())
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.001)
+    timer = StepTimer()
+
+    wait, compute, samples = 0.0, 0.0, 0
+    start = time.perf_counter()
+    for epoch_idx in range(epochs):
+        for data, labels in loader:
+            # As in train_batch: the step begins once the batch is there
+            timer.begin(epoch_idx)
+            loss = torch.nn.functional.cross_entropy(model(data), labels)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+
+            metrics = timer.end()
+            wait += metrics["data_wait_seconds"]
+            compute += metrics["compute_seconds"]
+            samples += len(labels)
+    elapsed = time.perf_counter() - start
+
+    print(f"{label:<36} {samples / elapsed:7.1f} samples/s, data wait {wait:6.2f} s, compute {compute:6.2f} s "
+          f"({wait / (wait + compute):.0%} waiting)")
+
+# =============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Data wait vs compute of the cat/dog training loop per loader setting")
+    parser.add_argument("--images",     type=int, default=256, help="Number of synthetic JPEG images")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--epochs",     type=int, default=2)
+    parser.add_argument("--workers",    type=int, default=4,   help="DataLoader workers of the parallel settings")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        image_dir = os.path.join(work_dir, "images")
+        os.makedirs(image_dir)
+        files = create_images(image_dir, args.images)
+
+        # A small model, so that the data loading is visible on a CPU
+        model = nn.Sequential(
+            nn.Conv2d(3, 32, kernel_size=7, stride=4), nn.ReLU(),
+            nn.AdaptiveAvgPool2d(1), nn.Flatten(), nn.Linear(32, 2),
+        )
+
+        settings = [
+            ("in process, pil",                      {"num_workers": 0}),
+            (f"{args.workers} workers, pil",         {"num_workers": args.workers}),
+            (f"{args.workers} workers, torchvision", {"num_workers": args.workers, "decoder": "torchvision"}),
+        ]
+        for label, loader_config in settings:
+            measure(label, files, loader_config, model, args.batch_size, args.epochs)
+    finally:
+        shutil.rmtree(work_dir)
@@ -0,0 +1,58 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+
+from preprocessing import TensorPreprocessor
+
+# =============================================================================
+
+def pil_path(images):
+    # What DogCatModel.predict used to do for every request
+    batch = []
+    for X in images:
+        transform = transforms.Compose([
+            transforms.Resize(240),
+            transforms.CenterCrop(224),
+            transforms.ToTensor(),
+            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+        ])
+        batch.append(transform(Image.fromarray(X.astype(np.uint8))))
+    return torch.stack(batch)
+
+# =============================================================================
+
+def measure(label, fn, images, batch_size, repeat):
+    batches = [images[i:i + batch_size] for i in range(0, len(images), batch_size)]
+    for batch in batches[:1]:
+        fn(batch)
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for batch in batches:
+            fn(batch)
+    elapsed = (time.perf_counter() - start) / (repeat * len(images)) * 1000
+    print(f"{label:<36} {elapsed:8.3f} ms/image")
+
+# =============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Per-image preprocessing time of the PIL and tensor paths")
+    parser.add_argument("--images",  type=int, default=64, help="Number of synthetic images")
+    parser.add_argument("--repeat",  type=int, default=3,  help="Measurements averaged per scenario")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    sizes = [(375, 500), (500, 333), (480, 640), (300, 300)]
+    images = [rng.integers(0, 256, size=(*sizes[i % len(sizes)], 3), dtype=np.uint8) for i in range(args.images)]
+
+    preprocessor = TensorPreprocessor()
+    diff = (pil_path(images[:8]) - preprocessor(images[:8])).abs()
+    print(f"Max / mean abs difference with the PIL path: {diff.max().item():.4f} / {diff.mean().item():.5f}")
+
+    measure("PIL path", pil_path, images, 1, args.repeat)
+    for batch_size in [1, 8, 32]:
+        measure(f"tensor path (batch {batch_size})", preprocessor, images, batch_size, args.repeat)
@@ -0,0 +1,99 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+from torchvision import transforms
+
+from data import CatDogDataset, image_label
+from shards import ShardDataset, ShardShuffleSampler, pack_shards
+
+# =============================================================================
+
+def test_transforms():
+    return transforms.Compose([
+        transforms.Resize(240),
+        transforms.CenterCrop(224),
+        transforms.ToTensor(),
+        transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+    ])
+
+# -----------------------------------------------------------------------------
+
+def create_images(image_dir, count):
+    rng = np.random.default_rng(0)
+    sizes = [(375, 500), (500, 333), (480, 640), (300, 300)]
+    files = []
+    for i in range(count):
+        # Smooth images compress like photos, unlike pure noise
+        height, width = sizes[i % len(sizes)]
+        small = rng.integers(0, 256, size=(height // 16, width // 16, 3), dtype=np.uint8)
+        image = Image.fromarray(small).resize((width, height), Image.BILINEAR)
+        files.append(os.path.join(image_dir, f"{'dog' if i % 2 == 0 else 'cat'}.{i:05d}.jpg"))
+        image.save(files[-1], quality=90)
+    return files
+
+# -----------------------------------------------------------------------------
+
+def measure(label, dataset, batch_size, workers, sampler=None):
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=workers, sampler=sampler)
+    start = time.perf_counter()
+    samples = sum(len(labels) for _, labels in loader)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<44} {samples / elapsed:9.1f} samples/s")
+
+# =============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Samples/s of the file-per-sample dataset and of packed shards")
+    parser.add_argument("--images",     type=int, default=512, help="Number of synthetic JPEG images")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--workers",    type=int, default=0,   help="DataLoader workers")
+    parser.add_argument("--no-transforms", action="store_true", help="Measure reading and decoding only")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        image_dir = os.path.join(work_dir, "images")
+        os.makedirs(image_dir)
+        files = create_images(image_dir, args.images)
+
+        for encoding in ["jpeg", "raw"]:
+            start = time.perf_counter()
+            pack_shards([(file, image_label(file)) for file in files], os.path.join(work_dir, encoding), encoding,
+                        shard_size_mb=16)
+            size = sum(os.path.getsize(os.path.join(work_dir, encoding, name))
+                       for name in os.listdir(os.path.join(work_dir, encoding)))
+            print(f"Packed {len(files)} images as {encoding:<4} in {time.perf_counter() - start:.2f} s "
+                  f"({size / 1e6:.1f} MB)")
+
+        transform = test_transforms()
+        files_ds = CatDogDataset(files, transform=transform)
+        jpeg_ds  = ShardDataset(os.path.join(work_dir, "jpeg"), transform)
+        raw_ds   = ShardDataset(os.path.join(work_dir, "raw"), transform)
+
+        for i in [0, 1, len(files) - 1]:
+            expected, label = files_ds[i]
+            for dataset in [jpeg_ds, raw_ds]:
+                image, shard_label = dataset[i]
+                assert label == shard_label and torch.equal(expected, image), f"Sample {i} differs"
+        print("Shard samples match the file-per-sample dataset")
+
+        if args.no_transforms:
+            for dataset in [files_ds, jpeg_ds, raw_ds]:
+                dataset.transform = lambda image: torch.from_numpy(np.asarray(image.convert("RGB"))[:8, :8].copy())
+
+        measure("files (CatDogDataset)", files_ds, args.batch_size, args.workers)
+        measure("jpeg shards, sequential", jpeg_ds, args.batch_size, args.workers)
+        measure("jpeg shards, shard+buffer shuffle", jpeg_ds, args.batch_size, args.workers,
+                ShardShuffleSampler(jpeg_ds, buffer_size=256))
+        measure("raw shards, sequential", raw_ds, args.batch_size, args.workers)
+        measure("raw shards, shard+buffer shuffle", raw_ds, args.batch_size, args.workers,
+                ShardShuffleSampler(raw_ds, buffer_size=256))
+    finally:
+        shutil.rmtree(work_dir)
@@ -1,5 +1,8 @@
+import json
 import os
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import python_pachyderm
 import torch
@@ -8,13 +11,18 @@ from python_pachyderm.proto.v2.pfs.pfs_pb2 import FileType
 from skimage import io
 from torch.utils.data import Dataset
 
+from dataset_cache import DatasetCache
+from loading import decode
+from shards import fingerprint, pack_shards
+
 # ======================================================================================================================
 
 
 class CatDogDataset(Dataset):
-    def __init__(self, files, transform=None):
+    def __init__(self, files, transform=None, decoder="pil"):
         self.files = files
         self.transform = transform
+        self.decoder = decoder
 
     def __len__(self):
         return len(self.files)
@@ -24,50 +32,283 @@ class CatDogDataset(Dataset):
             idx = idx.tolist()
 
         img_path = self.files[idx]
-        image = io.imread(img_path)
-        image = Image.fromarray(image)
+        if self.decoder == "pil":
+            image = io.imread(img_path)
+            image = Image.fromarray(image)
+        else:
+            with open(img_path, "rb") as img_file:
+                image = decode(img_file.read(), self.decoder)
         if self.transform:
             image = self.transform(image)
-        # Create label for image based on file name (dog = 0, cat = 1)
-        label = 0 if "dog" in str(img_path) else 1
-        sample = (image, label)
+        sample = (image, image_label(img_path))
         # print(f"Loaded image: index='{idx}', name='{img_path}'")
         return sample
 
 
+def image_label(img_path):
+    # Create label for image based on file name (dog = 0, cat = 1)
+    return 0 if "dog" in str(img_path) else 1
+
+
+def pack_images(files, cache, encoding):
+    """
+    Packs the image files into shards (see shards.py) once, in the dataset cache, and returns their directory.
+    """
+    key = ("shards", encoding, fingerprint(files))
+    download = lambda path: pack_shards([(file, image_label(file)) for file in files], path, encoding)
+    root, hit = cache.fetch(key, download)
+    print(f"Shards {'found in cache' if hit else 'packed'}: {root}")
+    return root
+
+
 # ======================================================================================================================
 
 
-def download_pach_repo(pachyderm_host, pachyderm_port, repo, branch, root, token):
-    print(f"Starting to download dataset: {repo}@{branch} --> {root}")
+MANIFEST_NAME = ".pachyderm-manifest.json"
 
-    if not os.path.exists(root):
-        os.makedirs(root)
 
+def download_pach_repo(pachyderm_host, pachyderm_port, repo, branch, cache, token, workers=8, retries=3):
+    """
+    Downloads the head commit of `repo@branch` into the dataset cache `cache` (see DatasetCache), unless it is
+    already there. When the commit synced last is still in the cache, only the files that changed since then are
+    downloaded. Returns the list of (source path, local path) of the files of the repository.
+    """
     client = python_pachyderm.Client(host=pachyderm_host, port=pachyderm_port, auth_token=token)
+    return download_commit(client, repo, branch, cache, workers, retries)
+
+
+def download_commit(client, repo, branch, cache, workers=8, retries=3):
+    commit = client.inspect_branch(repo, branch).head.id
+    print(f"Starting to download dataset: {repo}@{branch} (commit {commit}) --> {cache.root}")
+
+    old_commit = load_last_synced_commit(cache, repo)
+    old_key = ("pachyderm", repo, old_commit, "/")
+
+    def download(path):
+        # The previous commit is held so that it cannot be evicted while its files are being linked
+        if old_commit is not None and old_commit != commit and cache.hold(old_key):
+            try:
+                return sync_files(client, repo, old_commit, commit, cache.entry_path(old_key), path, workers, retries)
+            finally:
+                cache.release(old_key)
+        return download_files(client, repo, commit, path, workers, retries)
+
+    root, hit = cache.fetch(("pachyderm", repo, commit, "/"), download, resumable=True)
+    save_last_synced_commit(cache, repo, commit)
+    print(f"Dataset {'found in cache' if hit else 'downloaded'}: {root}")
+
+    return list_files(root)
+
+
+# ======================================================================================================================
+
+
+def download_files(client, repo, commit, root, workers=8, retries=3):
+    """
+    Downloads every file of commit `commit` of `repo` into `root`. Files already present in `root` and unchanged (see
+    fetch_files) are skipped, so that an interrupted download can be resumed.
+    Returns the list of (source path, destination path) of the files of the repository.
+    """
     files = []
+    remote = {}
 
-    for diff in client.diff_file((repo, branch), "/"):
+    for diff in client.diff_file((repo, commit), "/"):
         src_path = diff.new_file.file.path
         des_path = os.path.join(root, src_path[1:])
-        # print(f"Got src='{src_path}', des='{des_path}'")
 
         if diff.new_file.file_type == FileType.FILE:
             if src_path != "":
                 files.append((src_path, des_path))
+                remote[src_path] = (diff.new_file.size_bytes, diff.new_file.hash.hex())
         elif diff.new_file.file_type == FileType.DIR:
-            print(f"Creating dir : {des_path}")
             os.makedirs(des_path, exist_ok=True)
 
-    for src_path, des_path in files:
-        src_file = client.get_file((repo, branch), src_path)
-        # print(f'Downloading {src_path} to {des_path}')
+    # Leftovers of an interrupted download, for files that are not part of the commit
+    for src_path, des_path in list_files(root):
+        if src_path not in remote:
+            os.remove(des_path)
 
-        with open(des_path, "wb") as dest_file:
-            shutil.copyfileobj(src_file, dest_file)
+    fetch_files(client, repo, commit, root, files, remote, load_manifest(root), workers, retries)
 
     print("Download operation ended")
     return files
 
 
+def sync_files(client, repo, old_commit, commit, old_root, root, workers=8, retries=3):
+    """
+    Turns `root` into a copy of commit `commit` of `repo`, starting from `old_root`, a copy of `old_commit`: the files
+    of `old_root` are hard-linked into `root`, the files added or changed since `old_commit` are downloaded and the
+    files removed since then are deleted. Returns the number of bytes downloaded.
+    """
+    manifest = load_manifest(old_root)
+    manifest.update(load_manifest(root))
+    link_files(old_root, root)
+    save_manifest(root, manifest)
+
+    files = []
+    remote = {}
+    removed = 0
+
+    for diff in client.diff_file((repo, commit), "/", (repo, old_commit), "/"):
+        if diff.new_file.file.path == "":
+            src_path = diff.old_file.file.path
+            des_path = os.path.join(root, src_path[1:])
+            if diff.old_file.file_type == FileType.FILE and os.path.exists(des_path):
+                os.remove(des_path)
+                manifest.pop(src_path, None)
+                removed += 1
+            elif diff.old_file.file_type == FileType.DIR:
+                shutil.rmtree(des_path, ignore_errors=True)
+            continue
+
+        src_path = diff.new_file.file.path
+        des_path = os.path.join(root, src_path[1:])
+
+        if diff.new_file.file_type == FileType.FILE:
+            files.append((src_path, des_path))
+            remote[src_path] = (diff.new_file.size_bytes, diff.new_file.hash.hex())
+        elif diff.new_file.file_type == FileType.DIR:
+            os.makedirs(des_path, exist_ok=True)
+
+    downloaded = fetch_files(client, repo, commit, root, files, remote, manifest, workers, retries)
+
+    total = sum(os.path.getsize(des) for _, des in list_files(root))
+    print(
+        f"Incremental sync from commit {old_commit}: {len(files)} file(s) added or changed, {removed} removed, "
+        f"downloaded {downloaded / 1e6:.1f} MB of {total / 1e6:.1f} MB "
+        f"({max(total - downloaded, 0) / 1e6:.1f} MB saved)"
+    )
+    return downloaded
+
+
+def fetch_files(client, repo, commit, root, files, remote, manifest, workers, retries):
+    """
+    Downloads `files` (source path, destination path) with a pool of `workers` threads, retrying each file up to
+    `retries` times, and returns the number of bytes downloaded. `remote` maps source paths to their size and
+    Pachyderm hash, and `manifest` to the hash of the local copy: files that are already present and unchanged are
+    skipped. The manifest is updated and saved inside `root`, even if the download is interrupted.
+    """
+    pending = [(src, des) for src, des in files if not is_up_to_date(des, *remote[src], manifest.get(src))]
+    # Files that are up to date are recorded with their current hash, those that are pending once downloaded
+    pending_paths = set(src for src, _ in pending)
+    for src, _ in files:
+        if src in pending_paths:
+            manifest.pop(src, None)
+        else:
+            manifest[src] = remote[src][1]
+    total_bytes = sum(remote[src][0] for src, _ in pending)
+    print(
+        f"{len(files) - len(pending)} file(s) already up to date, "
+        f"downloading {len(pending)} ({total_bytes / 1e6:.1f} MB)"
+    )
+
+    start = time.time()
+    done_bytes = 0
+    last_report = start
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(download_file, client, repo, commit, src, des, retries): src for src, des in pending
+            }
+            for done, future in enumerate(as_completed(futures), 1):
+                src = futures[future]
+                done_bytes += future.result()
+                manifest[src] = remote[src][1]
+
+                now = time.time()
+                if now - last_report >= 10 or done == len(pending):
+                    last_report = now
+                    print(
+                        f"Downloaded {done}/{len(pending)} files, {done_bytes / 1e6:.1f}/{total_bytes / 1e6:.1f} MB "
+                        f"({done_bytes / 1e6 / max(now - start, 1e-6):.1f} MB/s)"
+                    )
+    finally:
+        save_manifest(root, manifest)
+
+    return done_bytes
+
+
+def download_file(client, repo, commit, src_path, des_path, retries):
+    """Downloads one file through a temporary file, so that a partial download is never taken for a complete one."""
+    tmp_path = f"{des_path}.part"
+    os.makedirs(os.path.dirname(des_path), exist_ok=True)
+
+    for attempt in range(retries + 1):
+        try:
+            src_file = client.get_file((repo, commit), src_path)
+            with open(tmp_path, "wb") as dest_file:
+                shutil.copyfileobj(src_file, dest_file, 1024 * 1024)
+            os.replace(tmp_path, des_path)
+            return os.path.getsize(des_path)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            print(f"Retrying download of {src_path} ({attempt + 1}/{retries}): {e}")
+            time.sleep(0.5 * 2 ** attempt)
+
+
+def link_files(src_root, des_root):
+    """Hard-links the files of `src_root` that are missing from `des_root` (except the cache's own files)."""
+    for src_path, old_path in list_files(src_root):
+        des_path = os.path.join(des_root, src_path[1:])
+        if not os.path.exists(des_path):
+            os.makedirs(os.path.dirname(des_path), exist_ok=True)
+            os.link(old_path, des_path)
+
+
+def list_files(root):
+    files = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            des_path = os.path.join(dirpath, filename)
+            src_path = "/" + os.path.relpath(des_path, root)
+            if src_path not in (f"/{MANIFEST_NAME}", f"/{DatasetCache.COMPLETE_MARKER}"):
+                files.append((src_path, des_path))
+    return files
+
+
+def is_up_to_date(des_path, size, file_hash, known_hash):
+    if not os.path.exists(des_path) or os.path.getsize(des_path) != size:
+        return False
+    # Without a recorded hash (i.e. files copied by hand), only the size is compared
+    return known_hash is None or known_hash == file_hash
+
+
+def load_manifest(root):
+    try:
+        with open(os.path.join(root, MANIFEST_NAME), "r") as stream:
+            return json.load(stream)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(root, manifest):
+    tmp_path = os.path.join(root, f"{MANIFEST_NAME}.tmp")
+    with open(tmp_path, "w") as stream:
+        json.dump(manifest, stream)
+    os.replace(tmp_path, os.path.join(root, MANIFEST_NAME))
+
+
+def load_last_synced_commit(cache, repo):
+    try:
+        with open(last_synced_path(cache, repo), "r") as stream:
+            return json.load(stream)["commit"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def save_last_synced_commit(cache, repo, commit):
+    path = last_synced_path(cache, repo)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as stream:
+        json.dump({"commit": commit}, stream)
+    os.replace(tmp_path, path)
+
+
+def last_synced_path(cache, repo):
+    return os.path.join(cache.root, f".{cache.entry_name(('pachyderm', repo))}.last-sync.json")
+
+
 # ========================================================================================================
@@ -0,0 +1,130 @@
+import io
+import logging
+import time
+from typing import Any, Dict, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+from torchvision.io import ImageReadMode, decode_jpeg
+
+DECODERS = ("pil", "torchvision")
+
+
+class LoadingConfig:
+    """
+    Settings of the training and validation data loaders, read from the `loader` section of the data config:
+
+        loader:
+          num_workers: 4            # decoding and augmentation run in worker processes (0: in the trial's process)
+          pin_memory: true          # page-locked batches, for faster and asynchronous copies to the GPU
+          prefetch_factor: 2        # batches loaded in advance by each worker
+          persistent_workers: true  # keep the workers between epochs instead of forking new ones
+          decoder: pil              # or torchvision: decode_jpeg to uint8 tensors, and tensor transforms
+
+    PIL-SIMD, installed in place of Pillow, speeds up the "pil" decoder without any change.
+    """
+
+    def __init__(self, data_config: Dict[str, Any]):
+        loader = data_config.get("loader") or {}
+        self.num_workers = int(loader.get("num_workers", 4))
+        self.pin_memory = bool(loader.get("pin_memory", torch.cuda.is_available()))
+        self.prefetch_factor = int(loader.get("prefetch_factor", 2))
+        self.persistent_workers = bool(loader.get("persistent_workers", True))
+        self.decoder = loader.get("decoder", "pil")
+
+        if self.decoder not in DECODERS:
+            raise ValueError(f"Unknown decoder '{self.decoder}', expected one of {DECODERS}")
+
+    def loader_kwargs(self) -> Dict[str, Any]:
+        kwargs = {"num_workers": self.num_workers, "pin_memory": self.pin_memory}
+        if self.num_workers > 0:
+            # Only valid with worker processes
+            kwargs["prefetch_factor"] = self.prefetch_factor
+            kwargs["persistent_workers"] = self.persistent_workers
+        return kwargs
+
+    def resize(self, size: int) -> transforms.Resize:
+        if self.decoder == "torchvision":
+            # Tensors are not antialiased by default, unlike PIL images
+            return transforms.Resize(size, antialias=True)
+        return transforms.Resize(size)
+
+    def to_tensor(self):
+        if self.decoder == "torchvision":
+            return transforms.ConvertImageDtype(torch.float32)
+        return transforms.ToTensor()
+
+
+def decode(data: bytes, decoder: str):
+    """
+    Decodes an encoded image into a PIL image, or a uint8 CxHxW tensor with the "torchvision" decoder.
+    """
+    if decoder == "torchvision":
+        return decode_jpeg(torch.frombuffer(bytearray(data), dtype=torch.uint8), mode=ImageReadMode.RGB)
+    return Image.open(io.BytesIO(data))
+
+
+def from_array(array: np.ndarray, decoder: str):
+    """
+    Converts a decoded uint8 HxWxC image into a PIL image, or a CxHxW tensor with the "torchvision" decoder.
+    """
+    if decoder == "torchvision":
+        tensor = torch.from_numpy(np.array(array)).permute(2, 0, 1)
+        return tensor.expand(3, -1, -1) if tensor.shape[0] == 1 else tensor
+    return Image.fromarray(array[:, :, 0] if array.shape[2] == 1 else array)
+
+
+class StepTimer:
+    """
+    Splits the time of every training step between waiting for data (from the end of the previous step) and
+    computing. On GPUs, the end of the step waits for the queued kernels so that they are not counted as data wait.
+    A summary is logged at the end of every epoch.
+    """
+
+    def __init__(self, synchronize: Optional[bool] = None):
+        self.synchronize = torch.cuda.is_available() if synchronize is None else synchronize
+        self.last_end = None
+        self.began = None
+        self.wait = 0.0
+        self.epoch = None
+        self.totals = [0.0, 0.0, 0]
+
+    def begin(self, epoch_idx: int):
+        now = time.perf_counter()
+        self.wait = now - self.last_end if self.last_end is not None else 0.0
+        self.began = now
+
+        if epoch_idx != self.epoch:
+            self.log_epoch()
+            self.epoch = epoch_idx
+            self.totals = [0.0, 0.0, 0]
+
+    def reset(self):
+        """Forgets the end of the previous step, i.e. after a validation that ran in between."""
+        self.last_end = None
+
+    def end(self) -> Dict[str, float]:
+        if self.synchronize:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        compute = now - self.began
+        self.last_end = now
+
+        self.totals[0] += self.wait
+        self.totals[1] += compute
+        self.totals[2] += 1
+        return {
+            "data_wait_seconds": self.wait,
+            "compute_seconds": compute,
+            "data_wait_fraction": self.wait / max(self.wait + compute, 1e-9),
+        }
+
+    def log_epoch(self):
+        wait, compute, steps = self.totals
+        if steps > 0:
+            logging.info(
+                f"Epoch {self.epoch}: {steps} steps, data wait {wait:.1f} s, compute {compute:.1f} s "
+                f"({wait / max(wait + compute, 1e-9):.0%} waiting for data)"
+            )
@@ -1,5 +1,6 @@
 import os
-from typing import Any, Dict, Sequence, Tuple, Union, cast, List
+import time
+from typing import Any, Dict, Sequence, Tuple, Union, cast, List, Optional
 import logging
 
 import torch
@@ -8,9 +9,12 @@ from determined import InvalidHP
 from determined.pytorch import DataLoader, PyTorchTrial
 from torchvision import models, transforms
 import numpy as np
-from PIL import Image
 
-from data import CatDogDataset, download_pach_repo
+from data import CatDogDataset, download_pach_repo, pack_images
+from dataset_cache import DatasetCache
+from loading import LoadingConfig, StepTimer
+from preprocessing import TensorPreprocessor
+from shards import ShardDataset, ShardShuffleSampler
 TorchData = Union[Dict[str, torch.Tensor], Sequence[torch.Tensor], torch.Tensor]
 
 logging.basicConfig()
@@ -21,7 +25,8 @@ logging.getLogger().setLevel(logging.INFO)
 class DogCatModel(PyTorchTrial):
     def __init__(self, context):
         self.context = context
-        self.download_directory = f"/tmp/data-rank{self.context.distributed.get_rank()}"
+        self.loading = LoadingConfig(self.context.get_data_config())
+        self.step_timer = StepTimer()
 
         load_weights = (os.environ.get('SERVING_MODE') != 'true')
         logging.info(f"Loading weights : {load_weights}")
@@ -44,10 +49,12 @@ class DogCatModel(PyTorchTrial):
         self.model = self.context.wrap_model(model)
         self.optimizer = self.context.wrap_optimizer(optimizer)
         self.labels = ['dog', 'cat']
+        self.preprocessor = TensorPreprocessor()
 
     # -------------------------------------------------------------------------
 
     def train_batch(self, batch: TorchData, epoch_idx: int, batch_idx: int) -> Union[torch.Tensor, Dict[str, Any]]:
+        self.step_timer.begin(epoch_idx)
         batch = cast(Tuple[torch.Tensor, torch.Tensor], batch)
         data, labels = batch
 
@@ -57,7 +64,7 @@ class DogCatModel(PyTorchTrial):
         self.context.backward(loss)
         self.context.step_optimizer(self.optimizer)
 
-        return {"loss": loss}
+        return {"loss": loss, **self.step_timer.end()}
 
     # -------------------------------------------------------------------------
 
@@ -66,6 +73,8 @@ class DogCatModel(PyTorchTrial):
         Calculate validation metrics for a batch and return them as a dictionary.
         This method is not necessary if the user overwrites evaluate_full_dataset().
         """
+        # Validation runs between training steps: its time is not data wait
+        self.step_timer.reset()
         batch = cast(Tuple[torch.Tensor, torch.Tensor], batch)
         data, labels = batch
         output = self.model(data)
@@ -77,28 +86,33 @@ class DogCatModel(PyTorchTrial):
     # -------------------------------------------------------------------------
 
     def build_training_data_loader(self) -> DataLoader:
-        return DataLoader(self.train_ds, batch_size=self.context.get_per_slot_batch_size())
+        if isinstance(self.train_ds, ShardDataset):
+            sampler = ShardShuffleSampler(self.train_ds, seed=self.context.get_trial_seed())
+            return DataLoader(self.train_ds, batch_size=self.context.get_per_slot_batch_size(), sampler=sampler,
+                              **self.loading.loader_kwargs())
+        return DataLoader(self.train_ds, batch_size=self.context.get_per_slot_batch_size(),
+                          **self.loading.loader_kwargs())
 
     # -------------------------------------------------------------------------
 
     def build_validation_data_loader(self) -> DataLoader:
-        return DataLoader(self.val_ds, batch_size=self.context.get_per_slot_batch_size())
+        return DataLoader(self.val_ds, batch_size=self.context.get_per_slot_batch_size(),
+                          **self.loading.loader_kwargs())
 
     # -------------------------------------------------------------------------
 
     def download_data(self):
         data_config = self.context.get_data_config()
-        data_dir = os.path.join(self.download_directory, 'data')
 
         files = download_pach_repo(
             data_config['pachyderm']['host'],
             data_config['pachyderm']['port'],
             data_config["pachyderm"]["repo"],
             data_config["pachyderm"]["branch"],
-            data_dir,
-            data_config["pachyderm"]["token"]
+            DatasetCache.from_data_config(data_config),
+            data_config["pachyderm"]["token"],
+            workers=data_config["pachyderm"].get("download_workers", 8)
         )
-        print(f'Data dir set to : {data_dir}')
 
         return [des for src, des in files ]
 
@@ -108,20 +122,32 @@ class DogCatModel(PyTorchTrial):
         print(f"Creating datasets from {len(files)} input files")
         train_size = round(0.81 * len(files))
         val_size   = len(files) - train_size
-        train_ds, val_ds = torch.utils.data.random_split(files, [train_size, val_size])
+        train_ds, val_ds = torch.utils.data.random_split(range(len(files)), [train_size, val_size])
 
-        self.train_ds = CatDogDataset(train_ds, transform=self.get_train_transforms())
-        self.val_ds   = CatDogDataset(val_ds,   transform=self.get_test_transforms())
+        data_config = self.context.get_data_config()
+        encoding = data_config.get("shards")
+        if encoding:
+            # Sorted indices keep the reads in file order, the sampler shuffles the training set
+            root = pack_images(files, DatasetCache.from_data_config(data_config), encoding)
+            self.train_ds = ShardDataset(root, self.get_train_transforms(), sorted(train_ds.indices),
+                                         decoder=self.loading.decoder)
+            self.val_ds   = ShardDataset(root, self.get_test_transforms(), sorted(val_ds.indices),
+                                         decoder=self.loading.decoder)
+        else:
+            self.train_ds = CatDogDataset([files[i] for i in train_ds.indices], transform=self.get_train_transforms(),
+                                          decoder=self.loading.decoder)
+            self.val_ds   = CatDogDataset([files[i] for i in val_ds.indices],   transform=self.get_test_transforms(),
+                                          decoder=self.loading.decoder)
         print(f"Datasets created: train_size={train_size}, val_size={val_size}")
 
     # -------------------------------------------------------------------------
 
     def get_train_transforms(self):
         return transforms.Compose([
-            transforms.Resize(240),
+            self.loading.resize(240),
             transforms.RandomCrop(224),
             transforms.RandomHorizontalFlip(),
-            transforms.ToTensor(),
+            self.loading.to_tensor(),
             transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
         ])
 
@@ -129,27 +155,43 @@ class DogCatModel(PyTorchTrial):
 
     def get_test_transforms(self):
         return transforms.Compose([
-            transforms.Resize(240),
+            self.loading.resize(240),
             transforms.CenterCrop(224),
-            transforms.ToTensor(),
+            self.loading.to_tensor(),
             transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
         ])
 
     # -------------------------------------------------------------------------
 
     def predict(self, X: np.ndarray, names, meta) -> Union[np.ndarray, List, str, bytes, Dict]:
+        return self.predict_batch([X])
+
+    # -------------------------------------------------------------------------
 
-        image = Image.fromarray(X.astype(np.uint8))
-        logging.info(f"Image size : {image.size}")
+    def predict_batch(self, images: List[np.ndarray], timings: Optional[Dict[str, float]] = None) -> List[str]:
+        """
+        Classifies a batch of images. When given, `timings` receives the duration in seconds of the
+        preprocess, forward and postprocess stages.
+        """
+        timings = {} if timings is None else timings
+        logging.debug("Image sizes : %s", [X.shape for X in images])
 
-        image = self.get_test_transforms()(image)
-        image = image.unsqueeze(0)
+        start = time.perf_counter()
+        batch = self.preprocessor(images)
+        timings['preprocess'] = time.perf_counter() - start
 
+        self.model.eval()
         with torch.no_grad():
-            output = self.model(image)[0]
-            pred = np.argmax(output)
-            logging.info(f"Prediction is : {pred}")
+            start = time.perf_counter()
+            output = self.model(batch)
+            timings['forward'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        preds = output.argmax(dim=1).tolist()
+        labels = [self.labels[pred] for pred in preds]
+        timings['postprocess'] = time.perf_counter() - start
+        logging.debug("Predictions are : %s", preds)
 
-        return [self.labels[pred]]
+        return labels
 
 # =============================================================================
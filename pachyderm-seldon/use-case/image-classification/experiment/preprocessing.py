@@ -0,0 +1,60 @@
+from typing import List, Sequence
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# ======================================================================================================================
+
+class TensorPreprocessor(object):
+    """
+    Serving counterpart of DogCatModel.get_test_transforms() working directly on uint8 ndarrays:
+    resize of the shorter side, center crop and normalization, without going through PIL.
+
+    Images can have different sizes, so resizing is done per image. Crops are then stacked and
+    normalized in a single vectorized operation on the whole batch.
+    """
+
+    def __init__(self, resize: int = 240, crop: int = 224,
+                 mean: Sequence[float] = (0.5, 0.5, 0.5), std: Sequence[float] = (0.5, 0.5, 0.5)):
+        self.resize = resize
+        self.crop   = crop
+
+        # ToTensor() + Normalize() folded into a single multiply-add on [0, 255] values
+        std        = torch.tensor(std).view(1, 3, 1, 1)
+        self.scale = 1.0 / (255.0 * std)
+        self.shift = -torch.tensor(mean).view(1, 3, 1, 1) / std
+
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def __call__(self, images: List[np.ndarray]) -> torch.Tensor:
+        batch = torch.stack([self.resize_and_crop(image) for image in images])
+        return batch * self.scale + self.shift
+
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def resize_and_crop(self, image: np.ndarray) -> torch.Tensor:
+        image = np.asarray(image, dtype=np.uint8)
+        if image.ndim == 2:
+            image = np.stack([image] * 3, axis=-1)
+        image = image[..., :3]
+
+        # HWC uint8 --> 1CHW float
+        tensor = torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1).unsqueeze(0).float()
+
+        # Same output size as transforms.Resize(int): the shorter side is resized to `self.resize`
+        height, width = tensor.shape[-2:]
+        if height <= width:
+            size = (self.resize, int(self.resize * width / height))
+        else:
+            size = (int(self.resize * height / width), self.resize)
+
+        tensor = F.interpolate(tensor, size=size, mode='bilinear', align_corners=False, antialias=True)
+
+        # Same offsets as transforms.CenterCrop
+        top  = int(round((size[0] - self.crop) / 2.0))
+        left = int(round((size[1] - self.crop) / 2.0))
+
+        return tensor[0, :, top:top + self.crop, left:left + self.crop].clamp_(0, 255)
+
+# ======================================================================================================================
@@ -0,0 +1,185 @@
+import hashlib
+import json
+import mmap
+import os
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset, Sampler
+
+from loading import decode, from_array
+
+INDEX_NAME = "index.npy"
+META_NAME = "meta.json"
+ENCODINGS = ("jpeg", "raw")
+
+INDEX_DTYPE = np.dtype(
+    [
+        ("shard", np.uint32),
+        ("offset", np.uint64),
+        ("length", np.uint64),
+        ("label", np.int64),
+        ("height", np.uint32),
+        ("width", np.uint32),
+        ("channels", np.uint32),
+    ]
+)
+
+
+def pack_shards(samples: Iterable[Tuple[str, int]], out_dir: str, encoding: str = "jpeg", shard_size_mb: int = 256):
+    """
+    Packs (image path, label) samples into shard files of about `shard_size_mb` each, plus an index of the offset,
+    length and label of every record. With the "jpeg" encoding, the image files are stored as they are and decoded
+    when read; with "raw", they are stored decoded (uint8 HxWxC), which takes more space but no decoding time.
+    """
+    if encoding not in ENCODINGS:
+        raise ValueError(f"Unknown shard encoding '{encoding}', expected one of {ENCODINGS}")
+
+    os.makedirs(out_dir, exist_ok=True)
+    shard_size = shard_size_mb * 1024 * 1024
+    shards = []
+    records = []
+    stream = None
+
+    try:
+        for path, label in samples:
+            if stream is None or stream.tell() >= shard_size:
+                if stream is not None:
+                    stream.close()
+                shards.append(f"shard-{len(shards):05d}.bin")
+                stream = open(os.path.join(out_dir, shards[-1]), "wb")
+
+            if encoding == "jpeg":
+                with open(path, "rb") as image_file:
+                    data = image_file.read()
+                height, width, channels = 0, 0, 0
+            else:
+                image = np.asarray(Image.open(path))
+                image = image[:, :, None] if image.ndim == 2 else image
+                height, width, channels = image.shape
+                data = np.ascontiguousarray(image, dtype=np.uint8).tobytes()
+
+            records.append((len(shards) - 1, stream.tell(), len(data), label, height, width, channels))
+            stream.write(data)
+    finally:
+        if stream is not None:
+            stream.close()
+
+    np.save(os.path.join(out_dir, INDEX_NAME), np.array(records, dtype=INDEX_DTYPE))
+    with open(os.path.join(out_dir, META_NAME), "w") as meta:
+        json.dump({"encoding": encoding, "shards": shards}, meta)
+
+
+def fingerprint(paths: Iterable[str]) -> str:
+    """Identifies a set of files by their paths, sizes and modification times, to key packed shards in a cache."""
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        stat = os.stat(path)
+        digest.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ShardDataset(Dataset):
+    """
+    Reads the samples packed by pack_shards through memory maps of the shard files, so that a sample costs a slice
+    of the page cache instead of opening, reading and closing a file. `indices` restricts the dataset to a subset of
+    the records (i.e. a train/validation split). Use ShardShuffleSampler to read the shards mostly sequentially.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        transform: Optional[Callable] = None,
+        indices: Optional[Sequence[int]] = None,
+        decoder: str = "pil",
+    ):
+        self.root = root
+        self.transform = transform
+        self.decoder = decoder
+
+        with open(os.path.join(root, META_NAME), "r") as stream:
+            meta = json.load(stream)
+        self.encoding = meta["encoding"]
+        self.shard_files = meta["shards"]
+
+        index = np.load(os.path.join(root, INDEX_NAME))
+        self.index = index if indices is None else index[np.asarray(indices, dtype=np.int64)]
+        self.maps = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+
+        shard, offset, length, label, height, width, channels = self.index[idx].tolist()
+        buffer = self._map(shard)
+
+        if self.encoding == "jpeg":
+            image = decode(buffer[offset : offset + length], self.decoder)
+        else:
+            array = np.frombuffer(buffer, dtype=np.uint8, count=length, offset=offset)
+            image = from_array(array.reshape(height, width, channels), self.decoder)
+
+        if self.transform:
+            image = self.transform(image)
+        return image, label
+
+    def locations(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Shard and offset of every record, in dataset order."""
+        return self.index["shard"], self.index["offset"]
+
+    def _map(self, shard: int) -> mmap.mmap:
+        # Opened lazily, so that each DataLoader worker maps the shards it reads on its own
+        if shard not in self.maps:
+            with open(os.path.join(self.root, self.shard_files[shard]), "rb") as stream:
+                self.maps[shard] = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.maps[shard]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["maps"] = {}
+        return state
+
+
+class ShardShuffleSampler(Sampler):
+    """
+    Shuffles at the shard and buffer level: the shards are visited in a random order and their records streamed in
+    file order through a buffer of `buffer_size` records, from which a random one is picked each time. The reads
+    stay close to sequential, while the samples of a batch still come from several regions of the dataset.
+    The order changes with every pass over the dataset and is reproducible given `seed`.
+    """
+
+    def __init__(self, dataset: ShardDataset, buffer_size: int = 1024, seed: int = 0):
+        self.shards, self.offsets = dataset.locations()
+        self.buffer_size = max(1, int(buffer_size))
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.shards)
+
+    def __iter__(self) -> Iterator[int]:
+        rng = np.random.default_rng([self.seed, self.epoch])
+        self.epoch += 1
+
+        # Records in file order within each shard, shards in a random order
+        order = np.lexsort((self.offsets, self.shards))
+        starts = np.searchsorted(self.shards[order], np.unique(self.shards))
+        blocks = np.split(order, starts[1:])
+        stream = np.concatenate([blocks[i] for i in rng.permutation(len(blocks))])
+
+        buffer: List[int] = []
+        for idx in stream.tolist():
+            if len(buffer) < self.buffer_size:
+                buffer.append(idx)
+                continue
+            pick = rng.integers(len(buffer))
+            yield buffer[pick]
+            buffer[pick] = idx
+
+        rng.shuffle(buffer)
+        yield from buffer
@@ -44,6 +44,19 @@ def parse_args():
     parser.add_argument("--detect-bucket-uri", type=str, help="Bucket to use for all detectors")
     parser.add_argument("--detect-batch-size", type=str, help="Batch size to use for all detectors")
     parser.add_argument("--serving-image", type=str, help="Container image to use to serve the model")
+    parser.add_argument(
+        "--serving-mode",
+        type=str,
+        default="eager",
+        choices=["eager", "int8", "torchscript", "int8+torchscript"],
+        help="Conversion applied to the model before serving",
+    )
+    parser.add_argument(
+        "--checkpoint-cache-host-path",
+        type=str,
+        default=None,
+        help="Node directory shared by all replicas to cache downloaded checkpoints",
+    )
     return parser.parse_args()
 
 
@@ -183,6 +196,11 @@ def deploy_model(api_client, args, secrets, det, model):
                                 "value": model.version,
                                 "type": "STRING",
                             },
+                            {
+                                "name": "serving_mode",
+                                "value": args.serving_mode,
+                                "type": "STRING",
+                            },
                         ],
                         "children": [],
                         "logger": {"mode": "all"},
@@ -193,6 +211,18 @@ def deploy_model(api_client, args, secrets, det, model):
         "status": {},
     }
 
+    if args.checkpoint_cache_host_path:
+        pod_spec = mldeployment["spec"]["predictors"][0]["componentSpecs"][0]["spec"]
+        pod_spec["containers"][0]["volumeMounts"].append(
+            {"name": "checkpoint-cache", "mountPath": "/app/checkpoint-cache"}
+        )
+        pod_spec["volumes"].append(
+            {
+                "name": "checkpoint-cache",
+                "hostPath": {"path": args.checkpoint_cache_host_path, "type": "DirectoryOrCreate"},
+            }
+        )
+
     try:
         api_instance.delete_seldon_deployment(args.deploy_name, secrets.namespace)
     except ApiException:
@@ -3,18 +3,20 @@ import os
 import time
 from typing import Dict, List, Optional, Union
 
-import nltk
 import numpy as np
 import torch
-from determined.common.experimental import ModelVersion
 from determined.experimental import Determined
 from determined.pytorch import load_trial_from_checkpoint_path
+from seldon_core.user_model import SeldonResponse
 from transformers import AutoModelForSequenceClassification
 
-from finbert import Config, FinBert, finbert_predict
+from checkpoint_cache import CheckpointCache
+from finbert import WARMUP_TEXT, FinBertPredictor, load_tokenizer
+from model_optimizer import optimize_for_serving
+from request_logging import RequestLogger, setup_async_logging, summarize
+from serving_metrics import ServingMetrics
 from utils import check_model
-
-nltk.download("punkt")
+from version_index import VersionIndex
 
 logging.basicConfig()
 logging.getLogger().setLevel(logging.INFO)
@@ -28,7 +30,18 @@ class ModelServer(object):
     Model template. You can load your model parameters in __init__ from a location accessible at runtime
     """
 
-    def __init__(self, det_master, user, password, model_name, model_version):
+    def __init__(
+        self,
+        det_master,
+        user,
+        password,
+        model_name,
+        model_version,
+        checkpoint_cache_dir: str = "/app/checkpoint-cache",
+        checkpoint_cache_gb: float = 10.0,
+        serving_mode: str = "eager",
+        request_log_sample_rate: float = 0.1,
+    ):
         logging.info(f"Loading model version '{model_name}/{model_version}' from master at '{det_master}'")
 
         # Credentials to download the checkpoint from the bucket
@@ -41,45 +54,68 @@ class ModelServer(object):
 
         start = time.time()
         client = Determined(master=det_master, user=user, password=password)
-        version = self.get_version(client, model_name, model_version)
-        checkpoint = version.checkpoint
-        checkpoint_dir = checkpoint.download()
-        self.trial = load_trial_from_checkpoint_path(checkpoint_dir, map_location=torch.device("cpu"))
-        self.model = self.trial.model
+        index = VersionIndex(checkpoint_cache_dir, model_name)
+        uuid = index.resolve(client, model_version)
+        cache = CheckpointCache(checkpoint_cache_dir, checkpoint_cache_gb)
+
+        with cache.open(uuid, lambda path: client.get_checkpoint(uuid).download(path)) as (checkpoint_dir, hit):
+            # Only the served model is kept: with int8 or TorchScript, the eager one is released once converted
+            model = load_trial_from_checkpoint_path(checkpoint_dir, map_location=torch.device("cpu")).model
+            example_inputs = self.example_inputs(model) if serving_mode != "eager" else None
+            self.model = optimize_for_serving(model, serving_mode, example_inputs, checkpoint_dir)
+            del model
+
         end = time.time()
         delta = end - start
-        logging.info(f"Checkpoint loaded in {delta} seconds")
+        logging.info(f"Checkpoint loaded in {delta} seconds (cache {'hit' if hit else 'miss'}, mode {serving_mode})")
+
+        # Tokenizers and classifier are loaded once and warmed up before the pod reports ready
+        self.predictor = FinBertPredictor(self.model)
+        self.predictor.warmup()
+        self.first_request = True
+        self.request_logger = RequestLogger(request_log_sample_rate)
+        self.metrics = ServingMetrics(delta, hit)
 
     # -------------------------------------------------------------------------
 
-    def get_version(self, client, model_name, model_version) -> ModelVersion:
+    def load(self):
+        # Called by the Seldon wrapper in every process that serves requests, after the fork
+        setup_async_logging()
 
-        for version in client.get_model(model_name).get_versions():
-            if version.name == model_version:
-                return version
+    # -------------------------------------------------------------------------
 
-        raise AssertionError(f"Version '{model_version}' not found inside model '{model_name}'")
+    @staticmethod
+    def example_inputs(model):
+        # Converted models have to return tuples, finbert_predict reads the logits with [0]. Only called when the
+        # model is converted: the eager one keeps its outputs
+        model.config.return_dict = False
+        inputs = load_tokenizer()(WARMUP_TEXT, return_tensors="pt")
+        return [inputs["input_ids"], inputs["attention_mask"], inputs["token_type_ids"]]
 
     # -------------------------------------------------------------------------
 
     def predict(
         self, X: Union[np.ndarray, List, str, bytes, Dict], names: Optional[List[str]], meta: Optional[Dict] = None
     ) -> Union[np.ndarray, List, str, bytes, Dict]:
-        logging.info(f"Received request : {X}")
+        start = time.perf_counter()
 
-        input_string = X[0]
+        try:
+            input_string = X[0]
 
-        logging.info(f"Input string : {input_string}")
-        logging.info(f"Type of Input string : {type(input_string)}")
+            timings = {}
+            result = self.predictor.predict(input_string, timings=timings)
+            elapsed = time.perf_counter() - start
+            if self.first_request:
+                self.first_request = False
+                logging.info(f"First request served in {elapsed:.3f} seconds")
+            self.request_logger.log(X, result)
 
-        try:
-            result = finbert_predict(input_string, self.model)
-            logging.info(f"Prediction type : {type(result)}")
-            logging.info(f"Prediction : {result}")
-            return result
+            # Every sentence of the text is classified in the same request
+            metrics = self.metrics.batch(len(result), timings) + self.metrics.request(elapsed)
+            return SeldonResponse(result, metrics=metrics)
 
         except Exception as e:
-            logging.warning(f"Raised error : {e}")
-            return "???"
+            logging.warning("Raised error : %s (request : %s)", e, summarize(X))
+            return SeldonResponse("???", metrics=self.metrics.error(e))
 
     # =============================================================================
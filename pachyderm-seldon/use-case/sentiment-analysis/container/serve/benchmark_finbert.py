@@ -0,0 +1,99 @@
+import argparse
+import time
+
+import nltk
+import numpy as np
+import pandas as pd
+import torch
+from transformers import AutoModelForSequenceClassification
+
+from finbert import FinBertPredictor, finbert_predict, load_tokenizer
+from utils import InputExample, chunks, convert_examples_to_features, softmax
+
+
+def legacy_finbert_predict(text, model, batch_size=5):
+    """
+    Previous inference path: fixed padding to 64 tokens, features rebuilt through InputFeatures and the model moved
+    to the device for every chunk of 5 sentences.
+    """
+    model.eval()
+    sentences = nltk.tokenize.sent_tokenize(text)
+    label_list = ["positive", "negative", "neutral"]
+    result = []
+    for batch in chunks(sentences, batch_size):
+        examples = [InputExample(str(i), sentence) for i, sentence in enumerate(batch)]
+        features = convert_examples_to_features(examples, label_list, 64, load_tokenizer())
+        all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
+        all_attention_mask = torch.tensor([f.attention_mask for f in features], dtype=torch.long)
+        all_token_type_ids = torch.tensor([f.token_type_ids for f in features], dtype=torch.long)
+        with torch.no_grad():
+            model = model.to("cpu")
+            logits = model(all_input_ids, all_attention_mask, all_token_type_ids)[0]
+            logits = softmax(np.array(logits.cpu()))
+            result.append(np.argmax(logits, axis=1))
+    return result
+
+
+def first_request(label, build, text):
+    """Time from process-level setup (tokenizers, punkt, model placement) to the first response."""
+    start = time.perf_counter()
+    predict = build()
+    ready = time.perf_counter()
+    predict(text)
+    end = time.perf_counter()
+    print(f"{label:<40} setup {ready - start:8.3f} s   first request {(end - ready) * 1000:8.1f} ms")
+
+
+def measure(label, fn, text, num_sentences, repeat):
+    fn(text)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(text)
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{label:<40} {num_sentences / elapsed:10.1f} sentences/sec")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CPU throughput of finbert_predict")
+    parser.add_argument("--csv", type=str, default="../../dataset/sentiment_data/test.csv", help="Sentences to classify")
+    parser.add_argument("--sentences", type=int, default=256, help="Number of sentences per request")
+    parser.add_argument(
+        "--cold", choices=["legacy", "warm"], help="Measure first-request latency of a serving path instead of throughput"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Measurements averaged per scenario")
+    args = parser.parse_args()
+
+    nltk.download("punkt", quiet=True)
+
+    df = pd.read_csv(args.csv, sep="\t", lineterminator="\n")
+    sentences = [str(t).strip().rstrip(".") + "." for t in df["text"][: args.sentences]]
+    text = " ".join(sentences)
+    num_sentences = len(nltk.tokenize.sent_tokenize(text))
+
+    model = AutoModelForSequenceClassification.from_pretrained("bert-base-uncased", num_labels=3)
+
+    # Tokenizers are cached per process, so run each serving path in a fresh process
+    if args.cold == "legacy":
+        first_request("legacy (no warmup)", lambda: lambda t: legacy_finbert_predict(t, model), text)
+        raise SystemExit(0)
+
+    if args.cold == "warm":
+
+        def warm():
+            predictor = FinBertPredictor(model)
+            predictor.warmup()
+            return predictor.predict
+
+        first_request("serving context + warmup", warm, text)
+        raise SystemExit(0)
+
+    print(f"Classifying {num_sentences} sentences on CPU")
+    measure("legacy (fixed 64 tokens, batch 5)", lambda t: legacy_finbert_predict(t, model), text, num_sentences, args.repeat)
+    for batch_size in [8, 32, 64]:
+        measure(
+            f"batched (dynamic padding, batch {batch_size})",
+            lambda t: finbert_predict(t, model, batch_size=batch_size),
+            text,
+            num_sentences,
+            args.repeat,
+        )
@@ -0,0 +1,181 @@
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+from checkpoint_cache import CheckpointCache
+from version_index import VersionIndex
+
+# =============================================================================
+# Fake Determined client standing in for the master: its checkpoints "download" by writing files,
+# and every download leaves a record in `log_dir` so that downloads can be counted across processes
+# =============================================================================
+
+class FakeCheckpoint(object):
+    def __init__(self, uuid, size_bytes, log_dir, delay):
+        self.uuid       = uuid
+        self.size_bytes = size_bytes
+        self.log_dir    = log_dir
+        self.delay      = delay
+
+    def download(self, path):
+        open(os.path.join(self.log_dir, f"{self.uuid}.{os.getpid()}.{time.time_ns()}"), "w").close()
+        os.makedirs(path, exist_ok=True)
+        time.sleep(self.delay)
+        with open(os.path.join(path, "state_dict.pth"), "wb") as stream:
+            stream.write(os.urandom(self.size_bytes))
+        return path
+
+
+class FakeModelVersion(object):
+    def __init__(self, number):
+        self.model_version = number
+        self.name          = f"v{number}"
+        self.checkpoint    = FakeCheckpoint(f"checkpoint-{number}", 0, None, 0)
+
+
+class FakeModel(object):
+    def __init__(self, num_versions):
+        self.num_versions = num_versions
+
+    def get_versions(self, order_by=None):
+        return [FakeModelVersion(n) for n in range(self.num_versions, 0, -1)]
+
+    def get_version(self, version=0):
+        return FakeModelVersion(version or self.num_versions)
+
+
+class FakeDetermined(object):
+    def __init__(self, num_versions, log_dir, size_bytes=1024 ** 2, delay=0.0):
+        self.model      = FakeModel(num_versions)
+        self.log_dir    = log_dir
+        self.size_bytes = size_bytes
+        self.delay      = delay
+
+    def get_model(self, name):
+        return self.model
+
+    def get_checkpoint(self, uuid):
+        return FakeCheckpoint(uuid, self.size_bytes, self.log_dir, self.delay)
+
+# =============================================================================
+
+def downloads(client, uuid=None):
+    return len([name for name in os.listdir(client.log_dir) if uuid is None or name.startswith(f"{uuid}.")])
+
+
+def load(client, cache, version):
+    """What ModelServer does on startup: resolves the version and opens its checkpoint in the cache."""
+    uuid = VersionIndex(cache.root, "model").resolve(client, version)
+    with cache.open(uuid, lambda path: client.get_checkpoint(uuid).download(path)) as (path, hit):
+        assert os.path.getsize(os.path.join(path, "state_dict.pth")) == client.size_bytes
+        return uuid, hit
+
+
+def replica(root, log_dir, version, start, results):
+    client = FakeDetermined(3, log_dir, delay=0.5)
+    while time.time() < start:
+        time.sleep(0.001)
+    try:
+        results.put(load(client, CheckpointCache(root, 1.0), version))
+    except Exception as e:
+        results.put((None, repr(e)))
+
+# =============================================================================
+
+def check_hit_and_miss(root, log_dir):
+    client = FakeDetermined(3, log_dir)
+    cache  = CheckpointCache(root, 1.0)
+
+    assert load(client, cache, "v1") == ("checkpoint-1", False)
+    assert load(client, cache, "v1") == ("checkpoint-1", True)
+    assert load(client, CheckpointCache(root, 1.0), "v1") == ("checkpoint-1", True), "Restarted pod missed"
+    assert downloads(client) == 1
+    print("hit/miss: downloaded once, then hit from the same and from a new cache")
+
+
+def check_lru_eviction(root, log_dir):
+    # Room for two 1 MB checkpoints
+    client = FakeDetermined(3, log_dir)
+    cache  = CheckpointCache(root, 2.5 / 1024)
+
+    load(client, cache, "v1")
+    load(client, cache, "v2")
+    time.sleep(0.01)
+    assert load(client, cache, "v1")[1], "v1 should still be cached"
+    time.sleep(0.01)
+    load(client, cache, "v3")
+
+    assert cache.contains("checkpoint-1") and cache.contains("checkpoint-3")
+    assert not cache.contains("checkpoint-2"), "The least recently used checkpoint was not evicted"
+    assert load(client, cache, "v2") == ("checkpoint-2", False)
+    assert not cache.contains("checkpoint-1")
+    print("LRU eviction: the least recently used checkpoint is evicted beyond the budget")
+
+
+def check_in_use(root, log_dir):
+    # Room for a single checkpoint, but v1 is in use while v2 is loaded
+    client = FakeDetermined(2, log_dir)
+    cache  = CheckpointCache(root, 1.5 / 1024)
+
+    download = lambda uuid: lambda path: client.get_checkpoint(uuid).download(path)
+    with cache.open("checkpoint-1", download("checkpoint-1")):
+        with cache.open("checkpoint-2", download("checkpoint-2")):
+            pass
+        assert cache.contains("checkpoint-1"), "A checkpoint in use was evicted"
+    cache.evict()
+    assert cache.contains("checkpoint-1") != cache.contains("checkpoint-2")
+    print("eviction skips the checkpoints in use")
+
+
+def check_failed_download(root, log_dir):
+    client = FakeDetermined(1, log_dir)
+    cache  = CheckpointCache(root, 1.0)
+
+    def failing(path):
+        client.get_checkpoint("checkpoint-1").download(path)
+        raise IOError("Connection reset")
+
+    try:
+        with cache.open("checkpoint-1", failing):
+            raise AssertionError("A failed download was yielded")
+    except IOError:
+        pass
+    assert not cache.contains("checkpoint-1")
+    assert [name for name in os.listdir(root) if name.startswith(".tmp-")] == [], "Partial download left behind"
+    assert load(client, cache, "v1") == ("checkpoint-1", False)
+    print("failed download: nothing cached, nothing left behind, next load downloads again")
+
+
+def check_concurrent_replicas(root, log_dir, replicas):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    start   = time.time() + 2.0
+    processes = [context.Process(target=replica, args=(root, log_dir, "v2", start, results))
+                 for _ in range(replicas)]
+    for process in processes:
+        process.start()
+    outcomes = [results.get(timeout=60) for _ in processes]
+    for process in processes:
+        process.join()
+
+    assert all(uuid == "checkpoint-2" for uuid, _ in outcomes), f"Replicas failed: {outcomes}"
+    assert sorted(hit for _, hit in outcomes) == [False] + [True] * (replicas - 1), outcomes
+    assert downloads(FakeDetermined(3, log_dir), "checkpoint-2") == 1, "Replicas downloaded the checkpoint twice"
+    print(f"{replicas} concurrent replicas: one download, shared by the others")
+
+# =============================================================================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Checks of CheckpointCache against a fake Determined client")
+    parser.add_argument("--replicas", type=int, default=4, help="Concurrent replicas of the sharing check")
+    args = parser.parse_args()
+
+    checks = [check_hit_and_miss, check_lru_eviction, check_in_use, check_failed_download,
+              lambda root, log_dir: check_concurrent_replicas(root, log_dir, args.replicas)]
+    for check in checks:
+        with tempfile.TemporaryDirectory() as root, tempfile.TemporaryDirectory() as log_dir:
+            check(root, log_dir)
+
+    print("CheckpointCache checks passed")
@@ -0,0 +1,138 @@
+import contextlib
+import fcntl
+import logging
+import os
+import shutil
+from typing import Callable, Iterator, List, Tuple
+
+# =============================================================================
+
+class CheckpointCache(object):
+    """
+    Content-addressed cache of downloaded checkpoints (checkpoint UUID --> local directory).
+
+    The cache directory can be shared by every replica running on the same node (i.e. a hostPath
+    volume): downloads go to a temporary directory that is atomically renamed once complete, a
+    lock file per checkpoint makes sure that only one replica downloads a given checkpoint, and
+    the least recently used checkpoints are evicted once the cache grows beyond `max_size_gb`.
+    """
+
+    COMPLETE_MARKER = ".complete"
+
+    def __init__(self, root: str, max_size_gb: float):
+        self.root           = root
+        self.max_size_bytes = int(float(max_size_gb) * 1024 ** 3)
+        os.makedirs(self.root, exist_ok=True)
+
+    # -------------------------------------------------------------------------
+
+    def entry_path(self, uuid: str) -> str:
+        return os.path.join(self.root, uuid)
+
+    # -------------------------------------------------------------------------
+
+    def contains(self, uuid: str) -> bool:
+        return os.path.exists(os.path.join(self.entry_path(uuid), self.COMPLETE_MARKER))
+
+    # -------------------------------------------------------------------------
+
+    @contextlib.contextmanager
+    def open(self, uuid: str, download: Callable[[str], None]) -> Iterator[Tuple[str, bool]]:
+        """
+        Yields the local directory of checkpoint `uuid` and whether it was a cache hit, calling
+        `download(path)` on a cache miss. The entry cannot be evicted while the caller is using it.
+        """
+        entry = self.entry_path(uuid)
+
+        with self._lock(uuid) as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            hit = self.contains(uuid)
+            if hit:
+                logging.info(f"Checkpoint cache hit: {uuid}")
+                os.utime(os.path.join(entry, self.COMPLETE_MARKER))
+            else:
+                logging.info(f"Checkpoint cache miss: {uuid}. Downloading to {entry}")
+                self._download(uuid, download)
+
+            # Downgrade to a shared lock so other replicas can load the same checkpoint concurrently
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            yield entry, hit
+
+        self.evict(keep=uuid)
+
+    # -------------------------------------------------------------------------
+
+    def evict(self, keep: str = None):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+
+        for uuid, size, _ in entries:
+            if total <= self.max_size_bytes:
+                break
+            if uuid == keep:
+                continue
+
+            with self._lock(uuid) as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Another replica is using this checkpoint right now
+                    continue
+
+                logging.info(f"Evicting checkpoint {uuid} ({size / 1024 ** 2:.1f} MB) from cache")
+                shutil.rmtree(self.entry_path(uuid), ignore_errors=True)
+                total -= size
+
+    # -------------------------------------------------------------------------
+
+    def _download(self, uuid: str, download: Callable[[str], None]):
+        entry = self.entry_path(uuid)
+        tmp = os.path.join(self.root, f".tmp-{uuid}-{os.getpid()}")
+
+        shutil.rmtree(tmp, ignore_errors=True)
+        shutil.rmtree(entry, ignore_errors=True)
+
+        try:
+            download(tmp)
+            with open(os.path.join(tmp, self.COMPLETE_MARKER), "w"):
+                pass
+            os.rename(tmp, entry)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+    # -------------------------------------------------------------------------
+
+    @contextlib.contextmanager
+    def _lock(self, uuid: str):
+        with open(os.path.join(self.root, f".{uuid}.lock"), "a") as lock:
+            try:
+                yield lock
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    # -------------------------------------------------------------------------
+
+    def _entries(self) -> List[Tuple[str, int, float]]:
+        """
+        Returns (uuid, size in bytes, last access time) for every complete entry, least recently used first.
+        """
+        entries = []
+
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            marker = os.path.join(path, self.COMPLETE_MARKER)
+            if name.startswith(".") or not os.path.exists(marker):
+                continue
+
+            size = 0
+            for dirpath, _, filenames in os.walk(path):
+                for filename in filenames:
+                    size += os.path.getsize(os.path.join(dirpath, filename))
+
+            entries.append((name, size, os.path.getmtime(marker)))
+
+        return sorted(entries, key=lambda entry: entry[2])
+
+# =============================================================================
@@ -1,11 +1,13 @@
 from __future__ import absolute_import, division, print_function
 
+import functools
 import logging
 import random
+import time
 
 import numpy as np
 import pandas as pd
-from nltk.tokenize import sent_tokenize
+import nltk
 from torch.nn import CrossEntropyLoss, MSELoss
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
 from tqdm import tqdm_notebook as tqdm
@@ -17,7 +19,28 @@ from utils import *
 
 logger = logging.getLogger(__name__)
 
-tokenizer = AutoTokenizer.from_pretrained("bert-base-uncased")
+PUNKT_RESOURCE = "tokenizers/punkt/english.pickle"
+WARMUP_TEXT = "Operating profit rose to EUR 13.1 mn from EUR 8.7 mn. Net sales decreased compared to last year."
+
+
+@functools.lru_cache(maxsize=None)
+def load_tokenizer(base_model="bert-base-uncased"):
+    """Loads the word piece tokenizer of `base_model` once per process."""
+    return AutoTokenizer.from_pretrained(base_model)
+
+
+@functools.lru_cache(maxsize=None)
+def load_sentence_tokenizer(resource=PUNKT_RESOURCE):
+    """
+    Loads the punkt sentence tokenizer once per process. The model is looked up in the NLTK data path (baked into the
+    serving image) and is only downloaded when it is missing.
+    """
+    try:
+        return nltk.data.load(resource)
+    except LookupError:
+        logger.warning(f"NLTK resource '{resource}' not found locally, downloading punkt")
+        nltk.download("punkt", quiet=True)
+        return nltk.data.load(resource)
 
 
 class Config(object):
@@ -615,7 +638,19 @@ class FinBert(object):
         return evaluation_df
 
 
-def finbert_predict(text, model, write_to_csv=False, path=None, use_gpu=False, gpu_name="cuda:0", batch_size=5):
+def finbert_predict(
+    text,
+    model,
+    write_to_csv=False,
+    path=None,
+    use_gpu=False,
+    gpu_name="cuda:0",
+    batch_size=32,
+    max_seq_length=64,
+    tokenizer=None,
+    sentence_tokenizer=None,
+    timings=None,
+):
     """
     Predict sentiments of sentences in a given text. The function first tokenizes sentences, make predictions and write
     results.
@@ -633,48 +668,133 @@ def finbert_predict(text, model, write_to_csv=False, path=None, use_gpu=False, g
     gpu_name: (optional): string
         multi-gpu support: allows specifying which gpu to use
     batch_size: (optional): int
-        size of batching chunks
+        number of sentences per forward pass
+    max_seq_length: (optional): int
+        sentences longer than this number of tokens are truncated
+    tokenizer: (optional): PreTrainedTokenizer
+        word piece tokenizer, defaults to the one of bert-base-uncased
+    sentence_tokenizer: (optional): PunktSentenceTokenizer
+        sentence splitter, defaults to the english punkt model
+    timings: (optional): dict
+        receives the time in seconds spent in the preprocess (sentence splitting and tokenization), forward and
+        postprocess stages
+    Returns
+    -------
+    result: list
+        one [sentence, prediction, sentiment_score] entry per sentence, in the order they appear in the text
     """
     model.eval()
 
-    sentences = sent_tokenize(text)
+    tokenizer = tokenizer or load_tokenizer()
+    sentence_tokenizer = sentence_tokenizer or load_sentence_tokenizer()
+    timings = {} if timings is None else timings
+    timings.update(preprocess=0.0, forward=0.0, postprocess=0.0)
+
+    start = time.perf_counter()
+    sentences = sentence_tokenizer.tokenize(text)
+    timings["preprocess"] += time.perf_counter() - start
 
     device = gpu_name if use_gpu and torch.cuda.is_available() else "cpu"
     logging.info("Using device: %s " % device)
+    model = model.to(device)
+
     label_list = ["positive", "negative", "neutral"]
-    label_dict = {0: "positive", 1: "negative", 2: "neutral"}
-    result = pd.DataFrame(columns=["sentence", "logit", "prediction", "sentiment_score"])
-    for batch in chunks(sentences, batch_size):
-        examples = [InputExample(str(i), sentence) for i, sentence in enumerate(batch)]
-
-        features = convert_examples_to_features(examples, label_list, 64, tokenizer)
-        all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long).to(device)
-        all_attention_mask = torch.tensor([f.attention_mask for f in features], dtype=torch.long).to(device)
-        all_token_type_ids = torch.tensor([f.token_type_ids for f in features], dtype=torch.long).to(device)
-        with torch.no_grad():
-            model = model.to(device)
-
-            logits = model(all_input_ids, all_attention_mask, all_token_type_ids)[0]
-            logging.info(logits)
-            logits = softmax(np.array(logits.cpu()))
-            sentiment_score = pd.Series(logits[:, 0] - logits[:, 1])
-            predictions = np.squeeze(np.argmax(logits, axis=1))
-
-            batch_result = {
-                "sentence": batch,
-                "logit": list(logits),
-                "prediction": predictions,
-                "sentiment_score": sentiment_score,
-            }
-
-            return_list = [str(batch[0]), str(predictions), str(sentiment_score[0])]
-
-            # batch_result = pd.DataFrame(batch_result)
-            # result = pd.concat([result, batch_result], ignore_index=True)
-
-    # result["prediction"] = result.prediction.apply(lambda x: label_dict[x])
-    # if write_to_csv:
-    #    result.to_csv(path, sep=",", index=False)
-
-    # Returning batch_result to get dict for Seldon (original was to return pd.DataFrame)
-    return return_list
+    logits = np.zeros((len(sentences), len(label_list)), dtype=np.float32)
+
+    # Batch sentences of similar length together so that padding to the longest one stays cheap
+    order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]))
+
+    with torch.no_grad():
+        for batch in chunks(order, batch_size):
+            start = time.perf_counter()
+            inputs = tokenizer(
+                [sentences[i] for i in batch],
+                padding="longest",
+                truncation=True,
+                max_length=max_seq_length,
+                return_tensors="pt",
+            )
+            timings["preprocess"] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            batch_logits = model(
+                inputs["input_ids"].to(device),
+                inputs["attention_mask"].to(device),
+                inputs["token_type_ids"].to(device),
+            )[0]
+            logits[batch] = batch_logits.cpu().numpy()
+            timings["forward"] += time.perf_counter() - start
+
+    start = time.perf_counter()
+    probabilities = softmax(logits)
+    predictions = np.argmax(probabilities, axis=1)
+    sentiment_scores = probabilities[:, 0] - probabilities[:, 1]
+
+    result = [
+        [sentence, label_list[prediction], float(score)]
+        for sentence, prediction, score in zip(sentences, predictions, sentiment_scores)
+    ]
+    timings["postprocess"] += time.perf_counter() - start
+    if write_to_csv:
+        pd.DataFrame(result, columns=["sentence", "prediction", "sentiment_score"]).to_csv(path, sep=",", index=False)
+
+    return result
+
+
+class FinBertPredictor(object):
+    """
+    Warm serving context for FinBERT: the word piece tokenizer, the punkt sentence tokenizer and the classifier are
+    loaded once and reused by every request.
+    """
+
+    def __init__(self, model, base_model="bert-base-uncased", use_gpu=False, gpu_name="cuda:0", batch_size=32):
+        """
+        Parameters
+        ----------
+        model: BertForSequenceClassification
+            the fine-tuned classifier
+        base_model: str
+            name of the pretrained model whose tokenizer is used
+        use_gpu: bool
+            enables inference on GPU
+        gpu_name: str
+            multi-gpu support: allows specifying which gpu to use
+        batch_size: int
+            number of sentences per forward pass
+        """
+        self.tokenizer = load_tokenizer(base_model)
+        self.sentence_tokenizer = load_sentence_tokenizer()
+        self.device = gpu_name if use_gpu and torch.cuda.is_available() else "cpu"
+        self.model = model.to(self.device)
+        self.model.eval()
+        self.use_gpu = use_gpu
+        self.gpu_name = gpu_name
+        self.batch_size = batch_size
+
+    def predict(self, text, write_to_csv=False, path=None, timings=None):
+        return finbert_predict(
+            text,
+            self.model,
+            write_to_csv=write_to_csv,
+            path=path,
+            use_gpu=self.use_gpu,
+            gpu_name=self.gpu_name,
+            batch_size=self.batch_size,
+            tokenizer=self.tokenizer,
+            sentence_tokenizer=self.sentence_tokenizer,
+            timings=timings,
+        )
+
+    def warmup(self, text=WARMUP_TEXT, iterations=2):
+        """
+        Runs dummy requests so that lazy initialization (thread pools, kernel selection, allocator growth) does not
+        happen on the first real request. Returns the latency of the first dummy request in seconds.
+        """
+        first = None
+        for _ in range(iterations):
+            start = time.perf_counter()
+            self.predict(text)
+            elapsed = time.perf_counter() - start
+            first = elapsed if first is None else first
+        logger.info(f"FinBERT warmup done, first dummy request took {first:.3f} seconds")
+        return first
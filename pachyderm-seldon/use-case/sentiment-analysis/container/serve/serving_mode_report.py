@@ -0,0 +1,72 @@
+import argparse
+import copy
+import time
+
+import pandas as pd
+import torch
+
+from finbert import load_tokenizer
+from model_optimizer import SERVING_MODES, convert
+from ModelServer import ModelServer
+
+LABELS = ["positive", "negative", "neutral"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Accuracy delta and latency of every serving mode on a held-out batch")
+    parser.add_argument("det_master", type=str, help="Determined master URL")
+    parser.add_argument("model_name", type=str, help="Name of the model on Determined")
+    parser.add_argument("model_version", type=str, help="Name of the model version on Determined")
+    parser.add_argument("--csv", type=str, default="../../dataset/sentiment_data/test.csv", help="Held-out sentences")
+    parser.add_argument("--batch-size", type=int, default=64, help="Number of held-out sentences")
+    parser.add_argument("--repeat", type=int, default=5, help="Forward passes averaged per mode")
+    return parser.parse_args()
+
+
+def load_batch(path, batch_size):
+    df = pd.read_csv(path, sep="\t", lineterminator="\n").head(batch_size)
+    inputs = load_tokenizer()(
+        [str(text) for text in df["text"]], padding="longest", truncation=True, max_length=64, return_tensors="pt"
+    )
+    labels = torch.tensor([LABELS.index(label.strip()) for label in df["label"]])
+    return [inputs["input_ids"], inputs["attention_mask"], inputs["token_type_ids"]], labels
+
+
+def measure(model, inputs, repeat):
+    with torch.no_grad():
+        logits = model(*inputs)[0]
+        start = time.perf_counter()
+        for _ in range(repeat):
+            model(*inputs)
+        elapsed = (time.perf_counter() - start) / repeat
+    return logits, elapsed
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    server = ModelServer(args.det_master, "determined", "dai", args.model_name, args.model_version)
+    eager = server.model.eval()
+    inputs, labels = load_batch(args.csv, args.batch_size)
+
+    print(f"Held-out batch of {len(labels)} sentences")
+    print(f"{'mode':<18} {'accuracy':>9} {'delta':>8} {'agreement':>10} {'max |dlogit|':>13} {'latency':>11}")
+
+    reference, _ = measure(eager, inputs, 1)
+    reference_accuracy = (reference.argmax(dim=1) == labels).float().mean().item()
+
+    for mode in SERVING_MODES:
+        # As ModelServer converts them: traced on a single sentence rather than on the timed batch, since serving pads
+        # every request to its own longest sentence, and returning tuples rather than dicts
+        model = copy.deepcopy(eager)
+        model = convert(model, mode, ModelServer.example_inputs(model) if mode != "eager" else None)
+        logits, elapsed = measure(model, inputs, args.repeat)
+
+        accuracy = (logits.argmax(dim=1) == labels).float().mean().item()
+        agreement = (logits.argmax(dim=1) == reference.argmax(dim=1)).float().mean().item()
+        max_diff = (logits - reference).abs().max().item()
+
+        print(
+            f"{mode:<18} {accuracy:9.4f} {accuracy - reference_accuracy:+8.4f} {agreement:10.4f} "
+            f"{max_diff:13.5f} {elapsed * 1000:8.1f} ms"
+        )
@@ -18,6 +18,7 @@ from transformers.optimization import AdamW, get_linear_schedule_with_warmup
 
 import constants
 import data
+from dataset_cache import DatasetCache
 
 TorchData = Union[Dict[str, torch.Tensor], Sequence[torch.Tensor], torch.Tensor]
 
@@ -150,16 +151,15 @@ class FinBERTPyTorch(PyTorchTrial):
 
     def download_data(self):
         data_config = self.context.get_data_config()
-        data_dir = os.path.join(self.download_directory, "data")
 
         files = data.download_pach_repo(
             data_config["pachyderm"]["host"],
             data_config["pachyderm"]["port"],
             data_config["pachyderm"]["repo"],
             data_config["pachyderm"]["branch"],
-            data_dir,
+            DatasetCache.from_data_config(data_config),
             data_config["pachyderm"]["token"],
+            workers=data_config["pachyderm"].get("download_workers", 8),
         )
-        print(f"Data dir set to : {data_dir}")
 
         return [des for src, des in files]
@@ -0,0 +1,139 @@
+"""
+Per-sample latency and epoch time of VOCDeltaDataset on a synthetic VOC table, compared to reading every sample
+the way the dataset used to: one-row table slice converted to Python, and the annotation XML parsed again.
+"""
+import argparse
+import io
+import os
+import shutil
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import torch
+from PIL import Image
+
+from data import ANNOTATION_INDEX, VOCDeltaDataset
+
+
+class RowDataset(VOCDeltaDataset):
+    """The previous __getitem__ of VOCDeltaDataset, without the transfer to the GPU."""
+
+    def __getitem__(self, idx):
+        example = self.table.slice(idx, 1).to_pydict()
+        img = Image.open(io.BytesIO(example['image'][0])).convert('RGB')
+        if self.transforms is not None:
+            img = self.transforms(img)
+        return img, self.target(example)
+
+    def target(self, example):
+        anno_dict = self.parse_voc_xml(ET.fromstring(example['annotations'][0]))
+
+        labels = []
+        boxes = []
+        for obj in anno_dict['annotation']['object']:
+            labels.append(self.name2number[obj['name']])
+            bb = obj['bndbox']
+            boxes.append([float(bb["xmin"]), float(bb["ymin"]), float(bb["xmax"]), float(bb["ymax"])])
+
+        boxes = torch.as_tensor(boxes, dtype=torch.float32)
+        labels = torch.as_tensor(labels, dtype=torch.int64)
+        return {'labels': labels, 'boxes': boxes}
+
+
+def voc_annotation(rng, class_names, width, height):
+    objects = []
+    for _ in range(rng.integers(1, 8)):
+        xmin, ymin = rng.integers(0, width // 2), rng.integers(0, height // 2)
+        xmax, ymax = rng.integers(xmin + 1, width), rng.integers(ymin + 1, height)
+        objects.append(
+            f"<object><name>{class_names[rng.integers(len(class_names))]}</name><pose>Unspecified</pose>"
+            f"<truncated>0</truncated><difficult>0</difficult><bndbox><xmin>{xmin}</xmin><ymin>{ymin}</ymin>"
+            f"<xmax>{xmax}</xmax><ymax>{ymax}</ymax></bndbox></object>")
+    return (f"<annotation><folder>VOC2012</folder><filename>image.jpg</filename><size><width>{width}</width>"
+            f"<height>{height}</height><depth>3</depth></size><segmented>0</segmented>{''.join(objects)}</annotation>")
+
+
+def create_table(table_dir, images, files):
+    """Writes a VOC table like the one of spark/voc_to_delta.ipynb, split into `files` Parquet files."""
+    rng = np.random.default_rng(0)
+    class_names = ["aeroplane", "bicycle", "bird", "boat", "bottle", "bus", "car", "cat", "chair", "cow",
+                   "diningtable", "dog", "horse", "motorbike", "person", "pottedplant", "sheep", "sofa", "train",
+                   "tvmonitor"]
+    os.makedirs(os.path.join(table_dir, "_delta_log"))
+
+    rows = {"key": [], "image": [], "annotations": []}
+    for i in range(images):
+        width, height = 500, 375
+        small = rng.integers(0, 256, size=(height // 16, width // 16, 3), dtype=np.uint8)
+        stream = io.BytesIO()
+        Image.fromarray(small).resize((width, height), Image.BILINEAR).save(stream, format="JPEG", quality=90)
+        rows["key"].append(f"v1/JPEGImages/{i:06d}.jpg")
+        rows["image"].append(stream.getvalue())
+        rows["annotations"].append(voc_annotation(rng, class_names, width, height))
+
+    table = pa.table(rows)
+    per_file = -(-images // files)
+    for i in range(files):
+        # Small row groups, so that the table is read back in several chunks
+        pq.write_table(table.slice(i * per_file, per_file), os.path.join(table_dir, f"part-{i:05d}.parquet"),
+                       row_group_size=64)
+
+
+def measure(label, get, count):
+    start = time.perf_counter()
+    latencies = []
+    for i in range(count):
+        sample_start = time.perf_counter()
+        get(i)
+        latencies.append(time.perf_counter() - sample_start)
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000
+    print(f"{label:<38} epoch {elapsed:6.2f} s, per sample: median {np.median(latencies):6.3f} ms, "
+          f"p99 {np.percentile(latencies, 99):6.3f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Per-sample latency and epoch time of VOCDeltaDataset")
+    parser.add_argument("--images", type=int, default=1000, help="Number of synthetic images in the table")
+    parser.add_argument("--files", type=int, default=4, help="Number of Parquet files of the table")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        table_dir = os.path.join(work_dir, "train")
+        create_table(table_dir, args.images, args.files)
+
+        start = time.perf_counter()
+        dataset = VOCDeltaDataset(table_dir)
+        print(f"Annotation index built in {time.perf_counter() - start:.2f} s")
+        start = time.perf_counter()
+        dataset = VOCDeltaDataset(table_dir)
+        print(f"Annotation index loaded in {time.perf_counter() - start:.2f} s "
+              f"({os.path.getsize(os.path.join(table_dir, ANNOTATION_INDEX)) / 1024:.0f} kB)")
+        rows = RowDataset(table_dir)
+
+        for i in range(len(dataset)):
+            image, target = dataset[i]
+            expected_image, expected_target = rows[i]
+            assert torch.equal(image, expected_image), f"Image {i} differs"
+            assert torch.equal(target["boxes"], expected_target["boxes"]), f"Boxes of image {i} differ"
+            assert torch.equal(target["labels"], expected_target["labels"]), f"Labels of image {i} differ"
+        print("Samples match the row-by-row dataset")
+
+        # Everything but the image decode, then full samples without and with the ToTensor transform of the trial
+        count = len(dataset)
+        measure("row slice + XML parse, targets", lambda i: rows.target(rows.table.slice(i, 1).to_pydict()), count)
+        measure("columnar index, targets", lambda i: (
+            torch.tensor(dataset.boxes[dataset.offsets[i]:dataset.offsets[i + 1]]),
+            torch.tensor(dataset.labels[dataset.offsets[i]:dataset.offsets[i + 1]])), count)
+        for transforms in [None, dataset.transforms]:
+            suffix = "" if transforms else ", no transform"
+            rows.transforms = dataset.transforms = transforms
+            measure(f"row slice + XML parse{suffix}", rows.__getitem__, count)
+            measure(f"columnar index{suffix}", dataset.__getitem__, count)
+    finally:
+        shutil.rmtree(work_dir)
@@ -0,0 +1,175 @@
+"""
+Materializes versions of a synthetic Delta table through download_version, from a local directory served as an S3
+bucket, and compares the files and download requests with a full replay of the log.
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from data import DELTA_LOG, download_version
+from dataset_cache import DatasetCache
+
+
+class LocalS3Client:
+    """
+    Serves the subdirectories of `root` as S3 buckets, through the subset of the boto3 client used by data.py, with
+    a fixed latency per request.
+    """
+
+    def __init__(self, root, latency_ms=20.0):
+        self.root = root
+        self.latency = latency_ms / 1000.0
+        self.downloads = 0
+        self.lock = threading.Lock()
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        time.sleep(self.latency)
+        bucket_dir = os.path.join(self.root, Bucket)
+        keys = []
+        for dirpath, _, filenames in os.walk(bucket_dir):
+            for name in filenames:
+                key = os.path.relpath(os.path.join(dirpath, name), bucket_dir)
+                if key.startswith(Prefix):
+                    keys.append(key)
+        yield {'Contents': [{'Key': key} for key in sorted(keys)]}
+
+    def download_file(self, Bucket, Key, Filename):
+        time.sleep(self.latency)
+        with self.lock:
+            self.downloads += 1
+        shutil.copyfile(os.path.join(self.root, Bucket, Key), Filename)
+
+
+class DeltaTableWriter:
+    """Writes the commits and checkpoints of a Delta table, with random bytes in place of the Parquet data files."""
+
+    def __init__(self, table_dir, file_kb):
+        self.table_dir = table_dir
+        self.file_kb = file_kb
+        self.version = -1
+        self.checkpoint_version = None
+        self.active = set()
+        os.makedirs(os.path.join(table_dir, DELTA_LOG))
+
+    def commit(self, adds, removes=0):
+        self.version += 1
+        actions = [{'commitInfo': {'timestamp': int(time.time() * 1000), 'operation': 'WRITE'}}]
+        if self.version == 0:
+            actions.append({'protocol': {'minReaderVersion': 1, 'minWriterVersion': 2}})
+            actions.append({'metaData': {'id': str(uuid.uuid4()), 'format': {'provider': 'parquet'}}})
+        for path in sorted(self.active)[:removes]:
+            self.active.remove(path)
+            actions.append({'remove': {'path': path, 'dataChange': True}})
+        for _ in range(adds):
+            path = f'part-{len(self.active):05d}-{uuid.uuid4()}.c000.snappy.parquet'
+            with open(os.path.join(self.table_dir, path), 'wb') as f:
+                f.write(os.urandom(self.file_kb * 1024))
+            self.active.add(path)
+            actions.append({'add': {'path': path, 'size': self.file_kb * 1024, 'dataChange': True}})
+
+        with open(os.path.join(self.table_dir, DELTA_LOG, f'{self.version:020d}.json'), 'w') as f:
+            f.write('\n'.join(json.dumps(action) for action in actions) + '\n')
+
+    def checkpoint(self):
+        """Writes a single-file checkpoint of the current version: one row per active file, plus the metadata."""
+        add_type = pa.struct([('path', pa.string()), ('size', pa.int64()), ('dataChange', pa.bool_())])
+        meta_type = pa.struct([('id', pa.string())])
+        adds = [{'path': path, 'size': self.file_kb * 1024, 'dataChange': False} for path in sorted(self.active)]
+        table = pa.table({
+            'add': pa.array([None] + adds, type=add_type),
+            'metaData': pa.array([{'id': 'table'}] + [None] * len(adds), type=meta_type),
+        })
+        pq.write_table(table, os.path.join(self.table_dir, DELTA_LOG, f'{self.version:020d}.checkpoint.parquet'))
+        with open(os.path.join(self.table_dir, DELTA_LOG, '_last_checkpoint'), 'w') as f:
+            json.dump({'version': self.version, 'size': len(adds) + 1}, f)
+        self.checkpoint_version = self.version
+
+
+def full_replay(table_dir, version):
+    """Active data files of `version`, replaying every commit from the first one as download_version used to."""
+    files = set()
+    for v in range(version + 1):
+        with open(os.path.join(table_dir, DELTA_LOG, f'{v:020d}.json')) as f:
+            for line in f:
+                info = json.loads(line)
+                if 'add' in info:
+                    files.add(info['add']['path'])
+                if 'remove' in info:
+                    files.remove(info['remove']['path'])
+    return files
+
+
+def data_files(table_dir):
+    return {name for name in os.listdir(table_dir) if name.endswith('.parquet')}
+
+
+def measure(label, s3, fn):
+    downloads = s3.downloads
+    start = time.perf_counter()
+    path = fn()
+    print(f">>> {label:<48} {time.perf_counter() - start:6.2f} s, {s3.downloads - downloads:4d} downloads")
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Cached, concurrent materialization of Delta table versions")
+    parser.add_argument('--files', type=int, default=200, help="Data files added by the first commit")
+    parser.add_argument('--file-kb', type=int, default=64)
+    parser.add_argument('--commits', type=int, default=12, help="Commits after the first one, 5 files added each")
+    parser.add_argument('--latency-ms', type=float, default=20.0, help="Simulated latency of every S3 request")
+    parser.add_argument('--workers', type=int, default=8)
+    args = parser.parse_args()
+    if args.commits < 1:
+        parser.error("--commits must be at least 1, to materialize a version and the next one")
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        table_dir = os.path.join(work_dir, 's3', 'bucket', 'train')
+        writer = DeltaTableWriter(table_dir, args.file_kb)
+        writer.commit(args.files)
+        for _ in range(args.commits):
+            writer.commit(5, removes=1)
+            if writer.version % 10 == 0:
+                writer.checkpoint()
+
+        s3 = LocalS3Client(os.path.join(work_dir, 's3'), args.latency_ms)
+        version = writer.version - 1
+        serial = DatasetCache(os.path.join(work_dir, 'serial'))
+        measure(f"version {version}, 1 worker", s3, lambda: download_version('train', 'bucket', version, serial, 1, s3))
+
+        cache = DatasetCache(os.path.join(work_dir, 'cache'))
+        path = measure(f"version {version}, {args.workers} workers", s3,
+                       lambda: download_version('train', 'bucket', version, cache, args.workers, s3))
+        assert data_files(path) == full_replay(table_dir, version)
+
+        measure(f"version {version} again (cached)", s3,
+                lambda: download_version('train', 'bucket', version, cache, args.workers, s3))
+        path = measure(f"version {version + 1} (only the new files)", s3,
+                       lambda: download_version('train', 'bucket', version + 1, cache, args.workers, s3))
+        assert data_files(path) == full_replay(table_dir, version + 1)
+
+        # Once the log is cleaned up before the checkpoint, the versions after it are still replayed from it
+        if writer.checkpoint_version is None:
+            print("No checkpoint with fewer than 10 commits, the log is not cleaned up")
+        else:
+            for v in range(writer.checkpoint_version):
+                os.remove(os.path.join(table_dir, DELTA_LOG, f'{v:020d}.json'))
+            cleaned = DatasetCache(os.path.join(work_dir, 'cleaned'))
+            path = measure(f"version {version + 1}, log cleaned up to the checkpoint", s3,
+                           lambda: download_version('train', 'bucket', version + 1, cleaned, args.workers, s3))
+            assert data_files(path) == writer.active
+        print("Materialized versions match a full replay of the log")
+    finally:
+        shutil.rmtree(work_dir)
@@ -0,0 +1,198 @@
+"""
+Equivalence checks and timings of the detection metrics of utils.py against the original, loop-based versions,
+on random Faster R-CNN-like outputs: 100 predictions per image, some of them jittered copies of the targets.
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+import torchvision
+
+from utils import APAccumulator, ap_per_class, get_batch_statistics
+
+
+def reference_batch_statistics(outputs, targets, iou_threshold=0.5):
+    """The original get_batch_statistics: one box_iou call per predicted box."""
+    batch_metrics = []
+    for output, target in zip(outputs, targets):
+        if output is None:
+            continue
+        pred_boxes = output['boxes']
+        pred_scores = output['scores']
+        pred_labels = output['labels']
+        true_positives = np.zeros(pred_boxes.shape[0])
+        num_target_boxes = len(target['labels'])
+        if num_target_boxes > 0:
+            detected_boxes = []
+            target_boxes = target['boxes']
+            for pred_i, (pred_box, pred_label) in enumerate(zip(pred_boxes, pred_labels)):
+                if len(detected_boxes) == num_target_boxes:
+                    break
+                if pred_label not in target['labels']:
+                    continue
+                ious = torchvision.ops.box_iou(target_boxes, pred_box.unsqueeze(0)).cpu().numpy()
+                box_index = np.argmax(ious)
+                iou = np.max(ious)
+                if iou >= iou_threshold and box_index not in detected_boxes:
+                    true_positives[pred_i] = 1
+                    detected_boxes += [box_index]
+        batch_metrics.append([true_positives, pred_scores.cpu().numpy(), pred_labels.cpu().numpy(),
+                              target['labels'].cpu().numpy()])
+    return batch_metrics
+
+
+def reference_ap_per_class(tp, conf, pred_cls, target_cls):
+    """The original ap_per_class: a boolean mask over all the predictions per class."""
+    i = np.argsort(-conf)
+    tp, conf, pred_cls = tp[i], conf[i], pred_cls[i]
+    unique_classes = np.unique(target_cls)
+    ap, p, r = [], [], []
+    for c in unique_classes:
+        i = pred_cls == c
+        n_gt = (target_cls == c).sum()
+        n_p = i.sum()
+        if n_p == 0 and n_gt == 0:
+            continue
+        elif n_p == 0 or n_gt == 0:
+            ap.append(0)
+            r.append(0)
+            p.append(0)
+        else:
+            fpc = (1 - tp[i]).cumsum()
+            tpc = (tp[i]).cumsum()
+            recall_curve = tpc / (n_gt + 1e-16)
+            r.append(recall_curve[-1])
+            precision_curve = tpc / (tpc + fpc)
+            p.append(precision_curve[-1])
+            ap.append(reference_compute_ap(recall_curve, precision_curve))
+    p, r, ap = np.array(p), np.array(r), np.array(ap)
+    f1 = 2 * p * r / (p + r + 1e-16)
+    return p, r, ap, f1, unique_classes.astype("int32")
+
+
+def reference_compute_ap(recall, precision):
+    """The original compute_ap: the precision envelope in a Python loop."""
+    mrec = np.concatenate(([0.0], recall, [1.0]))
+    mpre = np.concatenate(([0.0], precision, [0.0]))
+    for i in range(mpre.size - 1, 0, -1):
+        mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+    i = np.where(mrec[1:] != mrec[:-1])[0]
+    return np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
+
+
+def random_predictions(rng, count, classes=20, batch=100):
+    """Per-image statistics as returned by get_batch_statistics, with tied scores and classes without predictions."""
+    batch_metrics = []
+    for start in range(0, count, batch):
+        size = min(batch, count - start)
+        tp = (rng.random(size) < 0.3).astype(np.float64)
+        conf = (np.round(rng.random(size), 3)).astype(np.float32)
+        pred_cls = rng.integers(1, classes - 2, size=size)
+        target_cls = rng.integers(1, classes + 1, size=int(rng.integers(0, 12)))
+        batch_metrics.append([tp, conf, pred_cls, target_cls])
+    return batch_metrics
+
+
+def same_ap(expected, actual):
+    # Values only: the original returns integer arrays when no class has any prediction
+    return all(np.array_equal(x, y) for x, y in zip(expected, actual))
+
+
+def random_boxes(rng, count, size=500):
+    xy = rng.uniform(0, size * 0.8, size=(count, 2))
+    wh = rng.uniform(5, size * 0.4, size=(count, 2))
+    return np.concatenate([xy, xy + wh], axis=1)
+
+
+def random_batch(rng, images, predictions, classes=20):
+    outputs, targets = [], []
+    for _ in range(images):
+        num_targets = rng.integers(0, 12)
+        target_boxes = random_boxes(rng, num_targets)
+        target_labels = rng.integers(0, classes, size=num_targets)
+        if num_targets > 0 and rng.random() < 0.1:
+            target_boxes[0, 2:] = target_boxes[0, :2]
+
+        boxes = random_boxes(rng, predictions)
+        labels = rng.integers(0, classes, size=predictions)
+        if num_targets > 0:
+            # Jittered copies of the targets, some with their label, and some exact duplicates (tied IoUs)
+            copies = rng.random(predictions) < 0.4
+            source = rng.integers(0, num_targets, size=predictions)
+            jitter = rng.normal(0, 8, size=(predictions, 4)) * (rng.random((predictions, 1)) < 0.8)
+            boxes[copies] = target_boxes[source[copies]] + jitter[copies]
+            boxes[:, 2:] = np.maximum(boxes[:, 2:], boxes[:, :2] + 1)
+            keep_label = copies & (rng.random(predictions) < 0.7)
+            labels[keep_label] = target_labels[source[keep_label]]
+        # A few degenerate boxes: their IoU with a degenerate target is NaN
+        degenerate = rng.random(predictions) < 0.02
+        boxes[degenerate, 2:] = boxes[degenerate, :2]
+        scores = np.sort(rng.random(predictions))[::-1].copy()
+
+        outputs.append({'boxes': torch.as_tensor(boxes, dtype=torch.float32),
+                        'scores': torch.as_tensor(scores, dtype=torch.float32),
+                        'labels': torch.as_tensor(labels, dtype=torch.int64)})
+        targets.append({'boxes': torch.as_tensor(target_boxes, dtype=torch.float32).reshape(-1, 4),
+                        'labels': torch.as_tensor(target_labels, dtype=torch.int64)})
+    return outputs, targets
+
+
+def same_statistics(expected, actual):
+    return len(expected) == len(actual) and all(
+        all(np.array_equal(x, y) for x, y in zip(e, a)) for e, a in zip(expected, actual))
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Vectorized detection metrics against the original loops")
+    parser.add_argument('--images', type=int, default=500, help="Images of the matching benchmark")
+    parser.add_argument('--predictions', type=int, default=100, help="Predictions per image")
+    parser.add_argument('--trials', type=int, default=200, help="Random batches of the equivalence checks")
+    parser.add_argument('--ap-predictions', type=int, default=1000000, help="Predictions of the AP benchmark")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for trial in range(args.trials):
+        outputs, targets = random_batch(rng, int(rng.integers(1, 5)), int(rng.integers(0, 60)))
+        for threshold in [0.0, 0.5, 0.9]:
+            assert same_statistics(reference_batch_statistics(outputs, targets, threshold),
+                                   get_batch_statistics(outputs, targets, threshold)), f"Batch {trial} differs"
+    print(f"get_batch_statistics matches the per-box loop on {args.trials} random batches")
+
+    for trial in range(args.trials):
+        batch_metrics = random_predictions(rng, int(rng.integers(1, 3000)))
+        expected = reference_ap_per_class(*[np.concatenate(x, 0) for x in zip(*batch_metrics)])
+        assert same_ap(expected, ap_per_class(*[np.concatenate(x, 0) for x in zip(*batch_metrics)])), trial
+        accumulator = APAccumulator(capacity=64)
+        accumulator.update(batch_metrics)
+        assert same_ap(expected, accumulator.compute()), trial
+    print(f"ap_per_class and APAccumulator match the per-class loops on {args.trials} random datasets")
+
+    batch_metrics = random_predictions(rng, args.ap_predictions)
+    arrays = [np.concatenate(x, 0) for x in zip(*batch_metrics)]
+    expected, loop_time = timed(lambda: reference_ap_per_class(*arrays))
+    actual, vectorized_time = timed(lambda: ap_per_class(*arrays))
+    assert same_ap(expected, actual)
+    print(f"ap_per_class, {args.ap_predictions} predictions: per-class loops {loop_time:.3f} s, "
+          f"vectorized {vectorized_time:.3f} s ({loop_time / vectorized_time:.0f}x)")
+
+    def accumulate():
+        accumulator = APAccumulator()
+        accumulator.update(batch_metrics)
+        return accumulator.compute()
+    actual, accumulator_time = timed(accumulate)
+    assert same_ap(expected, actual)
+    print(f"APAccumulator over {len(batch_metrics)} batches: {accumulator_time:.3f} s")
+
+    outputs, targets = random_batch(rng, args.images, args.predictions)
+    expected, loop_time = timed(lambda: reference_batch_statistics(outputs, targets))
+    actual, vectorized_time = timed(lambda: get_batch_statistics(outputs, targets))
+    assert same_statistics(expected, actual)
+    print(f"get_batch_statistics, {args.images} images x {args.predictions} predictions: "
+          f"per-box loop {loop_time:.3f} s, vectorized {vectorized_time:.3f} s ({loop_time / vectorized_time:.0f}x)")
@@ -0,0 +1,115 @@
+"""
+Peak RSS and epoch time of VOCDeltaDataset, which reads the whole table in memory, and of VOCDeltaStream, which
+reads a window of row groups at a time, each measured in a fresh process over one epoch of a synthetic VOC table.
+The images are decoded but not transformed, so that the peak is the memory of the datasets.
+"""
+import argparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+from torch.utils.data import DataLoader
+
+from benchmark_dataset import create_table
+from data import VOCDeltaDataset, VOCDeltaStream, collate_fn
+
+
+def reset_peak_rss():
+    # Linux only: resets the peak of /proc/self/status, i.e. forgets the peak of the imports
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def rss_mb(field="VmHWM"):
+    """Peak (VmHWM) or current (VmRSS) resident set size of this process."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_epoch(mode, table_dir, window, workers):
+    # Warm-up of the lazy imports and allocations of the DataLoader and the JPEG decoder, common to both datasets
+    next(iter(DataLoader(VOCDeltaStream(table_dir, transforms=None, window=1, shuffle=False), batch_size=4,
+                         collate_fn=collate_fn)))
+    reset_peak_rss()
+    baseline = rss_mb("VmRSS")
+    start = time.perf_counter()
+    if mode == "map":
+        dataset = VOCDeltaDataset(table_dir, transforms=None)
+        loader = DataLoader(dataset, batch_size=4, collate_fn=collate_fn, shuffle=True, num_workers=workers)
+    else:
+        dataset = VOCDeltaStream(table_dir, transforms=None, window=window)
+        loader = DataLoader(dataset, batch_size=4, collate_fn=collate_fn, num_workers=workers)
+
+    images = sum(len(batch_images) for batch_images, _ in loader)
+    elapsed = time.perf_counter() - start
+    print(f"{mode + (f' (window {window})' if mode == 'stream' else ''):<24} {images} images in {elapsed:6.2f} s, "
+          f"peak RSS {rss_mb():7.1f} MB ({rss_mb() - baseline:+7.1f} MB over the imports)")
+    if workers > 0:
+        print("  (the workers are separate processes, not counted)")
+
+
+def same_samples(table_dir):
+    """Whether the stream, unshuffled, yields the samples of VOCDeltaDataset in table order."""
+    dataset = VOCDeltaDataset(table_dir)
+    stream = VOCDeltaStream(table_dir, window=3, shuffle=False)
+    count = 0
+    for i, (image, target) in enumerate(stream):
+        expected_image, expected_target = dataset[i]
+        if not (torch.equal(image, expected_image) and torch.equal(target['boxes'], expected_target['boxes'])
+                and torch.equal(target['labels'], expected_target['labels'])):
+            return False
+        count += 1
+
+    # Shuffled and split between three ranks, every image is still read, and every rank yields as many of them
+    seen = []
+    for rank in range(3):
+        shard = VOCDeltaStream(table_dir, transforms=None, window=3, seed=1, rank=rank, num_replicas=3)
+        shard.set_epoch(1)
+        boxes = [tuple(target['boxes'].flatten().tolist()) for _, target in shard]
+        if len(boxes) != len(shard) or len(boxes) * 3 < len(dataset):
+            return False
+        seen += boxes
+    expected = [tuple(dataset.boxes[dataset.offsets[i]:dataset.offsets[i + 1]].flatten().tolist())
+                for i in range(len(dataset))]
+    return count == len(dataset) and set(seen) == set(expected)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Peak RSS of the in-memory and streaming VOC datasets")
+    parser.add_argument("--images", type=int, default=4000, help="Number of synthetic images in the table")
+    parser.add_argument("--files", type=int, default=4, help="Number of Parquet files of the table")
+    parser.add_argument("--window", type=int, default=4, help="Row groups (of 64 images) per streaming window")
+    parser.add_argument("--workers", type=int, default=0, help="DataLoader workers")
+    parser.add_argument("--epoch", choices=["map", "stream"], help=argparse.SUPPRESS)
+    parser.add_argument("--table", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.epoch:
+        run_epoch(args.epoch, args.table, args.window, args.workers)
+        sys.exit(0)
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        table_dir = os.path.join(work_dir, "train")
+        create_table(table_dir, args.images, args.files)
+        size = sum(os.path.getsize(os.path.join(table_dir, name)) for name in os.listdir(table_dir)
+                   if name.endswith(".parquet"))
+        print(f"Table of {args.images} images, {size / 1024 ** 2:.1f} MB of Parquet")
+
+        # Builds the annotation index, shared by both datasets
+        assert same_samples(table_dir), "The stream does not yield the samples of the table"
+        print("Streamed samples match VOCDeltaDataset")
+
+        for mode in ["map", "stream"]:
+            subprocess.run([sys.executable, __file__, "--epoch", mode, "--table", table_dir, "--window",
+                            str(args.window), "--workers", str(args.workers)], check=True)
+    finally:
+        shutil.rmtree(work_dir)
@@ -1,8 +1,14 @@
 import collections
+import contextlib
+import fcntl
 import io
 import os
+import re
 import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, Tuple
+from urllib.parse import unquote
 
 import boto3
 import json
@@ -18,11 +24,38 @@ from PIL import Image
 import xml.etree.ElementTree as ET
 
 from torchvision import transforms
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, IterableDataset, get_worker_info
 
 
+import pyarrow as pa
 import pyarrow.parquet as pq
 
+VOC_CLASSES = [
+    "aeroplane",
+    "bicycle",
+    "bird",
+    "boat",
+    "bottle",
+    "bus",
+    "car",
+    "cat",
+    "chair",
+    "cow",
+    "diningtable",
+    "dog",
+    "horse",
+    "motorbike",
+    "person",
+    "pottedplant",
+    "sheep",
+    "sofa",
+    "train",
+    "tvmonitor",
+]
+
+# Written next to the Parquet files of a table: the "_" prefix keeps pyarrow from reading it as part of the table
+ANNOTATION_INDEX = '_annotations.npz'
+
 
 def get_test_transforms():
     return transforms.Compose([
@@ -49,37 +82,31 @@ def collate_fn(batch):
     return tuple(zip(*batch))
 
 
+class RepeatingLoader:
+    """
+    Iterates over `loader` again and again. Determined only calls iter() once on a training loader that it did not
+    build, i.e. the DataLoader of an IterableDataset, and expects it to go on for as many epochs as the trial runs.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        while True:
+            yield from self.loader
+
+
 class VOCDeltaDataset(Dataset):
     def __init__(self,
                  root,
                  transforms=get_transform()):
         self.transforms = transforms
-        dataset = pq.ParquetDataset(root)
-        self.table = dataset.read()
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-
-        self.class_names = [
-            "aeroplane",
-            "bicycle",
-            "bird",
-            "boat",
-            "bottle",
-            "bus",
-            "car",
-            "cat",
-            "chair",
-            "cow",
-            "diningtable",
-            "dog",
-            "horse",
-            "motorbike",
-            "person",
-            "pottedplant",
-            "sheep",
-            "sofa",
-            "train",
-            "tvmonitor",
-        ]
+        self.table = read_table_files(root)
+
+        self.class_names = VOC_CLASSES
         self.NUM_CLASSES = len(self.class_names)
         self.name2number = {}
         self.number2name = {}
@@ -87,6 +114,11 @@ class VOCDeltaDataset(Dataset):
             self.name2number[name] = i
             self.number2name[i] = name
 
+        # Objects of image i: boxes[offsets[i]:offsets[i + 1]] and labels[offsets[i]:offsets[i + 1]]
+        self.boxes, self.labels, self.offsets = load_annotation_index(root, self.table.column('annotations'), self.name2number)
+        self.images = binary_buffers(self.table.column('image'))
+        self.image_starts = np.cumsum([0] + [len(chunk) for chunk in self.table.column('image').chunks])
+
     def __getitem__(self, idx):
         """
         Args:
@@ -95,27 +127,23 @@ class VOCDeltaDataset(Dataset):
         Returns:
             tuple: (image, target) where target is a dictionary of the XML tree.
         """
-        example = self.table.slice(idx,1).to_pydict()
-        img = Image.open(io.BytesIO(example['image'][0])).convert('RGB')
-        annotation = example['annotations'][0]
-
-        anno_dict = self.parse_voc_xml(
-            ET.fromstring(annotation))
-
-        labels = []
-        boxes = []
-        for obj in anno_dict['annotation']['object']:
-            labels.append(self.name2number[obj['name']])
-            bb = obj['bndbox']
-            bbox = [float(bb["xmin"]), float(bb["ymin"]), float(bb["xmax"]), float(bb["ymax"])]
-            boxes.append(bbox)
-
-        boxes = torch.as_tensor(boxes, dtype=torch.float32).to(self.device)
-        labels = torch.as_tensor(labels, dtype=torch.int64).to(self.device)
+        if torch.is_tensor(idx):
+            idx = idx.tolist()
+
+        # The image bytes are read in place from the Arrow buffers, without copying the row
+        chunk = np.searchsorted(self.image_starts, idx, side='right') - 1
+        offsets, data = self.images[chunk]
+        row = idx - self.image_starts[chunk]
+        img = Image.open(pa.BufferReader(data[offsets[row]:offsets[row + 1]])).convert('RGB')
+
+        # The samples stay on the CPU: the trial moves the batches to the GPU
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        boxes = torch.tensor(self.boxes[start:end], dtype=torch.float32)
+        labels = torch.tensor(self.labels[start:end], dtype=torch.int64)
         if self.transforms is not None:
             img = self.transforms(img)
 
-        return img.to(self.device), {'labels': labels, 'boxes': boxes}
+        return img, {'labels': labels, 'boxes': boxes}
 
     def __len__(self):
         return self.table.num_rows
@@ -145,16 +173,8 @@ class VOCDeltaDataset(Dataset):
         return self.table.slice(0,n).to_pandas()
 
     def draw_histogram(self):
-        counts = {c: 0 for c in self.class_names}
-        annotations = self.table.column('annotations').to_pandas()
-        for index, annotation in annotations.items():
-            anno_dict = self.parse_voc_xml(ET.fromstring(annotation))
-            for obj in anno_dict['annotation']['object']:
-                name = obj['name']
-                counts[name] += 1
-
-        names = list(counts.keys())
-        values = list(counts.values())
+        names = self.class_names
+        values = np.bincount(self.labels, minlength=self.NUM_CLASSES)
         plt.rcParams['figure.figsize'] = [13, 6]
         plt.bar(names, values)
         plt.xticks(rotation='vertical', fontsize=18)
@@ -163,45 +183,335 @@ class VOCDeltaDataset(Dataset):
 
 
 
+class VOCDeltaStream(IterableDataset):
+    """
+    Streaming version of VOCDeltaDataset, for tables that do not fit in the memory of every rank: the images are read
+    one window of `window` Parquet row groups at a time, and only the annotation index (see load_annotation_index) is
+    kept in memory. With `shuffle`, the row groups are visited in a random order and the images of each window are
+    shuffled, differently at every pass over the table.
 
-def download_s3_dir(bucket_name, directory, download_dir):
-    s3_resource = boto3.resource('s3')
-    bucket = s3_resource.Bucket(bucket_name)
-    for object in bucket.objects.filter(Prefix=directory):
-        path = os.path.join(download_dir, object.key)
-        if not os.path.exists(os.path.dirname(path)):
-            os.makedirs(os.path.dirname(path))
-        bucket.download_file(object.key, path)
+    The row groups are split between the `num_replicas` ranks of a distributed trial, and then between the DataLoader
+    workers of each rank. Every rank yields as many samples as the largest share, the others starting over their row
+    groups for the missing ones, so that all the ranks run the same number of batches. The trial calls `set_epoch`
+    before each pass, since the DataLoader workers iterate over copies of the dataset.
+    """
 
+    def __init__(self,
+                 root,
+                 transforms=get_transform(),
+                 window=4,
+                 shuffle=True,
+                 seed=0,
+                 rank=0,
+                 num_replicas=1):
+        self.transforms = transforms
+        self.window = max(1, int(window))
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.files = [os.path.join(root, path) for path in table_files(root)]
+
+        self.class_names = VOC_CLASSES
+        self.NUM_CLASSES = len(self.class_names)
+        self.name2number = {name: i for i, name in enumerate(self.class_names)}
+        self.number2name = {i: name for i, name in enumerate(self.class_names)}
+        annotations = read_table_files(root, columns=['annotations']).column('annotations')
+        self.boxes, self.labels, self.offsets = load_annotation_index(root, annotations, self.name2number)
+
+        # (file, row group, first row in the table, rows) of the non-empty row groups, from the file footers only
+        row_groups = []
+        first_row = 0
+        for file_idx, path in enumerate(self.files):
+            metadata = pq.ParquetFile(path).metadata
+            for group in range(metadata.num_row_groups):
+                rows = metadata.row_group(group).num_rows
+                if rows > 0:
+                    row_groups.append((file_idx, group, first_row, rows))
+                first_row += rows
+        if len(row_groups) < num_replicas:
+            raise ValueError(f"{root} has {len(row_groups)} row groups, fewer than the {num_replicas} ranks")
+        self.row_groups = row_groups[rank::num_replicas]
+        self.num_samples = max(sum(rows for _, _, _, rows in row_groups[r::num_replicas]) for r in range(num_replicas))
+
+    def __len__(self):
+        return self.num_samples
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+
+        row_groups = self.row_groups
+        if self.shuffle:
+            row_groups = [row_groups[i] for i in rng.permutation(len(row_groups))]
+        num_samples = self.num_samples
+        worker = get_worker_info()
+        if worker is not None:
+            # A worker without row groups of its own pads from the others
+            row_groups = row_groups[worker.id::worker.num_workers] or row_groups
+            num_samples = num_samples // worker.num_workers + (worker.id < num_samples % worker.num_workers)
+
+        count = 0
+        while count < num_samples:
+            for sample in self.stream(row_groups, rng):
+                if count == num_samples:
+                    return
+                yield sample
+                count += 1
+
+    def stream(self, row_groups, rng):
+        """Samples of `row_groups`, read `window` row groups at a time."""
+        parquet_files = {}
+        for start in range(0, len(row_groups), self.window):
+            window = []
+            for file_idx, group, first_row, rows in row_groups[start:start + self.window]:
+                if file_idx not in parquet_files:
+                    parquet_files[file_idx] = pq.ParquetFile(self.files[file_idx])
+                images = parquet_files[file_idx].read_row_group(group, columns=['image']).column('image')
+                window.append(binary_buffers(images))
+
+            # (row group in the window, chunk, row in the chunk, row in the table) of every image of the window
+            samples = []
+            for w, (file_idx, group, first_row, rows) in enumerate(row_groups[start:start + self.window]):
+                chunks = [(w, chunk, row) for chunk, (offsets, _) in enumerate(window[w])
+                          for row in range(len(offsets) - 1)]
+                samples += [location + (first_row + i,) for i, location in enumerate(chunks)]
+
+            order = rng.permutation(len(samples)) if self.shuffle else range(len(samples))
+            for i in order:
+                w, chunk, row, idx = samples[i]
+                yield self.sample(window[w][chunk], row, idx)
+
+    def sample(self, buffers, row, idx):
+        offsets, data = buffers
+        img = Image.open(pa.BufferReader(data[offsets[row]:offsets[row + 1]])).convert('RGB')
+
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        boxes = torch.tensor(self.boxes[start:end], dtype=torch.float32)
+        labels = torch.tensor(self.labels[start:end], dtype=torch.int64)
+        if self.transforms is not None:
+            img = self.transforms(img)
 
-def download_parquet(bucket, table, files, save_path):
-    s3 = boto3.client('s3')
-    table_path = os.path.join(save_path, table)
-    if not os.path.exists(table_path):
-        os.makedirs(table_path, exist_ok=True)
-    for file in files:
-        path = os.path.join(table, file)
-        s3.download_file(bucket, path, os.path.join(save_path, path))
-    return table_path
+        return img, {'labels': labels, 'boxes': boxes}
+
+
+def table_files(root):
+    """
+    Paths of the Parquet files of the table in `root`, relative to it, in the order in which their rows are numbered.
+    As with pyarrow, the files and directories starting with "_" or "." (i.e. the Delta log) are not part of the table.
+    """
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if not name.startswith(('_', '.'))]
+        paths += [os.path.relpath(os.path.join(dirpath, name), root) for name in filenames
+                  if name.endswith('.parquet') and not name.startswith(('_', '.'))]
+    return sorted(paths)
+
+
+def read_table_files(root, columns=None):
+    return pa.concat_tables([pq.read_table(os.path.join(root, path), columns=columns) for path in table_files(root)])
+
+
+def parse_annotations(annotations, name2number):
+    """
+    Parses the VOC XML annotations of a table into flat arrays: the boxes (float32, N x 4) and labels (int64, N) of
+    the objects of every image, one image after the other, and the offsets (int64, images + 1) such that the objects
+    of image i are at [offsets[i], offsets[i + 1]).
+    """
+    boxes = []
+    labels = []
+    offsets = [0]
+    for annotation in annotations:
+        for obj in ET.fromstring(annotation).findall('object'):
+            labels.append(name2number[obj.find('name').text.strip()])
+            bb = obj.find('bndbox')
+            boxes.append([float(bb.find(coord).text) for coord in ('xmin', 'ymin', 'xmax', 'ymax')])
+        offsets.append(len(labels))
+
+    return (np.array(boxes, dtype=np.float32).reshape(-1, 4),
+            np.array(labels, dtype=np.int64),
+            np.array(offsets, dtype=np.int64))
+
+
+def load_annotation_index(root, annotations, name2number):
+    """
+    Returns the parsed `annotations` column of the table in `root` (see parse_annotations), read from
+    ANNOTATION_INDEX in the table directory, or parsed and saved there the first time. A version of a Delta table
+    never changes once downloaded, so the index is only parsed again if the number of images does not match.
+    """
+    path = os.path.join(root, ANNOTATION_INDEX)
+    if os.path.exists(path):
+        with np.load(path) as index:
+            if len(index['offsets']) == len(annotations) + 1:
+                return index['boxes'], index['labels'], index['offsets']
+
+    boxes, labels, offsets = parse_annotations(annotations.to_pylist(), name2number)
+    # Written under a temporary name, so that the other ranks never read a partial index
+    tmp = f'{path}.{os.getpid()}.tmp.npz'
+    np.savez(tmp, boxes=boxes, labels=labels, offsets=offsets)
+    os.replace(tmp, path)
+    return boxes, labels, offsets
+
+
+def binary_buffers(column):
+    """
+    Returns (offsets, data) for each chunk of a binary Arrow column, where value i is data[offsets[i]:offsets[i + 1]].
+    Slicing `data` is zero-copy.
+    """
+    buffers = []
+    for chunk in column.chunks:
+        offset_type = np.int64 if pa.types.is_large_binary(chunk.type) else np.int32
+        _, offsets, data = chunk.buffers()
+        offsets = np.frombuffer(offsets, dtype=offset_type)[chunk.offset:chunk.offset + len(chunk) + 1]
+        buffers.append((offsets.astype(np.int64), data))
+    return buffers
+
+
+DELTA_LOG = '_delta_log'
+# Immutable Delta log and data files, downloaded once per S3 key, in a directory of the dataset cache that is not
+# one of its entries (the "." prefix)
+DELTA_MIRROR = '.delta-mirror'
+CHECKPOINT_RE = re.compile(r'^(\d{20})\.checkpoint(?:\.(\d{10})\.(\d{10}))?\.parquet$')
+
+
+def download_version(table_path, bucket, version, cache, workers=8, s3=None):
+    """
+    Downloads version `version` of the Delta table `table_path` into the dataset cache `cache` (see DatasetCache),
+    unless it is already there, and returns the local directory of the table.
+
+    Log and data files are downloaded concurrently into a mirror of the bucket kept in the cache, and hard-linked
+    from there into the version's entry: moving from a cached version to the next one only downloads the new files.
+    The log is replayed from the latest checkpoint at or before `version`.
+    """
+    s3 = boto3.client('s3') if s3 is None else s3
+    mirror = os.path.join(cache.root, DELTA_MIRROR, bucket)
+    os.makedirs(mirror, exist_ok=True)
+
+    download = lambda path: materialize_version(s3, bucket, table_path, version, mirror, path, workers)
+    root, _ = cache.fetch(("delta", bucket, table_path, version), download)
+    prune_mirror(mirror)
+    return os.path.join(root, table_path)
+
+
+def materialize_version(s3, bucket, table_path, version, mirror, save_path, workers=8):
+    """
+    Lays out version `version` of the table in `save_path`: its active data files, and the log files that lead to
+    the version, all hard-linked from `mirror`.
+    """
+    with mirror_lock(mirror, fcntl.LOCK_SH):
+        log_keys, data_files = replay_log(s3, bucket, table_path, version, mirror, workers)
+        data_keys = [os.path.join(table_path, file) for file in sorted(data_files)]
+        downloaded = fetch_files(s3, bucket, data_keys, mirror, workers)
+        print(f"Version {version} of {table_path}: {len(data_keys)} data files, "
+              f"{downloaded / 1024 ** 2:.1f} MB downloaded")
+
+        for key in log_keys + data_keys:
+            path = os.path.join(save_path, key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.link(os.path.join(mirror, key), path)
+
+
+def replay_log(s3, bucket, table_path, version, mirror, workers=8):
+    """
+    Returns the keys of the log files that make up version `version` of the table, and the set of data files
+    active at that version (relative to the table). The replay starts from the latest checkpoint at or before
+    `version`, if any, instead of the first commit.
+    """
+    log_dir = os.path.join(table_path, DELTA_LOG)
+    names = set(list_files(s3, bucket, log_dir + '/'))
+
+    checkpoint, parts = latest_checkpoint(names, version)
+    first = 0 if checkpoint is None else checkpoint + 1
+    commits = [str(v).zfill(20) + '.json' for v in range(first, version + 1)]
+    missing = [name for name in commits if name not in names]
+    if missing:
+        raise ValueError(f"Version {version} of s3://{bucket}/{table_path} cannot be replayed, missing {missing[0]}")
+
+    log_keys = [os.path.join(log_dir, name) for name in parts + commits]
+    fetch_files(s3, bucket, log_keys, mirror, workers)
 
-def download_version(table_path, bucket, version=0, save_path='./'):
-    if os.path.exists(table_path):
-        shutil.rmtree(table_path)
-    delta_config_folder = "_delta_log"
-    config_path = os.path.join(table_path, delta_config_folder)
-    download_s3_dir(bucket, config_path, save_path)
-    local_config_dir = os.path.join(save_path, table_path, delta_config_folder)
     files = set()
-    for v in range(version+1):
-        filename = str(v).zfill(20) + '.json'
-        with open(os.path.join(local_config_dir, filename)) as f:
+    for name in parts:
+        adds = pq.read_table(os.path.join(mirror, log_dir, name), columns=['add']).column('add').to_pylist()
+        files.update(unquote(add['path']) for add in adds if add is not None)
+    for name in commits:
+        with open(os.path.join(mirror, log_dir, name)) as f:
             for line in f:
                 info = json.loads(line.strip())
                 if 'add' in info:
-                    files.add(info['add']['path'])
+                    files.add(unquote(info['add']['path']))
                 if 'remove' in info:
-                    files.remove(info['remove']['path'])
-    return download_parquet(bucket, table_path, files, save_path)
+                    files.discard(unquote(info['remove']['path']))
+    return log_keys, files
+
+
+def latest_checkpoint(names, version):
+    """
+    Returns the version and file names of the latest complete checkpoint at or before `version` among the log file
+    names `names`, or (None, []). A checkpoint is either a single file or `parts` files written in parallel.
+    """
+    checkpoints = collections.defaultdict(list)
+    for name in names:
+        match = CHECKPOINT_RE.match(name)
+        if match and int(match.group(1)) <= version:
+            checkpoints[int(match.group(1)), int(match.group(3) or 1)].append(name)
+
+    complete = [(v, parts) for (v, parts), files in checkpoints.items() if len(files) == parts]
+    if not complete:
+        return None, []
+    latest = max(complete)
+    return latest[0], sorted(checkpoints[latest])
+
+
+def list_files(s3, bucket, prefix):
+    """Names of the objects under `prefix`, relative to it."""
+    names = []
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        names += [obj['Key'][len(prefix):] for obj in page.get('Contents', [])]
+    return names
+
+
+def fetch_files(s3, bucket, keys, mirror, workers=8):
+    """
+    Downloads the objects `keys` that are not in `mirror` yet, `workers` at a time, and returns the number of bytes
+    downloaded. The files of a Delta table are never modified once written, so a file in the mirror is up to date.
+    """
+    def fetch(key):
+        path = os.path.join(mirror, key)
+        if os.path.exists(path):
+            return 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        s3.download_file(bucket, key, tmp)
+        os.replace(tmp, path)
+        return os.path.getsize(path)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return sum(executor.map(fetch, keys))
+
+
+@contextlib.contextmanager
+def mirror_lock(mirror, operation):
+    with open(os.path.join(mirror, '.lock'), 'a') as lock:
+        fcntl.flock(lock, operation)
+        yield
+
+
+def prune_mirror(mirror):
+    """
+    Deletes the files of `mirror` that no version in the dataset cache links to anymore (i.e. since their versions
+    were evicted), unless another process is materializing a version right now.
+    """
+    try:
+        with mirror_lock(mirror, fcntl.LOCK_EX | fcntl.LOCK_NB):
+            for dirpath, _, filenames in os.walk(mirror):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    if name != '.lock' and os.stat(path).st_nlink == 1:
+                        os.remove(path)
+    except BlockingIOError:
+        pass
 
 
 def draw_example(image, labels, title=None):
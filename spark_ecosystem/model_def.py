@@ -13,8 +13,9 @@ import determined as det
 from determined.pytorch import DataLoader, LRScheduler, PyTorchTrial
 from determined.experimental import Determined
 
-from data import VOCDeltaDataset, download_version, collate_fn
-from utils import get_batch_statistics, ap_per_class
+from data import RepeatingLoader, VOCDeltaDataset, VOCDeltaStream, download_version, collate_fn
+from dataset_cache import DatasetCache
+from utils import get_batch_statistics, APAccumulator
 
 TorchData = Union[Dict[str, torch.Tensor], Sequence[torch.Tensor], torch.Tensor]
 
@@ -29,8 +30,22 @@ class ObjectDetectionModel(PyTorchTrial):
             self.num_classes = 20
         else:
             self.download_data()
-            self.train_dataset = VOCDeltaDataset(self.train_data_path)
-            self.val_dataset = VOCDeltaDataset(self.val_data_path)
+            self.streaming = self.context.get_data_config().get('streaming', False)
+            if self.streaming:
+                # The streams are read through plain DataLoaders, see build_training_data_loader
+                self.context.experimental.disable_dataset_reproducibility_checks()
+                # Only a window of row groups of each table is kept in memory. The training row groups are split
+                # between the ranks, while evaluate_full_dataset reads the whole validation table
+                window = self.context.get_data_config().get('stream_window', 4)
+                self.train_dataset = VOCDeltaStream(self.train_data_path,
+                                                    window=window,
+                                                    seed=self.context.get_trial_seed(),
+                                                    rank=self.context.distributed.get_rank(),
+                                                    num_replicas=self.context.distributed.get_size())
+                self.val_dataset = VOCDeltaStream(self.val_data_path, window=window, shuffle=False)
+            else:
+                self.train_dataset = VOCDeltaDataset(self.train_data_path)
+                self.val_dataset = VOCDeltaDataset(self.val_data_path)
             self.num_classes = self.train_dataset.NUM_CLASSES
 
     def download_data(self):
@@ -40,10 +55,20 @@ class ObjectDetectionModel(PyTorchTrial):
         train_version = data_config['train']['version']
         val_table = data_config['val']['table']
         val_version = data_config['val']['version']
-        self.train_data_path = download_version(train_table, bucket, train_version, self.download_directory)
-        self.val_data_path = download_version(val_table, bucket, val_version, self.download_directory)
+        cache = DatasetCache.from_data_config(data_config)
+        workers = data_config.get('download_workers', 8)
+        self.train_data_path = download_version(train_table, bucket, train_version, cache, workers)
+        self.val_data_path = download_version(val_table, bucket, val_version, cache, workers)
 
     def build_training_data_loader(self) -> DataLoader:
+        if self.streaming:
+            # Iterable datasets shard themselves, Determined's DataLoader would add a sampler. Without it, the trial
+            # starts from the beginning of an epoch when it is resumed
+            return RepeatingLoader(torch.utils.data.DataLoader(
+                self.train_dataset,
+                batch_size=self.context.get_per_slot_batch_size(),
+                collate_fn=collate_fn,
+            ))
         return DataLoader(
             self.train_dataset,
             batch_size=self.context.get_per_slot_batch_size(),
@@ -51,6 +76,12 @@ class ObjectDetectionModel(PyTorchTrial):
         )
 
     def build_validation_data_loader(self) -> DataLoader:
+        if self.streaming:
+            return torch.utils.data.DataLoader(
+                self.val_dataset,
+                batch_size=self.context.get_per_slot_batch_size(),
+                collate_fn=collate_fn,
+            )
         return DataLoader(
             self.val_dataset,
             batch_size=self.context.get_per_slot_batch_size(),
@@ -90,6 +121,10 @@ class ObjectDetectionModel(PyTorchTrial):
         self, batch: TorchData, model: nn.Module, epoch_idx: int, batch_idx: int
     ) -> Dict[str, torch.Tensor]:
         images, targets = batch
+        if self.streaming:
+            # The next pass over the stream starts in new copies of the dataset, made once this epoch's batches are
+            # drawn
+            self.train_dataset.set_epoch(epoch_idx + 1)
         loss_dict = model(list(images), list(targets))
         total_loss = sum([loss_dict[l] for l in loss_dict])
 
@@ -100,23 +135,18 @@ class ObjectDetectionModel(PyTorchTrial):
 
 
     def evaluate_full_dataset(self, data_loader, model):
-        batch_stats = []
+        accumulator = APAccumulator()
         model.eval()
-        device = torch.device('cuda')
+        device = next(model.parameters()).device
         with torch.no_grad():
             for images, targets in data_loader:
-                images = list(images)
-                targets = list(targets)
-                # for image in images:
-                #     image = image.to(device)
-                # for target in targets:
-                #     target['labels'] = target['labels'].to(device)
-                #     target['boxes'] = target['boxes'].to(device)
+                # Unlike the batches of train_batch, these are not moved to the GPU by Determined
+                images = [image.to(device, non_blocking=True) for image in images]
+                targets = [{k: v.to(device, non_blocking=True) for k, v in target.items()} for target in targets]
                 outputs = model(images, copy.deepcopy(targets))
-                batch_stats += get_batch_statistics(outputs, targets, iou_threshold=0.5)
+                accumulator.update(get_batch_statistics(outputs, targets, iou_threshold=0.5))
 
-        true_positives, pred_scores, pred_labels, labels = [np.concatenate(x, 0) for x in list(zip(*batch_stats))]
-        precision, recall, AP, f1, ap_class = ap_per_class(true_positives, pred_scores, pred_labels, labels)
+        precision, recall, AP, f1, ap_class = accumulator.compute()
         metrics =  {'mAP': AP.mean()}
         for i, c in enumerate(ap_class):
             class_name = self.train_dataset.number2name[c]
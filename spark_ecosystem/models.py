@@ -11,7 +11,8 @@ from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
 from tqdm.auto import tqdm
 
 from data import VOCDeltaDataset, download_version, collate_fn
-from utils import get_batch_statistics, ap_per_class
+from dataset_cache import DatasetCache
+from utils import get_batch_statistics, APAccumulator
 
 
 class ObjectDetectionModel(object):
@@ -22,7 +23,7 @@ class ObjectDetectionModel(object):
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         self.hparams = hparams
 
-        self.download_directory = "/tmp/VOC/"
+        self.dataset_cache = DatasetCache()
         self.build_model()
         self.make_data_loaders()
         self.make_optimizer()
@@ -56,8 +57,8 @@ class ObjectDetectionModel(object):
         train_version = self.train_data_version
         val_table = 'val'
         val_version = self.val_data_version
-        self.train_data_path = download_version(train_table, bucket, train_version, self.download_directory)
-        self.val_data_path = download_version(val_table, bucket, val_version, self.download_directory)
+        self.train_data_path = download_version(train_table, bucket, train_version, self.dataset_cache)
+        self.val_data_path = download_version(val_table, bucket, val_version, self.dataset_cache)
 
     def train_one_epoch(self):
         self.model.train();
@@ -65,27 +66,32 @@ class ObjectDetectionModel(object):
         self.epoch += 1
         train_loop = tqdm(self.train_loader, desc=f"Training Epoch {self.epoch}")
         for images, targets in train_loop:
+            images, targets = self.to_device(images, targets)
             self.optimizer.zero_grad()
-            losses = self.model(list(images), list(targets))
+            losses = self.model(images, targets)
             total_loss = sum([losses[l] for l in losses])
             total_loss.backward()
             self.optimizer.step()
 
     def eval(self):
-        batch_stats = []
+        accumulator = APAccumulator()
         self.model.eval()
         with torch.no_grad():
             val_loop = tqdm(self.val_loader, desc=f"Evaluating at Epoch {self.epoch}")
             for images, targets in val_loop:
-                images = list(images)
-                targets = list(targets)
+                images, targets = self.to_device(images, targets)
                 outputs = self.model(images, copy.deepcopy(targets))
-                batch_stats += get_batch_statistics(outputs, targets, iou_threshold=0.5)
+                accumulator.update(get_batch_statistics(outputs, targets, iou_threshold=0.5))
 
-        true_positives, pred_scores, pred_labels, labels = [np.concatenate(x, 0) for x in list(zip(*batch_stats))]
-        precision, recall, AP, f1, ap_class = ap_per_class(true_positives, pred_scores, pred_labels, labels)
+        precision, recall, AP, f1, ap_class = accumulator.compute()
         print(f"mAP: {AP.mean()}")
 
+    def to_device(self, images, targets):
+        # VOCDeltaDataset returns samples on the CPU
+        images = [image.to(self.device, non_blocking=True) for image in images]
+        targets = [{k: v.to(self.device, non_blocking=True) for k, v in target.items()} for target in targets]
+        return images, targets
+
     def visualize_example(self):
         image, label = self.dataset_train[0]
         draw_example(image.permute(1,2,0).numpy(), label, title="Training Example")
@@ -17,34 +17,24 @@ def get_batch_statistics(outputs, targets, iou_threshold=0.5):
             continue
 
         pred_boxes = output['boxes']
-        pred_scores = output['scores']
-        pred_labels = output['labels']
+        pred_scores = output['scores'].cpu().numpy()
+        pred_labels = output['labels'].cpu().numpy()
+        target_labels = target['labels'].cpu().numpy()
 
         true_positives = np.zeros(pred_boxes.shape[0])
 
-        num_target_boxes = len(target['labels'])
-
-        if num_target_boxes > 0:
-            detected_boxes = []
-            target_boxes = target['boxes']
-
-            for pred_i, (pred_box, pred_label) in enumerate(zip(pred_boxes, pred_labels)):
-
-                # If targets are found break
-                if len(detected_boxes) == num_target_boxes:
-                    break
-
-                # Ignore if label is not one of the target labels
-                if pred_label not in target['labels']:
-                    continue
-
-                ious = torchvision.ops.box_iou(target_boxes, pred_box.unsqueeze(0)).cpu().numpy()
-                box_index = np.argmax(ious)
-                iou = np.max(ious)
-                if iou >= iou_threshold and box_index not in detected_boxes:
-                    true_positives[pred_i] = 1
-                    detected_boxes += [box_index]
-        batch_metrics.append([true_positives, pred_scores.cpu().numpy(), pred_labels.cpu().numpy(), target['labels'].cpu().numpy()])
+        if len(target_labels) > 0 and len(pred_labels) > 0:
+            # IoU of every prediction with every target, and the target each prediction overlaps most
+            ious = torchvision.ops.box_iou(target['boxes'], pred_boxes).cpu().numpy()
+            box_index = np.argmax(ious, axis=0)
+            iou = np.max(ious, axis=0)
+
+            # Predictions are matched greedily, in order: one whose label is among the target labels and whose best
+            # target is close enough is a true positive, unless an earlier prediction already took that target
+            candidates = np.flatnonzero(np.isin(pred_labels, target_labels) & (iou >= iou_threshold))
+            _, first = np.unique(box_index[candidates], return_index=True)
+            true_positives[candidates[first]] = 1
+        batch_metrics.append([true_positives, pred_scores, pred_labels, target_labels])
     return batch_metrics
 
 
@@ -59,48 +49,49 @@ def ap_per_class(tp, conf, pred_cls, target_cls):
     # Returns
         The average precision as computed in py-faster-rcnn.
     """
+    # Find unique classes, and their number of ground truth objects
+    unique_classes, n_gt = np.unique(target_cls, return_counts=True)
+    return ap_per_class_counts(np.asarray(tp), np.asarray(conf), np.asarray(pred_cls), unique_classes, n_gt)
+
 
-    # Sort by objectness
+def ap_per_class_counts(tp, conf, pred_cls, unique_classes, n_gt):
+    """ ap_per_class, given the number of ground truth objects `n_gt` of each of the `unique_classes` instead of the
+    class of every object.
+    """
+    # Sort by objectness, then group by class: the predictions of each class stay sorted by objectness
     i = np.argsort(-conf)
-    tp, conf, pred_cls = tp[i], conf[i], pred_cls[i]
+    i = i[np.argsort(pred_cls[i], kind='stable')]
+    tp, pred_cls = tp[i], pred_cls[i]
 
-    # Find unique classes
-    unique_classes = np.unique(target_cls)
+    # Accumulate FPs and TPs of all classes at once, then start every class from zero
+    starts = np.searchsorted(pred_cls, unique_classes, side='left')
+    ends = np.searchsorted(pred_cls, unique_classes, side='right')
+    tpc_all = np.concatenate(([0.0], np.cumsum(tp)))
+    fpc_all = np.concatenate(([0.0], np.cumsum(1 - tp)))
 
     # Create Precision-Recall curve and compute AP for each class
-    ap, p, r = [], [], []
-    for c in unique_classes:
-        i = pred_cls == c
-        n_gt = (target_cls == c).sum()  # Number of ground truth objects
-        n_p = i.sum()  # Number of predicted objects
-
-        if n_p == 0 and n_gt == 0:
+    ap, p, r = np.zeros(len(unique_classes)), np.zeros(len(unique_classes)), np.zeros(len(unique_classes))
+    for c, (start, end) in enumerate(zip(starts, ends)):
+        if start == end:
             continue
-        elif n_p == 0 or n_gt == 0:
-            ap.append(0)
-            r.append(0)
-            p.append(0)
-        else:
-            # Accumulate FPs and TPs
-            fpc = (1 - tp[i]).cumsum()
-            tpc = (tp[i]).cumsum()
-
-            # Recall
-            recall_curve = tpc / (n_gt + 1e-16)
-            r.append(recall_curve[-1])
-
-            # Precision
-            precision_curve = tpc / (tpc + fpc)
-            p.append(precision_curve[-1])
-
-            # AP from recall-precision curve
-            ap.append(compute_ap(recall_curve, precision_curve))
+        tpc = tpc_all[start + 1:end + 1] - tpc_all[start]
+        fpc = fpc_all[start + 1:end + 1] - fpc_all[start]
+
+        # Recall
+        recall_curve = tpc / (n_gt[c] + 1e-16)
+        r[c] = recall_curve[-1]
+
+        # Precision
+        precision_curve = tpc / (tpc + fpc)
+        p[c] = precision_curve[-1]
+
+        # AP from recall-precision curve
+        ap[c] = compute_ap(recall_curve, precision_curve)
 
     # Compute F1 score (harmonic mean of precision and recall)
-    p, r, ap = np.array(p), np.array(r), np.array(ap)
     f1 = 2 * p * r / (p + r + 1e-16)
 
-    return p, r, ap, f1, unique_classes.astype("int32")
+    return p, r, ap, f1, np.asarray(unique_classes).astype("int32")
 
 
 def compute_ap(recall, precision):
@@ -117,9 +108,8 @@ def compute_ap(recall, precision):
     mrec = np.concatenate(([0.0], recall, [1.0]))
     mpre = np.concatenate(([0.0], precision, [0.0]))
 
-    # compute the precision envelope
-    for i in range(mpre.size - 1, 0, -1):
-        mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+    # compute the precision envelope: maximum of the precisions at higher recalls
+    mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
     # to calculate area under PR curve, look for points
     # where X axis (recall) changes value
@@ -130,6 +120,53 @@ def compute_ap(recall, precision):
     return ap
 
 
+class APAccumulator(object):
+    """ Accumulates the outputs of get_batch_statistics over a dataset, for ap_per_class. The predictions are kept in
+    arrays that grow by doubling, and the targets are only counted per class, instead of keeping the arrays of every
+    batch until they are concatenated.
+    """
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.size = 0
+        self.tp = self.conf = self.pred_cls = None
+        self.n_gt = np.zeros(0, dtype=np.int64)
+
+    def update(self, batch_metrics):
+        for true_positives, pred_scores, pred_labels, target_labels in batch_metrics:
+            self.add(true_positives, pred_scores, pred_labels, target_labels)
+
+    def add(self, tp, conf, pred_cls, target_cls):
+        if self.tp is None:
+            self.tp = np.empty(self.capacity, dtype=tp.dtype)
+            self.conf = np.empty(self.capacity, dtype=conf.dtype)
+            self.pred_cls = np.empty(self.capacity, dtype=pred_cls.dtype)
+
+        end = self.size + len(tp)
+        if end > len(self.tp):
+            capacity = max(end, 2 * len(self.tp))
+            self.tp, self.conf, self.pred_cls = [np.resize(x, capacity) for x in (self.tp, self.conf, self.pred_cls)]
+        self.tp[self.size:end] = tp
+        self.conf[self.size:end] = conf
+        self.pred_cls[self.size:end] = pred_cls
+        self.size = end
+
+        counts = np.bincount(np.asarray(target_cls, dtype=np.int64))
+        if len(counts) > len(self.n_gt):
+            self.n_gt = np.pad(self.n_gt, (0, len(counts) - len(self.n_gt)))
+        self.n_gt[:len(counts)] += counts
+
+    def compute(self):
+        """ Returns ap_per_class of all the accumulated predictions and targets. """
+        unique_classes = np.flatnonzero(self.n_gt)
+        if self.tp is None:
+            return ap_per_class_counts(np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64), unique_classes,
+                                       self.n_gt[unique_classes])
+        n = self.size
+        return ap_per_class_counts(self.tp[:n], self.conf[:n], self.pred_cls[:n], unique_classes,
+                                   self.n_gt[unique_classes])
+
+
 def show_hp_comparison():
     hyperband = .5272
     old_hps = .3806